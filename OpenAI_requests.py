@@ -1,19 +1,21 @@
-from openai import OpenAI
-
+import base64
 import json
 import re
 import logging
 
-from config import OPENAI_API_KEY
+# Wszystkie zapytania idą przez bramkę (limity, ponawianie, terminy, bezpiecznik)
+from openai_gateway import chat_completion
+
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-# client.api_key=OPENAI_API_KEY
+def image_data_url(image_bytes: bytes, content_type: str = "image/jpeg") -> str:
+    """Zdjęcie jako data URL do pola image_url - OpenAI nie musi pobierać go z S3."""
+    return f"data:{content_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
 
 
 def query_meal_nutrients(image_url: str, user_context: dict,language: str ="english"):
     """
     Delegates the ChatGPT query to estimate macronutrient values based on the provided image URL
-    and additional user context regarding dietary issues.
+    (an https link or a data URL from image_data_url) and additional user context regarding dietary issues.
     The original query text is preserved.
     Returns a tuple containing:
       - A dictionary with keys: 'name', 'kcal', 'proteins', 'carbs', 'fats', 'healthy_index', 'problems'
@@ -36,7 +38,7 @@ def query_meal_nutrients(image_url: str, user_context: dict,language: str ="engl
             f"The value for 'problems' should be a list. Do not add any additional text. If there are additional issues not specified, do not include them."
     )
 
-    response = client.chat.completions.create(model="gpt-4o-mini",
+    response = chat_completion(model="gpt-4o-mini",
         messages=[
             {
                 "role": "user",
@@ -49,7 +51,8 @@ def query_meal_nutrients(image_url: str, user_context: dict,language: str ="engl
                 ]
             }
         ],
-        max_tokens=300)
+        max_tokens=300,
+        hedge=True)
     result_text = response.choices[0].message.content
 
     if result_text.startswith("```"):
@@ -106,7 +109,7 @@ def new_goal(sex, birthDate, height, lifestyle, diet, startTime, endTime):
         "Respond in JSON format with exactly the keys: 'kcal', 'proteins', 'carbs', 'fats'. Do not include any additional text."
     )
 
-    response = client.chat.completions.create(model="gpt-4o-mini",
+    response = chat_completion(model="gpt-4o-mini",
     messages=[
         {"role": "user", "content": prompt}
     ],
@@ -160,7 +163,7 @@ def meals_from_barcode_problems(food_name: str, ingredients: str, user_context:
         "Do not include any additional text."
     )
 
-    response = client.chat.completions.create(model="gpt-4o-mini",
+    response = chat_completion(model="gpt-4o-mini",
         messages=[
             {"role": "user", "content": prompt}
         ],
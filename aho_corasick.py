@@ -0,0 +1,88 @@
+# aho_corasick.py
+"""
+Automat Aho-Corasicka: wyszukuje wszystkie wzorce ze słownika w jednym przejściu po tekście.
+
+Tekst i wzorce są normalizowane tak samo (małe litery, bez znaków diakrytycznych,
+ujednolicone białe znaki), więc 'Mleko', 'mléko' i 'MLEKO' to ten sam wzorzec.
+Wzorzec zakończony '*' dopasowuje też dłuższe słowa ('mlek*' -> 'mleka', 'mlekiem');
+pozostałe muszą być całym słowem ('nut' nie pasuje do 'nutmeg').
+"""
+import re
+import unicodedata
+from collections import deque
+
+_SPACES = re.compile(r"[\s_\-]+")
+# Litery, których NFKD nie rozkłada na literę bazową + znak diakrytyczny
+_LIGATURES = str.maketrans({"œ": "oe", "æ": "ae", "ß": "ss", "ł": "l"})
+
+
+def normalize(text: str) -> str:
+    text = str(text or "").casefold().translate(_LIGATURES)
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _SPACES.sub(" ", text).strip()
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum()
+
+
+class Automaton:
+    """Słownik wzorzec -> wartość skompilowany do jednego automatu."""
+
+    def __init__(self, patterns):
+        # Węzeł: [przejścia, link porażki, wyjścia (długość, wartość, czy prefiks)]
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern, value in patterns:
+            prefix = pattern.endswith("*")
+            word = normalize(pattern.rstrip("*"))
+            if word:
+                self._add(word, (len(word), value, prefix))
+        self._build()
+
+    def _add(self, word, output):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(output)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """(początek, koniec, wartość) dla każdego dopasowania w znormalizowanym tekście."""
+        node = 0
+        length = len(text)
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for size, value, prefix in self._out[node]:
+                start = i - size + 1
+                if start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if not prefix and i + 1 < length and _is_word_char(text[i + 1]):
+                    continue
+                yield start, i + 1, value
+
+    def find(self, text: str) -> set:
+        """Zbiór wartości wszystkich wzorców występujących w tekście."""
+        return {value for _, _, value in self.iter_matches(normalize(text))}
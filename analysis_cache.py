@@ -0,0 +1,98 @@
+# analysis_cache.py
+"""
+Cache wyników meals_from_barcode_problems adresowany treścią.
+
+Wynik analizy zależy tylko od produktu (nazwa, składniki) i kontekstu użytkownika
+(dieta, problemy, język), więc kluczem jest sha256 ze znormalizowanych wejść - dwóch
+użytkowników z tym samym profilem skanujących ten sam produkt dzieli jedną analizę.
+Kolejność: LRU w procesie -> tabela BarcodeAnalysisCache -> OpenAI.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+from datetime import datetime, timedelta
+
+from psycopg2.extras import Json
+
+from cache import TTLCache
+from config import ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_LOCAL_SIZE, ANALYSIS_CACHE_LOCAL_TTL
+from OpenAI_requests import meals_from_barcode_problems
+from pipeline import cursor_lock
+
+logger = logging.getLogger("server_logger")
+
+# Zmiana promptu w meals_from_barcode_problems wymaga podbicia wersji (unieważnia stare wpisy)
+PROMPT_VERSION = 1
+
+_local_cache = TTLCache(ANALYSIS_CACHE_LOCAL_SIZE, ANALYSIS_CACHE_LOCAL_TTL)
+_counters = {"local_hits": 0, "db_hits": 0, "misses": 0}
+_counters_lock = threading.Lock()
+
+
+def _norm(text) -> str:
+    return re.sub(r"\s+", " ", str(text or "")).strip().casefold()
+
+
+def analysis_key(food_name: str, ingredients: str, user_context: dict) -> str:
+    payload = {
+        "v": PROMPT_VERSION,
+        "name": _norm(food_name),
+        "ingredients": _norm(ingredients),
+        "diet": _norm(user_context.get("diet")),
+        # Problemy to zbiór - kolejność i duplikaty nie zmieniają analizy
+        "problems": sorted({_norm(p) for p in user_context.get("problems") or [] if _norm(p)}),
+        "language": _norm(user_context.get("language")),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _count(name: str):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def cached_barcode_problems(cur, food_name: str, ingredients: str, user_context: dict) -> dict:
+    """meals_from_barcode_problems z cache; zwraca słownik {'healthy_index', 'problems'}."""
+    key = analysis_key(food_name, ingredients, user_context)
+    result = _local_cache.get(key)
+    if result is not None:
+        _count("local_hits")
+        return result
+
+    # Kursor żądania tylko na czas zapytań - etap oceny w pipeline.py czeka na OpenAI bez blokady
+    with cursor_lock():
+        cur.execute(
+            "SELECT result FROM BarcodeAnalysisCache WHERE key = %s AND created_at > %s",
+            (key, datetime.now() - timedelta(seconds=ANALYSIS_CACHE_TTL))
+        )
+        row = cur.fetchone()
+    if row is not None:
+        _count("db_hits")
+        _local_cache.set(key, row[0])
+        return row[0]
+
+    _count("misses")
+    result, _ = meals_from_barcode_problems(food_name, ingredients, user_context)
+    # Nieudane parsowanie odpowiedzi (healthy_index -1) nie trafia do cache
+    if result.get("healthy_index", -1) != -1:
+        with cursor_lock():
+            cur.execute("""
+                INSERT INTO BarcodeAnalysisCache (key, result, created_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (key) DO UPDATE SET result = EXCLUDED.result, created_at = EXCLUDED.created_at
+            """, (key, Json(result), datetime.now()))
+        _local_cache.set(key, result)
+    return result
+
+
+def get_analysis_cache_stats() -> dict:
+    with _counters_lock:
+        stats = dict(_counters)
+    total = sum(stats.values())
+    hits = stats["local_hits"] + stats["db_hits"]
+    stats["requests"] = total
+    stats["hit_rate"] = hits / total if total else 0.0
+    stats["local"] = _local_cache.stats()
+    return stats
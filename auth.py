@@ -1,104 +1,212 @@
 # auth.py
-import requests
+import asyncio
+import hashlib
+import time
+
+import httpx
 from fastapi import HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import logging
-from jose import jwt
-from config import JWKS_URL, COGNITO_APP_CLIENT_ID, COGNITO_REGION, USER_POOL_ID, APPLE_JWKS_URL, APPLE_CLIENT_ID
+from jose import jwk, jwt
+from config import JWKS_URL, COGNITO_APP_CLIENT_ID, COGNITO_ISSUER, APPLE_JWKS_URL, APPLE_CLIENT_ID, APPLE_TOKEN_ISSUER
+from config import JWKS_TTL, JWKS_MIN_REFETCH_INTERVAL
+from config import TOKEN_CACHE_SIZE, TOKEN_CACHE_MAX_TTL, TOKEN_NEGATIVE_CACHE_SIZE, TOKEN_NEGATIVE_CACHE_TTL
+from cache import TTLCache
+from config import SESSION_TOKEN_ISSUER
+from session_tokens import verify_session_token
 
 logger = logging.getLogger("server_logger")
 oauth2_scheme = HTTPBearer()
-jwks_data = None
-apple_jwks_data = None
-
-def get_jwks():
-    global jwks_data
-    if not jwks_data:
-        resp = requests.get(JWKS_URL)
-        if resp.status_code == 200:
-            jwks_data = resp.json()
-            logger.info("Pobrano klucze JWKS z Cognito.")
-        else:
-            logger.error("Nie można pobrać JWKS z Cognito, status: %s", resp.status_code)
-            raise HTTPException(status_code=500, detail="Nie można pobrać JWKS z Cognito.")
-    return jwks_data
-
-def verify_jwt_token(token: str):
-    jwks = get_jwks()
-    unverified_headers = jwt.get_unverified_header(token)
-    kid = unverified_headers.get("kid")
-
-    public_key = None
-    for key in jwks["keys"]:
-        if key["kid"] == kid:
-            public_key = key
-            break
-    if not public_key:
-        logger.error("Nieprawidłowy token (brak odpowiedniego klucza kid)")
-        raise HTTPException(status_code=401, detail="Nieprawidłowy token (kid).")
+
+# get_current_user działa na pętli zdarzeń - żadnych blokujących wywołań sieciowych
+# ani ciężkich obliczeń bezpośrednio w tym module.
+_http_client = None
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=5)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+class JWKSKeyManager:
+    """
+    Klucze publiczne jednego dostawcy tożsamości, trzymane jako gotowe obiekty
+    jose w słowniku kid -> klucz.
+
+    - po upływie ttl klucze są odświeżane w tle (żądanie używa dotychczasowych),
+    - nieznany kid wymusza ponowne pobranie, ale nie częściej niż co min_refetch_interval s
+      (ochrona przed zalewem tokenami z losowym kid),
+    - równoległe żądania czekają na jedno wspólne pobranie zamiast wysyłać własne.
+    """
+
+    def __init__(self, name: str, jwks_url: str, ttl: float = JWKS_TTL,
+                 min_refetch_interval: float = JWKS_MIN_REFETCH_INTERVAL):
+        self.name = name
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}
+        self._fetched_at = 0.0
+        self._last_attempt = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    async def _fetch(self) -> dict:
+        resp = await _get_http_client().get(self.jwks_url)
+        if resp.status_code != 200:
+            raise RuntimeError(f"status {resp.status_code}")
+        keys = {}
+        for key_data in resp.json().get("keys", []):
+            try:
+                keys[key_data["kid"]] = jwk.construct(key_data, key_data.get("alg", "RS256"))
+            except Exception as e:
+                logger.warning("Pominięto nieprawidłowy klucz JWKS z %s: %s", self.name, e)
+        return keys
+
+    def _may_refetch(self) -> bool:
+        return self._last_attempt == 0.0 or time.monotonic() - self._last_attempt >= self.min_refetch_interval
+
+    async def refresh(self, only_if=None) -> bool:
+        async with self._lock:
+            # Ktoś mógł pobrać klucze, gdy czekaliśmy na blokadę
+            if only_if is not None and not only_if():
+                return True
+            self._last_attempt = time.monotonic()
+            try:
+                keys = await self._fetch()
+            except Exception as e:
+                logger.error("Nie można pobrać JWKS z %s: %s", self.name, e)
+                return False
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        logger.info("Pobrano klucze JWKS z %s (%s kluczy).", self.name, len(keys))
+        return True
+
+    def _refresh_in_background(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+
+    async def get_key(self, kid):
+        if not self._keys:
+            # Pierwsze użycie (albo wszystkie dotychczasowe próby nieudane) - trzeba poczekać
+            if self._may_refetch():
+                await self.refresh(only_if=lambda: not self._keys and self._may_refetch())
+            if not self._keys:
+                raise HTTPException(status_code=500, detail=f"Nie można pobrać JWKS z {self.name}.")
+        elif time.monotonic() - self._fetched_at >= self.ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            # Możliwa rotacja kluczy u dostawcy
+            logger.info("Nieznany kid w tokenie %s, ponowne pobranie JWKS.", self.name)
+            await self.refresh(only_if=lambda: kid not in self._keys and self._may_refetch())
+            key = self._keys.get(kid)
+        return key
+
+
+class TokenProvider:
+    def __init__(self, name: str, issuer: str, audience: str, keys: JWKSKeyManager):
+        self.name = name
+        self.issuer = issuer
+        self.audience = audience
+        self.keys = keys
+
+    def _decode(self, token: str, public_key) -> dict:
+        try:
+            return jwt.decode(
+                token,
+                public_key,
+                audience=self.audience,
+                issuer=self.issuer,
+                options={"verify_aud": True}
+            )
+        except Exception as e:
+            logger.error("Token z %s niepoprawny: %s", self.name, e)
+            raise HTTPException(status_code=401, detail=f"Token z {self.name} niepoprawny: {str(e)}")
+
+    async def verify(self, token: str, kid) -> dict:
+        public_key = await self.keys.get_key(kid)
+        if public_key is None:
+            logger.error("Nieprawidłowy token (brak odpowiedniego klucza kid) z %s.", self.name)
+            raise HTTPException(status_code=401, detail=f"Nieprawidłowy token (kid) z {self.name}.")
+        # Weryfikacja RSA to czysty CPU - poza pętlą zdarzeń
+        return await run_in_threadpool(self._decode, token, public_key)
+
+
+cognito_provider = TokenProvider("Cognito", COGNITO_ISSUER, COGNITO_APP_CLIENT_ID,
+                                 JWKSKeyManager("Cognito", JWKS_URL))
+apple_provider = TokenProvider("Apple", APPLE_TOKEN_ISSUER, APPLE_CLIENT_ID,
+                               JWKSKeyManager("Apple", APPLE_JWKS_URL))
+_providers_by_issuer = {
+    cognito_provider.issuer: cognito_provider,
+    apple_provider.issuer: apple_provider,
+}
+
+
+# Klucz to skrót tokena - sam token nie jest trzymany w pamięci
+_verified_tokens = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_MAX_TTL)
+_rejected_tokens = TTLCache(TOKEN_NEGATIVE_CACHE_SIZE, TOKEN_NEGATIVE_CACHE_TTL)
+
+
+def _token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+async def verify_token_cached(token: str) -> dict:
+    """
+    verify_token z cache: poprawne tokeny są pamiętane do ich 'exp' (nie dłużej niż
+    TOKEN_CACHE_MAX_TTL), odrzucone (401) przez TOKEN_NEGATIVE_CACHE_TTL s.
+    """
+    key = _token_key(token)
+    claims = _verified_tokens.get(key)
+    if claims is not None:
+        if claims.get("exp", 0) > time.time():
+            return claims
+        _verified_tokens.pop(key)
+    rejected = _rejected_tokens.get(key)
+    if rejected is not None:
+        raise HTTPException(status_code=401, detail=rejected)
+
     try:
-        decoded_token = jwt.decode(
-            token,
-            public_key,
-            audience=COGNITO_APP_CLIENT_ID,
-            issuer=f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{USER_POOL_ID}",
-            options={"verify_aud": True}
-        )
-        logger.info("Token JWT z Cognito został pomyślnie zweryfikowany.")
-    except Exception as e:
-        logger.error("Token Cognito niepoprawny: %s", e)
-        raise HTTPException(status_code=401, detail=f"Token Cognito niepoprawny: {str(e)}")
-    return decoded_token
-
-def get_apple_jwks():
-    global apple_jwks_data
-    if not apple_jwks_data:
-        resp = requests.get(APPLE_JWKS_URL)
-        if resp.status_code == 200:
-            apple_jwks_data = resp.json()
-            logger.info("Pobrano klucze JWKS z Apple.")
-        else:
-            logger.error("Nie można pobrać JWKS z Apple, status: %s", resp.status_code)
-            raise HTTPException(status_code=500, detail="Nie można pobrać JWKS z Apple.")
-    return apple_jwks_data
-
-def verify_apple_jwt_token(token: str):
-    jwks = get_apple_jwks()
-    unverified_headers = jwt.get_unverified_header(token)
-    kid = unverified_headers.get("kid")
-    public_key = None
-    for key in jwks["keys"]:
-        if key["kid"] == kid:
-            public_key = key
-            break
-    if not public_key:
-        logger.error("Nieprawidłowy token (brak odpowiedniego klucza kid) z Apple.")
-        raise HTTPException(status_code=401, detail="Nieprawidłowy token (kid) z Apple.")
+        claims = await verify_token(token)
+    except HTTPException as e:
+        if e.status_code == 401:
+            _rejected_tokens.set(key, e.detail)
+        raise
+    ttl = min(claims.get("exp", 0) - time.time(), TOKEN_CACHE_MAX_TTL)
+    if ttl > 0:
+        _verified_tokens.set(key, claims, ttl=ttl)
+    return claims
+
+
+async def verify_token(token: str) -> dict:
+    # Dostawcę wybieramy po niezweryfikowanym 'iss' - podpis i tak sprawdza jego klucz
     try:
-        decoded_token = jwt.decode(
-            token,
-            public_key,
-            audience=APPLE_CLIENT_ID,
-            issuer="https://appleid.apple.com",
-            options={"verify_aud": True}
-        )
-        logger.info("Token JWT z Apple został pomyślnie zweryfikowany.")
+        unverified_headers = jwt.get_unverified_header(token)
+        unverified_claims = jwt.get_unverified_claims(token)
     except Exception as e:
-        logger.error("Token z Apple niepoprawny: %s", e)
-        raise HTTPException(status_code=401, detail=f"Token z Apple niepoprawny: {str(e)}")
-    return decoded_token
+        logger.error("Nie można odczytać tokena: %s", e)
+        raise HTTPException(status_code=401, detail="Niepoprawny token.")
+    if unverified_claims.get("iss") == SESSION_TOKEN_ISSUER:
+        # HMAC jest tani - weryfikujemy bezpośrednio na pętli
+        return verify_session_token(token, unverified_headers.get("kid"))
+    provider = _providers_by_issuer.get(unverified_claims.get("iss"))
+    if provider is None:
+        logger.error("Token od nieznanego wystawcy: %s", unverified_claims.get("iss"))
+        raise HTTPException(status_code=401, detail="Niepoprawny token.")
+    return await provider.verify(token, unverified_headers.get("kid"))
+
 
 async def get_current_user(request: Request, creds: HTTPAuthorizationCredentials = Depends(oauth2_scheme)):
-    token = creds.credentials
-    try:
-        decoded = verify_jwt_token(token)
-        return decoded
-    except HTTPException as e_cognito:
-        logger.info("Weryfikacja tokena jako Cognito nie powiodła się, próba jako Apple...")
-        try:
-            decoded = verify_apple_jwt_token(token)
-            return decoded
-        except HTTPException as e_apple:
-            logger.error("Token niepoprawny dla Cognito ani Apple: Cognito: %s, Apple: %s", e_cognito.detail,
-                         e_apple.detail)
-            raise HTTPException(status_code=401, detail="Niepoprawny token.")
\ No newline at end of file
+    return await verify_token_cached(creds.credentials)
@@ -0,0 +1,133 @@
+# backfill_healthy_index.py
+"""
+Przelicza healthy_index historycznych posiłków z kodem kreskowym na lokalny Nutri-Score.
+
+Wartości odżywcze bierzemy z Product, a dla starszych posiłków z ProductCache albo
+lokalnego indeksu OffProduct. Wiersze są czytane kursorem serwerowym paczkami, wynik liczony
+wektorowo (nutriscore.healthy_indexes_from_matrix) i zapisywany jednym UPDATE na paczkę.
+
+    python backfill_healthy_index.py --dry-run
+    python backfill_healthy_index.py --only-missing      # tylko posiłki z healthy_index = -1
+"""
+import argparse
+import collections
+import logging
+import time
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+from nutriscore import NUTRIENT_COLUMNS, GRADE_HEALTHY_INDEX, healthy_indexes_from_matrix
+
+logger = logging.getLogger("server_logger")
+
+BATCH_SIZE = 10000
+_NUMBER = r"^-?[0-9]+(\.[0-9]+)?([eE][-+]?[0-9]+)?$"
+
+
+def _nutrient_sql(keys) -> str:
+    values = [f"CASE WHEN n->>'{key}' ~ '{_NUMBER}' THEN (n->>'{key}')::float END" for key in keys]
+    return values[0] if len(values) == 1 else f"COALESCE({', '.join(values)})"
+
+
+def _select_sql(only_missing: bool) -> str:
+    columns = ",\n               ".join(_nutrient_sql(keys) for _, keys in NUTRIENT_COLUMNS)
+    where = "AND m.healthy_index = -1" if only_missing else ""
+    return f"""
+        SELECT m.ID, m.healthy_index, grade,
+               {columns}
+        FROM Meal m
+        LEFT JOIN Product p ON p.barcode = m.bar_code
+        LEFT JOIN ProductCache pc ON pc.barcode = m.bar_code AND pc.found
+        LEFT JOIN OffProduct op ON op.barcode = m.bar_code
+        CROSS JOIN LATERAL (SELECT COALESCE(p.nutriments, pc.data->'nutriments', op.data->'nutriments') AS n,
+                                   COALESCE(p.nutriscore_grade, pc.data->>'nutriscore_grade',
+                                            op.data->>'nutriscore_grade') AS grade) src
+        WHERE m.bar_code IS NOT NULL {where}
+        ORDER BY m.ID
+    """
+
+
+def compute_batch(rows):
+    """[(meal_id, stary healthy_index, nowy healthy_index albo None)] dla paczki wierszy z _select_sql."""
+    matrix = np.array([row[3:] for row in rows], dtype=float)
+    values = healthy_indexes_from_matrix(matrix)
+    result = []
+    for row, value in zip(rows, values):
+        new = None if np.isnan(value) else int(value)
+        if new is None:
+            new = GRADE_HEALTHY_INDEX.get((row[2] or "").lower())
+        result.append((row[0], row[1], new))
+    return result
+
+
+def backfill(conn, only_missing=False, dry_run=False, batch_size=BATCH_SIZE) -> dict:
+    stats = collections.Counter()
+    histogram = collections.Counter()
+    reader = conn.cursor(name="healthy_index_backfill", withhold=True)
+    writer = conn.cursor()
+    start = time.perf_counter()
+    try:
+        reader.itersize = batch_size
+        reader.execute(_select_sql(only_missing))
+        while True:
+            rows = reader.fetchmany(batch_size)
+            if not rows:
+                break
+            updates = []
+            for meal_id, old, new in compute_batch(rows):
+                stats["rows"] += 1
+                if new is None:
+                    stats["no_data"] += 1
+                    continue
+                histogram[new] += 1
+                if new != old:
+                    updates.append((meal_id, new))
+            stats["updated"] += len(updates)
+            if updates and not dry_run:
+                execute_values(writer, """
+                    UPDATE Meal SET healthy_index = v.healthy_index
+                    FROM (VALUES %s) AS v(id, healthy_index)
+                    WHERE Meal.ID = v.id
+                """, updates, page_size=len(updates))
+                conn.commit()
+            logger.info("healthy_index: przetworzono %s posiłków.", stats["rows"])
+    finally:
+        reader.close()
+        writer.close()
+        if dry_run:
+            conn.rollback()
+    stats["seconds"] = time.perf_counter() - start
+    stats["histogram"] = dict(sorted(histogram.items()))
+    return dict(stats)
+
+
+def _connect(dsn):
+    if dsn:
+        return psycopg2.connect(dsn)
+    from db import get_db_connection
+    return get_db_connection()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Uzupełnia healthy_index posiłków z kodem kreskowym (Nutri-Score).")
+    parser.add_argument("--dsn", help="DSN Postgresa (domyślnie baza serwera z config)")
+    parser.add_argument("--only-missing", action="store_true", help="tylko posiłki z healthy_index = -1")
+    parser.add_argument("--dry-run", action="store_true", help="policz, ale nie zapisuj")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    conn = _connect(args.dsn)
+    try:
+        stats = backfill(conn, args.only_missing, args.dry_run, args.batch_size)
+    finally:
+        conn.close()
+    print(f"{stats.get('rows', 0)} posiłków, {stats.get('updated', 0)} "
+          f"{'do zmiany' if args.dry_run else 'zmienionych'}, {stats.get('no_data', 0)} bez danych, "
+          f"{stats['seconds']:.1f} s; rozkład healthy_index: {stats['histogram']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Opóźnienie pętli zdarzeń podczas uwierzytelniania - stary sposób vs nowy.
+
+  blocking: requests.get po JWKS + jwt.decode bezpośrednio w async get_current_user
+            (tak działał auth.py przed zmianą)
+  async:    httpx.AsyncClient po JWKS (jedno wspólne pobranie) + jwt.decode w threadpoolu
+            (tak działa auth.py teraz, bez cache tokenów - najgorszy przypadek)
+
+Skrypt nie wymaga AWS: stawia lokalny serwer JWKS z opóźnieniem i podpisuje własne tokeny RS256.
+W trakcie testu co 1 ms tyka korutyna-zegar; jej spóźnienie to czas, przez który pętla
+była zablokowana (tyle czekają wszystkie inne żądania w tym workerze).
+
+    python benchmarks/auth_event_loop_lag.py --requests 200 --concurrency 50 --jwks-delay 0.3
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import requests
+from fastapi.concurrency import run_in_threadpool
+from jose import jwk, jwt
+from jose.backends import RSAKey
+
+ISSUER = "https://issuer.local"
+AUDIENCE = "bench-client"
+KID = "bench-key"
+
+
+def make_key_pair():
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                    serialization.NoEncryption())
+    except ImportError:
+        import rsa
+        _, private = rsa.newkeys(2048)
+        pem = private.save_pkcs1()
+    private_key = RSAKey(pem.decode(), "RS256")
+    public_jwk = private_key.public_key().to_dict()
+    public_jwk["kid"] = KID
+    return pem.decode(), public_jwk
+
+
+def start_jwks_server(public_jwk, delay):
+    body = json.dumps({"keys": [public_jwk]}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/jwks.json"
+
+
+class BlockingAuth:
+    """Odwzorowanie dawnego auth.py: globalny cache JWKS, wszystko synchronicznie."""
+
+    def __init__(self, url):
+        self.url = url
+        self.jwks = None
+
+    async def verify(self, token):
+        if not self.jwks:
+            self.jwks = requests.get(self.url).json()
+        kid = jwt.get_unverified_header(token)["kid"]
+        key = next(k for k in self.jwks["keys"] if k["kid"] == kid)
+        return jwt.decode(token, key, audience=AUDIENCE, issuer=ISSUER)
+
+
+class AsyncAuth:
+    """Odwzorowanie obecnego auth.py: async pobieranie JWKS, gotowe klucze, dekodowanie w threadpoolu."""
+
+    def __init__(self, url):
+        self.url = url
+        self.keys = {}
+        self.lock = asyncio.Lock()
+        self.client = httpx.AsyncClient(timeout=5)
+
+    async def verify(self, token):
+        if not self.keys:
+            async with self.lock:
+                if not self.keys:
+                    data = (await self.client.get(self.url)).json()
+                    self.keys = {k["kid"]: jwk.construct(k, "RS256") for k in data["keys"]}
+        key = self.keys[jwt.get_unverified_header(token)["kid"]]
+        return await run_in_threadpool(jwt.decode, token, key, audience=AUDIENCE, issuer=ISSUER)
+
+
+async def ticker(stop, lags, interval=0.001):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def run_mode(auth, tokens, concurrency):
+    stop = asyncio.Event()
+    lags = []
+    tick = asyncio.create_task(ticker(stop, lags))
+    await asyncio.sleep(0.01)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(token):
+        async with semaphore:
+            start = time.perf_counter()
+            await auth.verify(token)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(t) for t in tokens))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await tick
+    if isinstance(auth, AsyncAuth):
+        await auth.client.aclose()
+    return elapsed, lags, latencies
+
+
+def pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(name, elapsed, lags, latencies, n):
+    print(f"{name:9s} total {elapsed:7.3f} s | {n / elapsed:8.1f} req/s | "
+          f"loop lag p50 {statistics.median(lags) * 1000:7.2f} ms  p99 {pct(lags, 0.99) * 1000:7.2f} ms  "
+          f"max {max(lags) * 1000:7.2f} ms | request p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+          f"p99 {pct(latencies, 0.99) * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--jwks-delay", type=float, default=0.3, help="opóźnienie serwera JWKS w sekundach")
+    args = parser.parse_args()
+
+    private_pem, public_jwk = make_key_pair()
+    server, url = start_jwks_server(public_jwk, args.jwks_delay)
+    now = int(time.time())
+    tokens = [
+        jwt.encode({"iss": ISSUER, "aud": AUDIENCE, "sub": f"user-{i}", "iat": now, "exp": now + 3600},
+                   private_pem, algorithm="RS256", headers={"kid": KID})
+        for i in range(args.requests)
+    ]
+    try:
+        for name, auth_cls in (("blocking", BlockingAuth), ("async", AsyncAuth)):
+            elapsed, lags, latencies = asyncio.run(run_mode(auth_cls(url), tokens, args.concurrency))
+            report(name, elapsed, lags, latencies, args.requests)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Przygotowanie zdjęć: dotychczasowy kod endpointów (open, copy, thumbnail, zapis w formacie
+oryginału) kontra images.prepare_image (draft JPEG, orientacja EXIF, bez metadanych, limit
+rozmiaru JPEG/WebP). Dla każdej metody na korpusie zdjęć:
+
+  - rozmiar wyniku (średnio i maksymalnie),
+  - czas dekodowania i kodowania jednego zdjęcia (średnio, p95),
+  - szczytowe RSS procesu (każda metoda w osobnym procesie potomnym),
+
+a na koniec przepustowość --concurrency równoczesnych zdjęć: wątki (dotychczasowy kod)
+kontra pula procesów images.prepare().
+
+    python benchmarks/image_preprocessing.py --corpus ~/zdjecia --format WEBP
+    python benchmarks/image_preprocessing.py --synthetic 20 --max-bytes 150000
+"""
+import argparse
+import io
+import os
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import images  # noqa: E402
+
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".heic", ".tif", ".tiff")
+
+
+def legacy_prepare(data: bytes, fmt=None, max_size=images.MAX_SIZE, quality=None, max_bytes=None) -> bytes:
+    # Kod sprzed images.py - pełne dekodowanie, metadane i format oryginału zostają
+    img = Image.open(io.BytesIO(data))
+    img_small = img.copy()
+    if img_small.width > max_size[0] or img_small.height > max_size[1]:
+        img_small.thumbnail(max_size, Image.LANCZOS)
+    buf = io.BytesIO()
+    img_small.save(buf, format=img.format if img.format else "PNG")
+    return buf.getvalue()
+
+
+def synthetic_corpus(count: int):
+    """Zdjęcia jak z telefonu: 12 Mpx JPEG z EXIF (także obrócone) i kilka PNG."""
+    corpus = []
+    for i in range(count):
+        width, height = (4032, 3024) if i % 2 else (3024, 4032)
+        img = Image.effect_noise((width // 4, height // 4), 40 + i % 30).convert("RGB").resize((width, height))
+        buf = io.BytesIO()
+        if i % 5 == 4:
+            img.resize((width // 2, height // 2)).save(buf, format="PNG")
+        else:
+            exif = Image.Exif()
+            exif[0x0112] = 6 if i % 2 else 1
+            exif[0x010F] = "Phone"
+            img.save(buf, format="JPEG", quality=90, exif=exif.tobytes())
+        corpus.append(buf.getvalue())
+    return corpus
+
+
+def load_corpus(path: str):
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(EXTENSIONS):
+            with open(os.path.join(path, name), "rb") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def measure(name, prepare, corpus, options):
+    """Uruchamiane w procesie potomnym - ru_maxrss dotyczy tylko tej metody."""
+    sizes, times = [], []
+    for data in corpus:
+        start = time.perf_counter()
+        body = prepare(data, **options)
+        times.append(time.perf_counter() - start)
+        sizes.append(len(body))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:8s} wynik średnio {statistics.mean(sizes) / 1024:6.1f} KiB (max {max(sizes) / 1024:6.1f})   "
+          f"czas średnio {statistics.mean(times) * 1000:6.1f} ms   p95 {_percentile(times, 0.95) * 1000:6.1f} ms   "
+          f"szczytowe RSS {peak_rss:6.0f} MiB", flush=True)
+
+
+def in_child(fn, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            fn(*args)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def throughput(name, run, corpus, concurrency):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, corpus))
+    wall = time.perf_counter() - start
+    print(f"{name:24s} {len(corpus) / wall:6.1f} zdjęć/s ({wall:.2f} s na {len(corpus)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Porównanie przygotowania zdjęć: dotychczasowy kod i images.py.")
+    parser.add_argument("--corpus", help="katalog ze zdjęciami (domyślnie syntetyczne)")
+    parser.add_argument("--synthetic", type=int, default=10, help="liczba syntetycznych zdjęć")
+    parser.add_argument("--format", default="JPEG", choices=sorted(images.CONTENT_TYPES))
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument("--max-bytes", type=int, default=150000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="procesy puli images")
+    parser.add_argument("--concurrency", type=int, default=8, help="równoczesne zdjęcia w teście przepustowości")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.synthetic)
+    if not corpus:
+        parser.error("brak zdjęć w korpusie")
+    print(f"korpus: {len(corpus)} zdjęć, średnio {statistics.mean(map(len, corpus)) / 1024:.0f} KiB")
+
+    options = {"fmt": args.format, "quality": args.quality, "max_bytes": args.max_bytes}
+    in_child(measure, "legacy", legacy_prepare, corpus, {})
+    in_child(measure, "images", images.prepare_image, corpus, options)
+
+    throughput("legacy, wątki", legacy_prepare, corpus, args.concurrency)
+    images.start_pool(args.workers)
+    try:
+        throughput(f"images, {args.workers} procesy", lambda data: images.prepare(data, **options),
+                   corpus, args.concurrency)
+    finally:
+        images.stop_pool()
+
+
+if __name__ == "__main__":
+    main()
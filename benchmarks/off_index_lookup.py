@@ -0,0 +1,133 @@
+"""
+Przepustowość lokalnego indeksu Open Food Facts (tabela OffProduct).
+
+Skrypt ładuje N syntetycznych produktów przez off_index.copy_batch (ten sam COPY co
+off_dump_loader.py) w jednej transakcji, mierzy:
+  - szybkość ładowania (wiersze/s),
+  - pojedyncze lookup() z jednego wątku,
+  - lookup_many() paczkami,
+a na koniec wycofuje transakcję - baza zostaje bez zmian. Z --keep dane zostają
+zatwierdzone i mierzony jest też lookup() z kilku wątków (każdy z własnym połączeniem).
+
+    python benchmarks/off_index_lookup.py --dsn postgresql://user@localhost/foodio --synthetic 200000
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import off_index  # noqa: E402
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS OffProduct (
+        barcode varchar(100) PRIMARY KEY,
+        data jsonb NOT NULL,
+        last_modified_t bigint NOT NULL DEFAULT 0
+    );
+"""
+
+
+def synthetic_rows(n, base=5900000000000):
+    for i in range(n):
+        yield str(base + i), {
+            "name": f"Produkt {i}",
+            "kcal": 120 + i % 300,
+            "proteins": 4.5,
+            "carbs": 20.1,
+            "fats": 3.2,
+            "ingredients": "mąka pszenna, woda, sól, drożdże",
+            "image_url": f"https://images.openfoodfacts.org/images/products/{i}/front.jpg",
+            "nutriments": {"energy-kcal_100g": 240, "proteins_100g": 9, "sugars_100g": 2.5},
+        }, 1700000000 + i
+
+
+def bench_single(cur, barcodes):
+    start = time.perf_counter()
+    for barcode in barcodes:
+        off_index.lookup(cur, barcode)
+    return len(barcodes) / (time.perf_counter() - start)
+
+
+def bench_many(cur, barcodes, batch):
+    start = time.perf_counter()
+    for i in range(0, len(barcodes), batch):
+        off_index.lookup_many(cur, barcodes[i:i + batch])
+    return len(barcodes) / (time.perf_counter() - start)
+
+
+def bench_threads(dsn, barcodes, threads):
+    per_thread = len(barcodes) // threads
+    results = []
+
+    def worker(chunk):
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        try:
+            results.append(bench_single(cur, chunk))
+        finally:
+            cur.close()
+            conn.close()
+
+    workers = [threading.Thread(target=worker, args=(barcodes[i * per_thread:(i + 1) * per_thread],))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", required=True)
+    parser.add_argument("--synthetic", type=int, default=200000, help="liczba syntetycznych produktów")
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=100, help="rozmiar paczki dla lookup_many")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--keep", action="store_true", help="zatwierdź dane (wymagane, by wątki je widziały)")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    try:
+        cur.execute(SCHEMA)
+        start = time.perf_counter()
+        loaded = 0
+        rows = synthetic_rows(args.synthetic)
+        while True:
+            batch = [r for _, r in zip(range(50000), rows)]
+            if not batch:
+                break
+            loaded += off_index.copy_batch(cur, batch)
+        load_time = time.perf_counter() - start
+        cur.execute("ANALYZE OffProduct")
+        if args.keep:
+            conn.commit()
+        print(f"load          {loaded} wierszy w {load_time:.2f} s ({loaded / load_time:,.0f} wierszy/s)")
+
+        rng = random.Random(1)
+        barcodes = [str(5900000000000 + rng.randrange(args.synthetic)) for _ in range(args.lookups)]
+        print(f"lookup        {bench_single(cur, barcodes):,.0f} lookupów/s (1 wątek, 1 zapytanie na kod)")
+        print(f"lookup_many   {bench_many(cur, barcodes, args.batch):,.0f} lookupów/s "
+              f"(1 wątek, paczki po {args.batch})")
+        if args.keep:
+            print(f"lookup x{args.threads:<4d} {bench_threads(args.dsn, barcodes, args.threads):,.0f} lookupów/s "
+                  f"({args.threads} wątków, osobne połączenia)")
+        else:
+            # Inne połączenia nie widzą niezatwierdzonych danych
+            print("lookup xN     pominięte - uruchom z --keep")
+    finally:
+        if not args.keep:
+            conn.rollback()
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
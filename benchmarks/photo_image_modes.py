@@ -0,0 +1,186 @@
+"""
+Czas analizy zdjęcia (od zmniejszonego zdjęcia w pamięci do odpowiedzi modelu) dla obu
+wartości OPENAI_IMAGE_MODE, na lokalnych zastępnikach S3 i OpenAI:
+
+  url    - PUT resized_ do S3, presigned URL, zapytanie; OpenAI pobiera zdjęcie z S3,
+  inline - zapytanie z data URL (base64) w treści, bez S3.
+
+Zastępnik S3 dolicza --s3-rtt do każdego żądania, zastępnik OpenAI - --model-time na
+odpowiedź i --fetch-rtt na pobranie zdjęcia z S3; oba doliczają czas przesłania danych
+przy --bandwidth Mbit/s. Zapytanie ma ten sam kształt co query_meal_nutrients.
+
+    python benchmarks/photo_image_modes.py --iterations 30
+    python benchmarks/photo_image_modes.py --image meal.jpg --s3-rtt 0.03 --fetch-rtt 0.12
+"""
+import argparse
+import base64
+import io
+import json
+import statistics
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+from openai import OpenAI
+from PIL import Image
+
+MAX_SIZE = (512, 1024)
+
+
+def _transfer_time(size: int, bandwidth: float) -> float:
+    return size * 8 / (bandwidth * 1e6)
+
+
+def start_s3(rtt: float, bandwidth: float):
+    objects = {}
+
+    class S3Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(rtt + _transfer_time(len(body), bandwidth))
+            objects[self.path] = body
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            body = objects.get(self.path.split("?")[0])
+            time.sleep(rtt + _transfer_time(len(body or b""), bandwidth))
+            self.send_response(200 if body is not None else 404)
+            self.send_header("Content-Length", str(len(body or b"")))
+            self.end_headers()
+            self.wfile.write(body or b"")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), S3Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_openai(model_time: float, fetch_rtt: float, bandwidth: float):
+    fetch = requests.Session()
+
+    class OpenAIHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(_transfer_time(len(raw), bandwidth))
+            payload = json.loads(raw)
+            for part in payload["messages"][0]["content"]:
+                if part.get("type") != "image_url":
+                    continue
+                url = part["image_url"]["url"]
+                if url.startswith("data:"):
+                    image = base64.b64decode(url.split(",", 1)[1])
+                else:
+                    # OpenAI pobiera zdjęcie z S3 (inna sieć niż nasz serwer)
+                    time.sleep(fetch_rtt)
+                    image = fetch.get(url).content
+                Image.open(io.BytesIO(image)).verify()
+            time.sleep(model_time)
+            content = '{"name": "pasta", "kcal": 640, "proteins": 22, "carbs": 85, "fats": 21, ' \
+                      '"healthy_index": 6, "problems": []}'
+            body = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": payload["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": 1200, "completion_tokens": 60, "total_tokens": 1260},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_photo(width=3024, height=4032) -> bytes:
+    # Szum zamiast jednolitego koloru - rozmiar JPEG zbliżony do zdjęcia z telefonu
+    img = Image.effect_noise((width // 4, height // 4), 60).convert("RGB").resize((width, height))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def resized_jpeg(original: bytes) -> bytes:
+    img = Image.open(io.BytesIO(original))
+    img.thumbnail(MAX_SIZE, Image.ANTIALIAS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def ask(client, image_url: str):
+    return client.chat.completions.create(model="gpt-4o-mini", max_tokens=300, messages=[{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "Estimate the macronutrient values based on the image."},
+            {"type": "image_url", "image_url": {"url": image_url}},
+        ],
+    }])
+
+
+def run_url(client, s3_base: str, s3_session, resized: bytes, i: int):
+    key = f"/bucket/resized_bench_{i}.jpg"
+    s3_session.put(s3_base + key, data=resized, headers={"Content-Type": "image/jpeg"})
+    # Podpis presigned URL jest liczony lokalnie - bez ruchu sieciowego
+    ask(client, f"{s3_base}{key}?X-Amz-Signature=bench")
+
+
+def run_inline(client, s3_base, s3_session, resized: bytes, i: int):
+    ask(client, "data:image/jpeg;base64," + base64.b64encode(resized).decode("ascii"))
+
+
+def measure(name, run, iterations, *args):
+    times = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        run(*args, i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(f"{name:7s} średnio {statistics.mean(times) * 1000:7.1f} ms   p50 {times[len(times) // 2] * 1000:7.1f} ms   "
+          f"p95 {times[min(int(0.95 * len(times)), len(times) - 1)] * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Porównanie OPENAI_IMAGE_MODE=url i inline na zastępnikach S3/OpenAI.")
+    parser.add_argument("--image", help="plik zdjęcia (domyślnie syntetyczne 3024x4032)")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--s3-rtt", type=float, default=0.03, help="opóźnienie żądania do S3 z serwera [s]")
+    parser.add_argument("--fetch-rtt", type=float, default=0.10, help="opóźnienie pobrania z S3 przez OpenAI [s]")
+    parser.add_argument("--model-time", type=float, default=0.8, help="czas odpowiedzi modelu [s]")
+    parser.add_argument("--bandwidth", type=float, default=100.0, help="przepustowość łączy [Mbit/s]")
+    args = parser.parse_args()
+
+    original = open(args.image, "rb").read() if args.image else synthetic_photo()
+    resized = resized_jpeg(original)
+    print(f"zdjęcie {len(original) / 1024:.0f} KiB, zmniejszone {len(resized) / 1024:.0f} KiB, "
+          f"base64 {len(base64.b64encode(resized)) / 1024:.0f} KiB")
+
+    s3 = start_s3(args.s3_rtt, args.bandwidth)
+    openai_server = start_openai(args.model_time, args.fetch_rtt, args.bandwidth)
+    s3_base = f"http://127.0.0.1:{s3.server_address[1]}"
+    client = OpenAI(api_key="bench", base_url=f"http://127.0.0.1:{openai_server.server_address[1]}/v1",
+                    max_retries=0)
+    s3_session = requests.Session()
+    try:
+        # Rozgrzanie połączeń keep-alive
+        run_url(client, s3_base, s3_session, resized, -1)
+        run_inline(client, s3_base, s3_session, resized, -1)
+        measure("url", run_url, args.iterations, client, s3_base, s3_session, resized)
+        measure("inline", run_inline, args.iterations, client, s3_base, s3_session, resized)
+    finally:
+        s3.shutdown()
+        openai_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
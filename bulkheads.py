@@ -0,0 +1,226 @@
+# bulkheads.py
+"""
+Grodzie (bulkheads) dla endpointów: osobne limity współbieżności dla tras czekających na
+usługi zewnętrzne (OpenAI, Open Food Facts, Apple, Cognito) i dla szybkich tras CRUD.
+
+Wszystkie endpointy są synchroniczne i dzielą jedną pulę wątków anyio. Bez podziału
+wolne OpenAI zajmuje każdy wątek (i każde połączenie z puli bazy), a get_user_info czy
+edit_isAdded_true czekają w tej samej kolejce. BulkheadRoute wpuszcza żądanie do handlera
+(zależności + endpoint) dopiero po zajęciu miejsca w jego grodzi:
+
+  - size         - ile żądań klasy wykonuje się naraz (wątki i połączenia z bazą),
+  - queue_limit  - ile może czekać; kolejne dostają od razu 503 z Retry-After,
+  - queue_timeout - maksymalny czas oczekiwania w kolejce, potem 503.
+
+Pula wątków anyio ma rozmiar sumy grodzi (configure_thread_limiter), więc trasy jednej
+klasy nie mogą zabrać wątków drugiej. Trasę do grodzi 'external' przypisuje dekorator
+@bulkhead("external"); pozostałe synchroniczne trasy trafiają do 'db'.
+
+BulkheadRoute ustawia też termin żądania (deadlines.py) przed wejściem do kolejki grodzi
+i zamienia błędy 5xx po jego upływie na 504; w grodzi 'external' przerywa żądania, których
+klient się rozłączył.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import anyio
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+
+from config import BULKHEAD_EXTERNAL_SIZE, BULKHEAD_EXTERNAL_QUEUE, BULKHEAD_DB_SIZE, BULKHEAD_DB_QUEUE
+from config import BULKHEAD_QUEUE_TIMEOUT, REQUEST_DEADLINE, REQUEST_DEADLINE_EXTERNAL
+from config import DB_POOL_MAX_SIZE, DB_POOL_RESERVE, PHOTO_JOB_WORKERS
+import deadlines
+
+logger = logging.getLogger("server_logger")
+
+DEFAULT_BULKHEAD = "db"
+# Próbki czasu oczekiwania do percentyli w statystykach
+WAIT_SAMPLES = 1000
+
+
+class Bulkhead:
+    def __init__(self, name: str, size: int, queue_limit: int, queue_timeout: float):
+        self.name = name
+        self.size = size
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        # Semafor tworzony w pętli zdarzeń procesu (po forku workera uvicorna)
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = 0
+        self._completed = 0
+        self._rejected_full = 0
+        self._rejected_timeout = 0
+        self._deadline_exceeded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_samples = deque(maxlen=WAIT_SAMPLES)
+
+    def _reject(self, reason: str):
+        logger.warning("Gródź %s: odrzucono żądanie (%s).", self.name, reason)
+        raise HTTPException(status_code=503, detail="Serwer jest przeciążony, spróbuj ponownie.",
+                            headers={"Retry-After": "1"})
+
+    async def run(self, call):
+        """Wykonuje call() (korutynę) po zajęciu miejsca w grodzi."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        if self._semaphore.locked() and self._waiting >= self.queue_limit:
+            with self._lock:
+                self._rejected_full += 1
+            self._reject("kolejka pełna")
+
+        start = time.perf_counter()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), deadlines.budget(self.queue_timeout))
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._rejected_timeout += 1
+            self._reject("przekroczony czas w kolejce")
+        finally:
+            self._waiting -= 1
+
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._running += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            self._wait_samples.append(waited)
+        try:
+            return await call()
+        finally:
+            self._semaphore.release()
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    def count_deadline_exceeded(self):
+        with self._lock:
+            self._deadline_exceeded += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = sorted(self._wait_samples)
+            admitted = self._completed + self._running
+
+            def percentile(p):
+                return round(samples[min(int(p * len(samples)), len(samples) - 1)], 6) if samples else 0.0
+
+            return {
+                "size": self.size,
+                "queue_limit": self.queue_limit,
+                "running": self._running,
+                "waiting": self._waiting,
+                "completed": self._completed,
+                "rejected_queue_full": self._rejected_full,
+                "rejected_timeout": self._rejected_timeout,
+                "deadline_exceeded": self._deadline_exceeded,
+                "wait_time_avg": round(self._wait_total / admitted, 6) if admitted else 0.0,
+                "wait_time_p50": percentile(0.50),
+                "wait_time_p95": percentile(0.95),
+                "wait_time_p99": percentile(0.99),
+                "wait_time_max": round(self._wait_max, 6),
+            }
+
+
+_deadlines = {"external": REQUEST_DEADLINE_EXTERNAL, "db": REQUEST_DEADLINE}
+
+_bulkheads = {
+    "external": Bulkhead("external", BULKHEAD_EXTERNAL_SIZE, BULKHEAD_EXTERNAL_QUEUE, BULKHEAD_QUEUE_TIMEOUT),
+    "db": Bulkhead("db", BULKHEAD_DB_SIZE, BULKHEAD_DB_QUEUE, BULKHEAD_QUEUE_TIMEOUT),
+}
+
+
+def bulkhead(name: str):
+    """Dekorator endpointu: wykonuj trasę w grodzi name (domyślnie synchroniczne trasy -> 'db')."""
+    if name not in _bulkheads:
+        raise ValueError(f"Nieznana gródź: {name}")
+
+    def decorator(func):
+        func.bulkhead = name
+        return func
+    return decorator
+
+
+def get_bulkhead_stats() -> dict:
+    return {name: b.stats() for name, b in _bulkheads.items()}
+
+
+def _request_deadline(request, limit: float) -> float:
+    # Klient może skrócić termin do czasu, przez który faktycznie czeka na odpowiedź
+    try:
+        client_timeout = float(request.headers.get("x-request-timeout", ""))
+    except ValueError:
+        return limit
+    return min(limit, client_timeout) if client_timeout > 0 else limit
+
+
+def check_db_pool_size():
+    """Przy starcie: pula bazy mieści wszystkie grodzie, workery meal_jobs i zapas - inaczej błąd."""
+    required = {name: b.size for name, b in _bulkheads.items()}
+    required["meal_jobs"] = PHOTO_JOB_WORKERS
+    required["reserve"] = DB_POOL_RESERVE
+    if DB_POOL_MAX_SIZE < sum(required.values()):
+        raise RuntimeError(f"DB_POOL_MAX_SIZE={DB_POOL_MAX_SIZE} jest mniejsze niż suma połączeń "
+                           f"{sum(required.values())} ({required}) - zwiększ pulę albo zmniejsz grodzie.")
+
+
+def configure_thread_limiter():
+    """Pula wątków anyio = suma grodzi + zapas na zależności tras asynchronicznych (np. /events)."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = sum(b.size for b in _bulkheads.values()) + BULKHEAD_DB_SIZE // 4 + 1
+    logger.info("Pula wątków endpointów: %s (grodzie: %s).", limiter.total_tokens,
+                {name: b.size for name, b in _bulkheads.items()})
+
+
+class BulkheadRoute(APIRoute):
+    """Trasa wpuszczana do handlera (zależności i endpoint) przez gródź endpointu."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        name = getattr(self.endpoint, "bulkhead", None)
+        if name is None:
+            # Trasy asynchroniczne (strumienie, statystyki) nie zajmują wątków na czas odpowiedzi
+            if asyncio.iscoroutinefunction(self.endpoint):
+                return handler
+            name = DEFAULT_BULKHEAD
+        target = _bulkheads[name]
+        limit = _deadlines[name]
+
+        async def bulkhead_handler(request):
+            token = deadlines.start(_request_deadline(request, limit))
+            # Długie trasy przerywamy, gdy klient się rozłączy (deadlines.DisconnectWatch)
+            watch = deadlines.DisconnectWatch(request) if name == "external" else None
+            try:
+                response = await target.run(lambda: handler(watch.request if watch else request))
+                if deadlines.disconnected():
+                    deadlines.count("completed_after_disconnect")
+                return response
+            except Exception as e:
+                if deadlines.cancelled():
+                    deadlines.count("requests_cancelled")
+                    logger.info("Przerwano żądanie %s %s - klient się rozłączył (%r).",
+                                request.method, request.url.path, e)
+                    if isinstance(e, deadlines.RequestCancelled):
+                        raise
+                    raise deadlines.RequestCancelled() from e
+                server_error = not isinstance(e, HTTPException) or e.status_code >= 500
+                if server_error and deadlines.expired():
+                    # Błąd po terminie (timeout wywołania, anulowane zapytanie) - zawsze 504
+                    target.count_deadline_exceeded()
+                    logger.warning("Przekroczony termin żądania %s %s: %r", request.method, request.url.path, e)
+                    if isinstance(e, deadlines.DeadlineExceeded):
+                        raise
+                    raise deadlines.DeadlineExceeded() from e
+                raise
+            finally:
+                if watch is not None:
+                    watch.close()
+                deadlines.reset(token)
+        return bulkhead_handler
@@ -11,8 +11,10 @@ import json
 from config import (
     APPLE_KEY_ID,
     APPLE_ISSUER_ID,
-    APPLE_PRIVATE_KEY
+    APPLE_PRIVATE_KEY,
+    APPLE_TIMEOUT
 )
+import deadlines
 
 logger = logging.getLogger("server_logger")
 _cached_apple_jwt = None
@@ -58,14 +60,21 @@ def verify_apple_subscribe_active(receipt_data: str) -> bool:
     # Aby wrócić do produkcji, ustaw USE_SANDBOX=False lub usuń komentarz powyżej
 
     headers = {"Authorization": f"Bearer {token}"}
+    timeout = deadlines.budget(APPLE_TIMEOUT)
     try:
-        resp = httpx.get(url, headers=headers, timeout=10)
+        resp = httpx.get(url, headers=headers, timeout=timeout)
         resp.raise_for_status()
         data = resp.json()
         return data.get("status") in (0, 3, 4, 5)
     except httpx.HTTPStatusError as e:
         logger.error("Apple API error %s: %s", e.response.status_code, e.response.text)
         return False
+    except httpx.TimeoutException as e:
+        # Timeout skrócony terminem żądania to nie "brak subskrypcji"
+        if deadlines.expired():
+            raise deadlines.DeadlineExceeded() from e
+        logger.error("Network error: %s", e)
+        return False
     except Exception as e:
         logger.error("Network error: %s", e)
         return False
@@ -0,0 +1,106 @@
+# compare_goals.py
+"""
+Porównanie celów z OpenAI (historyczne wiersze Goal, source NULL/'openai') z goal_calculator.py.
+
+Dla każdego celu liczymy lokalny wynik z danych użytkownika (płeć, data urodzenia, wzrost,
+dieta) i ostatniej masy zapisanej przed startDate, a potem raportujemy różnice:
+
+    python compare_goals.py                 # podsumowanie
+    python compare_goals.py --csv goals.csv # plus wiersz po wierszu
+"""
+import argparse
+import csv
+import statistics
+import time
+
+import psycopg2
+
+from goal_calculator import calculate_goal
+
+FIELDS = (("kcal", "kcal"), ("protein", "proteins"), ("carbs", "carbs"), ("fats", "fats"))
+
+SELECT_SQL = """
+    SELECT g.ID, g.kcal, g.protein, g.carbs, g.fats, g.desiredWeight, g.lifestyle, g.startDate, g.endDate,
+           u.sex, u.birthDate, u.height, u.diet,
+           (SELECT w.weight FROM Weight w
+            WHERE w.User_ID = g.User_ID AND w.date <= g.startDate
+            ORDER BY w.date DESC, w.ID DESC LIMIT 1) AS weight
+    FROM Goal g
+    JOIN "User" u ON u.ID = g.User_ID
+    WHERE (g.source IS NULL OR g.source = 'openai') AND g.kcal > 0
+    ORDER BY g.ID
+"""
+
+
+def compare(rows):
+    """[(goal_id, {pole: (openai, lokalnie)})] oraz liczba celów, których nie da się policzyć lokalnie."""
+    compared, skipped = [], 0
+    for (goal_id, kcal, protein, carbs, fats, desired_weight, lifestyle, start_date, end_date,
+         sex, birth_date, height, diet, weight) in rows:
+        local = calculate_goal(sex, birth_date, height, weight, desired_weight, lifestyle, diet or "",
+                               start_date, end_date)
+        if local is None:
+            skipped += 1
+            continue
+        llm = {"kcal": kcal, "protein": protein, "carbs": carbs, "fats": fats}
+        compared.append((goal_id, {field: (llm[field], local[key]) for field, key in FIELDS}))
+    return compared, skipped
+
+
+def summarize(compared) -> dict:
+    summary = {}
+    for field, _ in FIELDS:
+        diffs = [local - llm for _, values in compared for llm, local in [values[field]]]
+        relative = [abs(local - llm) / llm for _, values in compared for llm, local in [values[field]] if llm]
+        summary[field] = {
+            "mean_diff": statistics.mean(diffs),
+            "mae": statistics.mean(abs(d) for d in diffs),
+            "median_abs_pct": statistics.median(relative) * 100 if relative else 0.0,
+            "within_10_pct": sum(r <= 0.10 for r in relative) / len(relative) * 100 if relative else 0.0,
+        }
+    return summary
+
+
+def _connect(dsn):
+    if dsn:
+        return psycopg2.connect(dsn)
+    from db import get_db_connection
+    return get_db_connection()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Porównanie celów z OpenAI z lokalnym kalkulatorem.")
+    parser.add_argument("--dsn", help="DSN Postgresa (domyślnie baza serwera z config)")
+    parser.add_argument("--csv", help="zapisz porównanie wiersz po wierszu do pliku CSV")
+    args = parser.parse_args()
+
+    conn = _connect(args.dsn)
+    cur = conn.cursor()
+    try:
+        cur.execute(SELECT_SQL)
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        conn.close()
+
+    start = time.perf_counter()
+    compared, skipped = compare(rows)
+    elapsed = time.perf_counter() - start
+    print(f"{len(compared)} celów porównanych, {skipped} bez wzrostu/daty urodzenia; "
+          f"obliczenia lokalne: {elapsed / max(len(rows), 1) * 1e6:.1f} µs na cel")
+    if not compared:
+        return
+    for field, stats in summarize(compared).items():
+        print(f"{field:8s} średnia różnica {stats['mean_diff']:+8.1f}  MAE {stats['mae']:7.1f}  "
+              f"mediana |Δ| {stats['median_abs_pct']:5.1f}%  w granicach 10%: {stats['within_10_pct']:5.1f}%")
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["goal_id"] + [f"{field}_{src}" for field, _ in FIELDS for src in ("openai", "local")])
+            for goal_id, values in compared:
+                writer.writerow([goal_id] + [v for field, _ in FIELDS for v in values[field]])
+
+
+if __name__ == "__main__":
+    main()
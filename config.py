@@ -1,4 +1,5 @@
 # config.py
+import os
 import json
 import boto3
 from botocore.exceptions import ClientError
@@ -33,21 +34,157 @@ DB_NAME = secrets_data.get("DB_NAME")
 DB_USER = secrets_data.get("DB_USER")
 DB_PASS = secrets_data.get("DB_PASS")
 
+# Pula połączeń z bazą (osobna w każdym procesie workera uvicorna); DB_POOL_MAX_SIZE - przy grodziach
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_MAX_IDLE_CHECK = float(os.getenv("DB_POOL_MAX_IDLE_CHECK", "30"))
+
+# Cache sub -> User.ID (w procesie)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
 # Konfiguracja S3
 AWS_ACCESS_KEY_ID = secrets_data.get("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = secrets_data.get("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = secrets_data.get("AWS_REGION")
 S3_BUCKET_NAME = secrets_data.get("S3_BUCKET_NAME")
+# Limit pojedynczej próby i liczba prób wywołania S3 (botocore)
+S3_TIMEOUT = float(os.getenv("S3_TIMEOUT", "5"))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
 
 # Konfiguracja Cognito
 COGNITO_REGION = secrets_data.get("COGNITO_REGION")
 USER_POOL_ID = secrets_data.get("USER_POOL_ID")
 COGNITO_APP_CLIENT_ID = secrets_data.get("COGNITO_APP_CLIENT_ID")
-JWKS_URL = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{USER_POOL_ID}/.well-known/jwks.json"
+COGNITO_ISSUER = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{USER_POOL_ID}"
+JWKS_URL = f"{COGNITO_ISSUER}/.well-known/jwks.json"
 
 # Konfiguracja Apple
-APPLE_JWKS_URL = "https://appleid.apple.com/auth/keys"
+APPLE_TOKEN_ISSUER = "https://appleid.apple.com"
+APPLE_JWKS_URL = f"{APPLE_TOKEN_ISSUER}/auth/keys"
 APPLE_CLIENT_ID = secrets_data.get("APPLE_CLIENT_ID")
+APPLE_TIMEOUT = float(os.getenv("APPLE_TIMEOUT", "10"))
+
+# Odświeżanie kluczy JWKS (Cognito i Apple)
+JWKS_TTL = float(os.getenv("JWKS_TTL", "3600"))
+JWKS_MIN_REFETCH_INTERVAL = float(os.getenv("JWKS_MIN_REFETCH_INTERVAL", "60"))
+
+# Cache zweryfikowanych tokenów (pomija weryfikację RS256 dla powtarzających się tokenów)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_MAX_TTL = float(os.getenv("TOKEN_CACHE_MAX_TTL", "3600"))
+TOKEN_NEGATIVE_CACHE_SIZE = int(os.getenv("TOKEN_NEGATIVE_CACHE_SIZE", "2000"))
+TOKEN_NEGATIVE_CACHE_TTL = float(os.getenv("TOKEN_NEGATIVE_CACHE_TTL", "30"))
+
+# Własne tokeny sesyjne (HS256) wydawane po weryfikacji tokena Cognito/Apple.
+# SESSION_SIGNING_KEYS: {"kid": "sekret", ...}; podpisujemy kluczem SESSION_ACTIVE_KID,
+# weryfikujemy każdym z listy - rotacja = dodanie nowego klucza, zmiana aktywnego,
+# usunięcie starego po SESSION_TOKEN_TTL.
+SESSION_SIGNING_KEYS = secrets_data.get("SESSION_SIGNING_KEYS") or {}
+if isinstance(SESSION_SIGNING_KEYS, str):
+    SESSION_SIGNING_KEYS = json.loads(SESSION_SIGNING_KEYS)
+SESSION_ACTIVE_KID = secrets_data.get("SESSION_ACTIVE_KID")
+SESSION_TOKEN_ISSUER = "foodio-session"
+SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", "3600"))
+# Jak długo worker ufa zapamiętanej wersji sesji użytkownika (opóźnienie unieważnienia)
+SESSION_VERSION_CACHE_TTL = float(os.getenv("SESSION_VERSION_CACHE_TTL", "60"))
+
+# Trasy statystyk (ops.py) wymagają nagłówka X-Ops-Token; bez tokena w sekretach są wyłączone (404)
+OPS_TOKEN = secrets_data.get("OPS_TOKEN")
+
+# Open Food Facts + cache produktów (tabela ProductCache i LRU w procesie)
+OFF_TIMEOUT = float(os.getenv("OFF_TIMEOUT", "5"))
+OFF_USER_AGENT = os.getenv("OFF_USER_AGENT", "Foodio/1.0 (foodio.example@gmail.com)")
+# online - tylko API OFF; local_first - najpierw lokalny indeks (OffProduct), potem API;
+# local_only - wyłącznie lokalny indeks, bez ruchu sieciowego do OFF
+OFF_LOOKUP_MODE = os.getenv("OFF_LOOKUP_MODE", "online")
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", str(7 * 24 * 3600)))
+PRODUCT_CACHE_NEGATIVE_TTL = float(os.getenv("PRODUCT_CACHE_NEGATIVE_TTL", str(24 * 3600)))
+PRODUCT_CACHE_STALE_TTL = float(os.getenv("PRODUCT_CACHE_STALE_TTL", str(30 * 24 * 3600)))
+PRODUCT_CACHE_LOCAL_SIZE = int(os.getenv("PRODUCT_CACHE_LOCAL_SIZE", "5000"))
+PRODUCT_CACHE_LOCAL_TTL = float(os.getenv("PRODUCT_CACHE_LOCAL_TTL", "3600"))
+
+# Cel dzienny: local - goal_calculator.py (OpenAI tylko, gdy brakuje danych), openai - zawsze new_goal
+GOAL_ENGINE = os.getenv("GOAL_ENGINE", "local")
+
+# Cache analiz meals_from_barcode_problems (tabela BarcodeAnalysisCache i LRU w procesie)
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", str(30 * 24 * 3600)))
+ANALYSIS_CACHE_LOCAL_SIZE = int(os.getenv("ANALYSIS_CACHE_LOCAL_SIZE", "20000"))
+ANALYSIS_CACHE_LOCAL_TTL = float(os.getenv("ANALYSIS_CACHE_LOCAL_TTL", "3600"))
+
+# Analiza zdjęć posiłków: sync - w żądaniu (jak dotąd), async - kolejka MealJob i pula workerów
+# (meal_jobs.py). Klient może też poprosić o tryb async nagłówkiem "Prefer: respond-async".
+PHOTO_ANALYSIS_MODE = os.getenv("PHOTO_ANALYSIS_MODE", "sync")
+PHOTO_JOB_WORKERS = int(os.getenv("PHOTO_JOB_WORKERS", "4"))
+PHOTO_JOB_POLL_INTERVAL = float(os.getenv("PHOTO_JOB_POLL_INTERVAL", "2"))
+PHOTO_JOB_MAX_ATTEMPTS = int(os.getenv("PHOTO_JOB_MAX_ATTEMPTS", "3"))
+PHOTO_JOB_LEASE = float(os.getenv("PHOTO_JOB_LEASE", "120"))
+
+# Zdarzenia w czasie rzeczywistym (/events, LISTEN/NOTIFY - events.py)
+EVENTS_CHANNEL = os.getenv("EVENTS_CHANNEL", "foodio_events")
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15"))
+
+# Etapy add_meal_from_photo / add_meal_from_barcode (pipeline.py): wątki wspólne dla wszystkich
+# żądań; kilka etapów na żądanie w grodzi 'external'
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "32"))
+
+# Termin obsługi żądania (deadlines.py), liczony od wejścia do trasy razem z kolejką grodzi.
+# Klient może go skrócić nagłówkiem X-Request-Timeout; po terminie trasa odpowiada 504.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "10"))
+REQUEST_DEADLINE_EXTERNAL = float(os.getenv("REQUEST_DEADLINE_EXTERNAL", "55"))
+# Poniżej tej reszty budżetu [s] nie zaczynamy kolejnego wywołania
+DEADLINE_MIN_BUDGET = float(os.getenv("DEADLINE_MIN_BUDGET", "0.05"))
+
+# Grodzie endpointów (bulkheads.py): trasy czekające na OpenAI/OFF/Apple/Cognito i szybkie trasy CRUD.
+BULKHEAD_EXTERNAL_SIZE = int(os.getenv("BULKHEAD_EXTERNAL_SIZE", "6"))
+BULKHEAD_EXTERNAL_QUEUE = int(os.getenv("BULKHEAD_EXTERNAL_QUEUE", "30"))
+BULKHEAD_DB_SIZE = int(os.getenv("BULKHEAD_DB_SIZE", "24"))
+BULKHEAD_DB_QUEUE = int(os.getenv("BULKHEAD_DB_QUEUE", "200"))
+BULKHEAD_QUEUE_TIMEOUT = float(os.getenv("BULKHEAD_QUEUE_TIMEOUT", "10"))
+# Każde żądanie w grodzi i każdy worker meal_jobs może trzymać połączenie z bazą naraz, a
+# DB_POOL_RESERVE to zapas na resztę (/events, odświeżanie cache OFF). Pula musi pomieścić
+# sumę - domyślnie dokładnie tyle; mniejsze DB_POOL_MAX_SIZE zatrzymuje start aplikacji
+# (bulkheads.check_db_pool_size), bo wolne OpenAI zabrałoby połączenia trasom 'db'.
+DB_POOL_RESERVE = int(os.getenv("DB_POOL_RESERVE", "2"))
+DB_POOL_REQUIRED = BULKHEAD_EXTERNAL_SIZE + BULKHEAD_DB_SIZE + PHOTO_JOB_WORKERS + DB_POOL_RESERVE
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", str(DB_POOL_REQUIRED)))
+
+# Bramka OpenAI (openai_gateway.py). Limity RPM/TPM dotyczą jednego procesu - przy kilku
+# workerach uvicorna ustawić limit konta podzielony przez liczbę procesów.
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "20"))
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "45"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+# {"model": limit}; modele spoza listy - OPENAI_MAX_CONCURRENCY
+OPENAI_MODEL_CONCURRENCY = json.loads(os.getenv("OPENAI_MODEL_CONCURRENCY", "{}"))
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "200000"))
+OPENAI_BREAKER_THRESHOLD = int(os.getenv("OPENAI_BREAKER_THRESHOLD", "5"))
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+# Zabezpieczanie (hedging) analizy zdjęć: druga próba po percentylu ostatnich czasów,
+# najwyżej dla OPENAI_HEDGE_MAX_RATE wywołań
+OPENAI_HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_ENABLED", "false").lower() == "true"
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "0.95"))
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "1"))
+OPENAI_HEDGE_MAX_RATE = float(os.getenv("OPENAI_HEDGE_MAX_RATE", "0.1"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+# Zdjęcie do analizy: inline - base64 w treści zapytania, url - presigned URL z S3 (OpenAI pobiera je sam)
+OPENAI_IMAGE_MODE = os.getenv("OPENAI_IMAGE_MODE", "inline")
+# Przygotowanie zdjęć (images.py): procesy puli w każdym workerze uvicorna (0 - w wątku żądania),
+# format JPEG albo WEBP, jakość startowa i limit rozmiaru wyniku w bajtach
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", "150000"))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "10"))
+# Przesyłane zdjęcia (uploads.py): limit pliku, limit pikseli z nagłówka (bomba dekompresyjna),
+# ile trzymamy w pamięci przed zapisem na dysk, kawałek odczytu i część multipart S3 (min. 5 MiB)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", "60000000"))
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(256 * 1024)))
+UPLOAD_MULTIPART_BYTES = int(os.getenv("UPLOAD_MULTIPART_BYTES", str(8 * 1024 * 1024)))
 
 
 APPLE_KEY_ID = secrets_data.get("APPLE_KEY_ID")
@@ -1,12 +1,30 @@
+import os
+import threading
+import time
+from collections import deque
+
 import psycopg2
+import psycopg2.extensions
 from datetime import datetime, date, timedelta
 import logging
 from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS
+from config import DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME, DB_POOL_MAX_IDLE_CHECK
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, APPLE_TOKEN_ISSUER
+from cache import TTLCache
+import deadlines
 
 logger = logging.getLogger("server_logger")
 
 
-def get_db_connection():
+class PoolTimeoutError(Exception):
+    """Nie udało się pobrać połączenia z puli w zadanym czasie."""
+
+
+class UserSubConflictError(Exception):
+    """Konto z tym adresem email jest już dowiązane do innego sub."""
+
+
+def _connect():
     return psycopg2.connect(
         host=DB_HOST,
         port=DB_PORT,
@@ -16,6 +34,270 @@ def get_db_connection():
     )
 
 
+class PooledConnection:
+    """
+    Połączenie psycopg2 wypożyczone z puli. Wszystkie atrybuty są delegowane do
+    oryginalnego połączenia, a close() zwraca je do puli zamiast zamykać gniazdo,
+    dzięki czemu istniejący kod (conn.commit() / conn.close()) działa bez zmian.
+    """
+
+    def __init__(self, pool, raw, created_at):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_created_at", created_at)
+
+    def __getattr__(self, name):
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return getattr(raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def __enter__(self):
+        return self._raw.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._raw.__exit__(exc_type, exc, tb)
+
+    @property
+    def closed(self):
+        raw = object.__getattribute__(self, "_raw")
+        return 1 if raw is None else raw.closed
+
+    def close(self):
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            return
+        object.__setattr__(self, "_raw", None)
+        self._pool.putconn(raw, self._created_at)
+
+
+class ConnectionPool:
+    """
+    Ograniczona pula połączeń do PostgreSQL, bezpieczna wątkowo.
+
+    - min_size połączeń otwieranych od razu, maksymalnie max_size jednocześnie,
+    - health-check przy wypożyczeniu (SELECT 1, jeśli połączenie leżało dłużej niż max_idle_check s),
+    - połączenia starsze niż max_lifetime s są zamykane i otwierane na nowo,
+    - gdy pula jest pełna, czekamy maksymalnie timeout s (nie dłużej niż do terminu żądania),
+      potem PoolTimeoutError.
+    """
+
+    def __init__(self, min_size, max_size, timeout, max_lifetime, max_idle_check, connect=_connect):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError("Nieprawidłowy rozmiar puli: min=%s, max=%s" % (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle_check = max_idle_check
+        self._connect = connect
+        self._cond = threading.Condition()
+        # (połączenie, czas utworzenia, czas ostatniego zwrotu)
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        for _ in range(min_size):
+            raw = self._connect()
+            now = time.monotonic()
+            self._idle.append((raw, now, now))
+            self._size += 1
+            self._created += 1
+
+    def _expired(self, created_at, now):
+        return self.max_lifetime > 0 and now - created_at >= self.max_lifetime
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def _healthy(self, raw, last_used, now):
+        if raw.closed:
+            return False
+        if now - last_used < self.max_idle_check:
+            return True
+        try:
+            with raw.cursor() as cur:
+                cur.execute("SELECT 1")
+            raw.rollback()
+            return True
+        except Exception as e:
+            logger.warning("Połączenie z puli nie przeszło health-checku: %s", e)
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + deadlines.budget(self.timeout)
+        while True:
+            raw = None
+            created_at = None
+            open_new = False
+            with self._cond:
+                if self._closed:
+                    raise psycopg2.InterfaceError("connection pool is closed")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        logger.error("Brak wolnych połączeń w puli po %.2f s (rozmiar: %s)",
+                                     self.timeout, self.max_size)
+                        raise PoolTimeoutError("Brak wolnego połączenia z bazą danych.")
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    # LIFO - najcieplejsze połączenie, zimne same się zestarzeją
+                    raw, created_at, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    open_new = True
+                self._in_use += 1
+
+            now = time.monotonic()
+            if open_new:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+                created_at = now
+                with self._cond:
+                    self._created += 1
+            elif self._expired(created_at, now) or not self._healthy(raw, last_used, now):
+                with self._cond:
+                    self._in_use -= 1
+                self._discard(raw)
+                continue
+
+            waited = time.monotonic() - start
+            with self._cond:
+                self._checkouts += 1
+                self._wait_total += waited
+                if waited > self._wait_max:
+                    self._wait_max = waited
+            return PooledConnection(self, raw, created_at)
+
+    def putconn(self, raw, created_at):
+        with self._cond:
+            self._in_use -= 1
+        keep = not self._closed and not raw.closed and not self._expired(created_at, time.monotonic())
+        if keep and raw.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Niezatwierdzona transakcja nie może przejść do kolejnego żądania
+            try:
+                raw.rollback()
+            except Exception:
+                keep = False
+        if not keep:
+            self._discard(raw)
+            return
+        with self._cond:
+            self._idle.append((raw, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for raw, _, _ in idle:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "connections_created": self._created,
+                "connections_discarded": self._discarded,
+                "wait_time_total": round(self._wait_total, 6),
+                "wait_time_avg": round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+                "wait_time_max": round(self._wait_max, 6),
+            }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Po forku (workery uvicorna) nie współdzielimy gniazd z procesem rodzica
+            _pool = ConnectionPool(
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_POOL_TIMEOUT,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                max_idle_check=DB_POOL_MAX_IDLE_CHECK
+            )
+            _pool_pid = pid
+            logger.info("Utworzono pulę połączeń (min: %s, max: %s) w procesie %s",
+                        DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, pid)
+    return _pool
+
+
+def get_db_connection():
+    return get_pool().getconn()
+
+
+def get_pool_stats() -> dict:
+    if _pool is None or _pool_pid != os.getpid():
+        return {"pid": os.getpid(), "initialized": False}
+    stats = _pool.stats()
+    stats["pid"] = os.getpid()
+    stats["initialized"] = True
+    return stats
+
+
+def close_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+            logger.info("Zamknięto pulę połączeń z bazą danych.")
+        _pool = None
+        _pool_pid = None
+
+
 def create_database_if_not_exists():
     try:
         logger.info("Sprawdzanie istnienia bazy danych: %s", DB_NAME)
@@ -61,9 +343,12 @@ def initialize_schema():
                 desiredWeight numeric(3,1) NOT NULL,
                 lifestyle varchar(50) NOT NULL,
                 startDate date NOT NULL,
-                endDate date NOT NULL
+                endDate date NOT NULL,
+                source varchar(10) NULL
             );
         """)
+        # Migracja - skąd pochodzi cel (local / openai); NULL = starsze cele z OpenAI
+        cur.execute("ALTER TABLE Goal ADD COLUMN IF NOT EXISTS source varchar(10) NULL;")
 
         # Tabela Warning z autoinkrementacją
         cur.execute("""
@@ -129,16 +414,26 @@ def initialize_schema():
         cur.execute("""
             CREATE TABLE IF NOT EXISTS "User" (
                 ID int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-                email varchar(255) NOT NULL,
+                email varchar(255) NULL,
                 password varchar(255) NULL,
                 sex char(1) NULL,
                 birthDate date NULL,
                 height int NULL,
                 diet varchar(70) NULL,
                 dateOfJoin date NOT NULL,
-                language varchar(30) NULL
+                language varchar(30) NULL,
+                cognito_sub varchar(255) NULL,
+                apple_sub varchar(255) NULL,
+                session_version int NOT NULL DEFAULT 0
             );
         """)
+        # Migracja istniejących baz - identyfikator użytkownika z tokena (sub)
+        cur.execute('ALTER TABLE "User" ADD COLUMN IF NOT EXISTS cognito_sub varchar(255) NULL;')
+        cur.execute('ALTER TABLE "User" ADD COLUMN IF NOT EXISTS apple_sub varchar(255) NULL;')
+        cur.execute('ALTER TABLE "User" ADD COLUMN IF NOT EXISTS session_version int NOT NULL DEFAULT 0;')
+        # Migracja - konta bez adresu email (token Apple bez email) mają NULL, nie wspólne ''
+        cur.execute('ALTER TABLE "User" ALTER COLUMN email DROP NOT NULL;')
+        cur.execute('UPDATE "User" SET email = NULL WHERE email = \'\';')
 
         # Tabela Weight z autoinkrementacją
         cur.execute("""
@@ -150,6 +445,93 @@ def initialize_schema():
             );
         """)
 
+        # Cache produktów z Open Food Facts (found = FALSE - kod nieznany w OFF)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ProductCache (
+                barcode varchar(100) PRIMARY KEY,
+                found boolean NOT NULL,
+                data jsonb NULL,
+                fetched_at timestamp NOT NULL
+            );
+        """)
+
+        # Produkty wspólne dla wszystkich użytkowników (Meal.bar_code -> Product.barcode)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS Product (
+                barcode varchar(100) PRIMARY KEY,
+                name varchar(255) NOT NULL,
+                kcal int NOT NULL,
+                proteins int NOT NULL,
+                carbs int NOT NULL,
+                fats int NOT NULL,
+                ingredients text NOT NULL,
+                img_link varchar(255) NULL,
+                off_image_url text NULL,
+                created_at timestamp NOT NULL,
+                nutriments jsonb NULL,
+                allergens_tags text[] NULL,
+                traces_tags text[] NULL,
+                ingredients_analysis_tags text[] NULL,
+                nutriscore_grade varchar(10) NULL
+            );
+        """)
+        # Migracja - dane OFF potrzebne regułom z diet_rules.py
+        cur.execute("ALTER TABLE Product ADD COLUMN IF NOT EXISTS nutriments jsonb NULL;")
+        cur.execute("ALTER TABLE Product ADD COLUMN IF NOT EXISTS allergens_tags text[] NULL;")
+        cur.execute("ALTER TABLE Product ADD COLUMN IF NOT EXISTS traces_tags text[] NULL;")
+        cur.execute("ALTER TABLE Product ADD COLUMN IF NOT EXISTS ingredients_analysis_tags text[] NULL;")
+        cur.execute("ALTER TABLE Product ADD COLUMN IF NOT EXISTS nutriscore_grade varchar(10) NULL;")
+        # Migracja - img_link tylko ze zdjęcia OFF; wcześniej bez niego trafiało tu zdjęcie pierwszego
+        # skanującego (widoczne dla wszystkich), a OFF go nie ma, gdy off_image_url nie jest adresem
+        cur.execute("ALTER TABLE Product ALTER COLUMN img_link DROP NOT NULL;")
+        cur.execute("UPDATE Product SET img_link = NULL WHERE off_image_url IS NULL OR off_image_url NOT LIKE 'http%';")
+
+        # Wyniki meals_from_barcode_problems; klucz to skrót znormalizowanych wejść (analysis_cache.py)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS BarcodeAnalysisCache (
+                key char(64) PRIMARY KEY,
+                result jsonb NOT NULL,
+                created_at timestamp NOT NULL
+            );
+        """)
+
+        # Lokalny indeks Open Food Facts ładowany z eksportu (off_dump_loader.py)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS OffProduct (
+                barcode varchar(100) PRIMARY KEY,
+                data jsonb NOT NULL,
+                last_modified_t bigint NOT NULL DEFAULT 0
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS OffImport (
+                ID int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                source text NOT NULL,
+                kind char(1) NOT NULL,
+                up_to_t bigint NOT NULL,
+                rows int NOT NULL,
+                imported_at timestamp NOT NULL
+            );
+        """)
+
+        # Kolejka analiz zdjęć posiłków (meal_jobs.py): pending -> running -> done / failed
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS MealJob (
+                ID int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                Meal_ID int NOT NULL,
+                User_ID int NOT NULL,
+                img_link varchar(255) NOT NULL,
+                status varchar(10) NOT NULL,
+                attempts int NOT NULL DEFAULT 0,
+                error text NULL,
+                created_at timestamp NOT NULL,
+                started_at timestamp NULL,
+                finished_at timestamp NULL,
+                locked_until timestamp NULL
+            );
+        """)
+        cur.execute("ALTER TABLE MealJob ADD COLUMN IF NOT EXISTS priority smallint NOT NULL DEFAULT 0;")
+
         # Dodawanie ograniczeń kluczy obcych
         alter_commands = [
             """ALTER TABLE Goal ADD CONSTRAINT Goal_User
@@ -186,25 +568,49 @@ def initialize_schema():
                 FOREIGN KEY (Meal_ID)
                 REFERENCES Meal (ID)
                 NOT DEFERRABLE
+                INITIALLY IMMEDIATE;""",
+            # NOT VALID - starsze posiłki z kodem kreskowym nie mają wiersza w Product
+            """ALTER TABLE Meal ADD CONSTRAINT Meal_Product
+                FOREIGN KEY (bar_code)
+                REFERENCES Product (barcode)
+                NOT DEFERRABLE
+                INITIALLY IMMEDIATE
+                NOT VALID;""",
+            """ALTER TABLE MealJob ADD CONSTRAINT MealJob_Meal
+                FOREIGN KEY (Meal_ID)
+                REFERENCES Meal (ID)
+                ON DELETE CASCADE
+                NOT DEFERRABLE
                 INITIALLY IMMEDIATE;"""
         ]
         for cmd in alter_commands:
+            # Savepoint - istniejące ograniczenie nie może przerwać całej transakcji (i migracji)
+            cur.execute("SAVEPOINT add_constraint;")
             try:
                 cur.execute(cmd)
+                cur.execute("RELEASE SAVEPOINT add_constraint;")
             except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT add_constraint;")
                 logger.warning("Błąd przy dodawaniu ograniczenia: %s", e)
 
         # Dodanie indeksów
         cur.execute("CREATE INDEX IF NOT EXISTS idx_goal_user ON Goal (User_ID);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_meal_user ON Meal (User_ID);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_meal_date ON Meal (date);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_meal_bar_code ON Meal (bar_code);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_openai_user ON OpenAI_request (User_ID);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_openai_date ON OpenAI_request (date);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_problem_user ON Problem (User_ID);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_subscription_user ON Subscription (User_ID);")
         cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_email ON \"User\" (email);")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_cognito_sub ON \"User\" (cognito_sub);")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_apple_sub ON \"User\" (apple_sub);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_weight_user ON Weight (User_ID);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_weight_date ON Weight (date);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_mealjob_meal ON MealJob (Meal_ID);")
+        cur.execute("DROP INDEX IF EXISTS idx_mealjob_queue;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_mealjob_queue_priority ON MealJob (priority, ID) "
+                    "WHERE status IN ('pending', 'running');")
 
         conn.commit()
         logger.info("Schemat bazy danych został pomyślnie zainicjowany i jest gotowy do użytku.")
@@ -216,28 +622,81 @@ def initialize_schema():
         conn.close()
 
 
-def get_or_create_user_by_sub(sub: str, email: str) -> int:
+_user_id_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def _sub_column(issuer) -> str:
+    return "apple_sub" if issuer == APPLE_TOKEN_ISSUER else "cognito_sub"
+
+
+def get_or_create_user_by_sub(sub: str, email: str, cur=None, issuer: str = None, on_commit=None) -> int:
     """
-    W nowym schemacie kolumna 'cognito_sub' nie występuje, dlatego identyfikacja użytkownika odbywa się wyłącznie na podstawie adresu email.
-    Jeśli użytkownik nie istnieje, wstawiamy rekord z automatycznie generowanym ID.
+    Zwraca User.ID dla danego 'sub' z tokena (cognito_sub lub apple_sub, zależnie od issuer).
+    Najpierw sprawdzany jest cache w procesie; przy chybieniu jedno zapytanie
+    (SELECT po sub albo INSERT ... ON CONFLICT (email)) znajduje, tworzy lub dowiązuje
+    sub do istniejącego konta z tym samym adresem email - tylko gdy konto nie ma jeszcze sub
+    tego dostawcy; konto z innym sub to UserSubConflictError. Pusty email nie łączy kont.
+    Jeśli podano kursor, zapytania idą w transakcji wywołującego (bez commitu); nowo
+    utworzone lub dowiązane konto trafia wtedy do cache dopiero po commit - przez
+    on_commit(callback) (DBSession.after_commit), a bez on_commit wcale. Po rollbacku
+    cache nie może wskazywać na wiersz, którego nie ma.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute('SELECT ID FROM "User" WHERE email = %s', (email,))
-        row = cur.fetchone()
-        if row:
-            user_id = row[0]
-            logger.info("Znaleziono istniejącego użytkownika o email: %s", email)
-        else:
-            cur.execute(
-                'INSERT INTO "User"(email) VALUES (%s) RETURNING ID',
-                (email,)
-            )
-            user_id = cur.fetchone()[0]
-            conn.commit()
-            logger.info("Utworzono nowego użytkownika o email: %s, przy ID: %s", email, user_id)
+    column = _sub_column(issuer)
+    key = (column, sub)
+    user_id = _user_id_cache.get(key)
+    if user_id is not None:
         return user_id
-    finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
+
+    if cur is not None:
+        user_id, found = _get_or_create_user(cur, column, sub, email)
+        if not found:
+            if on_commit is not None:
+                on_commit(lambda: _user_id_cache.set(key, user_id))
+            return user_id
+    else:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            user_id, _ = _get_or_create_user(cur, column, sub, email)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+    _user_id_cache.set(key, user_id)
+    return user_id
+
+
+def _get_or_create_user(cur, column: str, sub: str, email: str):
+    """(User.ID, found) - found: konto istniało już z tym sub (nic nie zapisano)."""
+    # column pochodzi wyłącznie z _sub_column, więc wstawienie do SQL jest bezpieczne.
+    # Pusty email zapisujemy jako NULL - indeks unikalny go nie porównuje, więc powstaje osobne konto
+    cur.execute(f"""
+        WITH found AS (
+            SELECT ID FROM "User" WHERE {column} = %(sub)s
+        ), created AS (
+            INSERT INTO "User"(email, {column}, dateOfJoin)
+            SELECT %(email)s, %(sub)s, %(today)s
+            WHERE NOT EXISTS (SELECT 1 FROM found)
+            ON CONFLICT (email) DO UPDATE SET {column} = EXCLUDED.{column} WHERE "User".{column} IS NULL
+            RETURNING ID, (xmax = 0) AS inserted
+        )
+        SELECT ID, FALSE, TRUE FROM found
+        UNION ALL
+        SELECT ID, inserted, FALSE FROM created
+    """, {"sub": sub, "email": email or None, "today": date.today()})
+    row = cur.fetchone()
+    if row is None:
+        # Konflikt email, a konto ma już inny sub - nie przepinamy go na nowe logowanie
+        logger.warning("Konto o email: %s jest już powiązane z innym %s.", email, column)
+        raise UserSubConflictError(email)
+    user_id, inserted, found = row
+    if inserted:
+        logger.info("Utworzono nowego użytkownika o email: %s, przy ID: %s", email, user_id)
+    elif not found:
+        logger.info("Dowiązano %s do użytkownika o email: %s, ID: %s", column, email, user_id)
+    return user_id, found
+
+
+def forget_user_sub(sub: str, issuer: str = None):
+    """Usuwa wpis z cache sub -> User.ID (np. po usunięciu konta)."""
+    _user_id_cache.pop((_sub_column(issuer), sub))
@@ -0,0 +1,127 @@
+# db_session.py
+import logging
+
+from fastapi import Depends, HTTPException
+
+from auth import get_current_user
+import deadlines
+from db import get_db_connection, get_or_create_user_by_sub, UserSubConflictError
+from session_tokens import is_session_token, check_session_token
+
+logger = logging.getLogger("server_logger")
+
+
+class DBSession:
+    """
+    Jedno połączenie z puli i jedna transakcja na całe żądanie HTTP.
+    Handler wywołuje commit() raz, tuż przed zwróceniem odpowiedzi; przy wyjątku
+    zależność robi rollback, a połączenie wraca do puli.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.current_user = None
+        self.user_id = None
+        self._after_commit = []
+        left = deadlines.remaining()
+        if left is not None:
+            # Żadne zapytanie transakcji nie trwa dłużej niż reszta terminu żądania
+            # (SET LOCAL - po commit/rollback połączenie wraca do puli bez limitu)
+            self.cur.execute("SELECT set_config('statement_timeout', %s, true)",
+                             (f"{max(int(left * 1000), 1)}ms",))
+
+    @property
+    def sub(self):
+        return self.current_user["sub"] if self.current_user else None
+
+    @property
+    def issuer(self):
+        # Dla tokenów sesyjnych - wystawca oryginalnego tokena (Cognito/Apple)
+        if not self.current_user:
+            return None
+        return self.current_user.get("idp") or self.current_user.get("iss")
+
+    @property
+    def email(self):
+        return self.current_user.get("email", "") if self.current_user else ""
+
+    def after_commit(self, callback):
+        """callback() po udanym commit() transakcji żądania; rollback je porzuca."""
+        self._after_commit.append(callback)
+
+    def commit(self):
+        self.conn.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self._after_commit = []
+        self.conn.rollback()
+
+    def close(self):
+        try:
+            self.cur.close()
+        except Exception:
+            pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+def get_db():
+    """Zależność FastAPI: połączenie/transakcja bez uwierzytelnienia (np. /register)."""
+    session = DBSession(get_db_connection())
+    try:
+        yield session
+        # Kod po yield wykonuje się już po wysłaniu odpowiedzi - handlery zapisujące
+        # dane robią commit() samodzielnie, tu zatwierdzamy ewentualne resztki.
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def get_db_session(
+        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db)
+) -> DBSession:
+    """Zależność FastAPI: transakcja żądania z ustalonym wewnętrznym user_id (na tym samym połączeniu)."""
+    session.current_user = current_user
+    session.user_id = _resolve_user_id(session, current_user)
+    return session
+
+
+def get_current_user_id(current_user: dict = Depends(get_current_user)) -> int:
+    """
+    Zależność FastAPI dla długich połączeń (strumień /events): ustala user_id na chwilę
+    pożyczonym połączeniu, żeby nie trzymać go z puli przez cały czas trwania odpowiedzi.
+    """
+    session = DBSession(get_db_connection())
+    try:
+        user_id = _resolve_user_id(session, current_user)
+        session.commit()
+        return user_id
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _resolve_user_id(session: DBSession, current_user: dict) -> int:
+    if is_session_token(current_user):
+        # Token sesyjny niesie już user_id - sprawdzamy tylko, czy nie został unieważniony
+        check_session_token(session.cur, current_user)
+        return current_user["uid"]
+    try:
+        return get_or_create_user_by_sub(
+            current_user["sub"], current_user.get("email", ""), cur=session.cur, issuer=current_user.get("iss"),
+            on_commit=session.after_commit
+        )
+    except UserSubConflictError:
+        raise HTTPException(status_code=409, detail="Konto z tym adresem email jest powiązane z innym logowaniem.")
@@ -0,0 +1,226 @@
+# deadlines.py
+"""
+Termin (deadline) i anulowanie żądania HTTP, przekazywane do wywołań zewnętrznych.
+
+BulkheadRoute ustawia termin na początku obsługi trasy, razem z czasem w kolejce grodzi:
+REQUEST_DEADLINE, dla grodzi 'external' REQUEST_DEADLINE_EXTERNAL. Klient może go skrócić
+nagłówkiem X-Request-Timeout (tyle sekund faktycznie czeka). Termin siedzi w zmiennej
+kontekstowej, więc widzą go zależności i endpointy w wątkach anyio oraz etapy z pipeline.py;
+workery meal_jobs i odświeżanie cache działają bez terminu. Wywołania biorą resztę budżetu:
+
+  - Open Food Facts, Apple - timeout żądania HTTP = budget(własny limit),
+  - OpenAI - termin bramki (openai_gateway) nie później niż termin żądania,
+  - S3 - sprawdzenie terminu przed wywołaniem (botocore nie przyjmuje timeoutu dla
+    pojedynczego wywołania; próbę ogranicza S3_TIMEOUT),
+  - baza - oczekiwanie na połączenie z puli i statement_timeout transakcji żądania.
+
+Po terminie trasa odpowiada 504, także gdy endpoint zamienił błąd wywołania (timeout,
+anulowane zapytanie) na własny 5xx.
+
+Rozłączenie klienta (aplikacja w tle w trakcie analizy) trasy 'external' wykrywa
+DisconnectWatch: po odczytaniu treści żądania czeka na http.disconnect. Od tej chwili
+check()/budget() rzucają RequestCancelled, więc nie startują kolejne etapy, wywołania S3
+ani OpenAI, a trwające zapytanie do OpenAI jest przerywane (on_cancel). Handler, który woli
+dokończyć pracę (tryb kolejki zdjęć), wywołuje keep_on_disconnect() i sam sprawdza
+disconnected(). Liczniki oszczędzonej pracy - get_cancellation_stats() (/cancellation_stats).
+"""
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from config import DEADLINE_MIN_BUDGET
+
+_scope = ContextVar("request_scope", default=None)
+_stats_lock = threading.Lock()
+_stats = {
+    "disconnected": 0,
+    "disconnected_during_upload": 0,
+    "requests_cancelled": 0,
+    "completed_after_disconnect": 0,
+    "stages_skipped": 0,
+    "s3_calls_skipped": 0,
+    "openai_calls_skipped": 0,
+    "openai_calls_cancelled": 0,
+    "jobs_downgraded": 0,
+    "seconds_after_disconnect": 0.0,
+}
+
+
+class DeadlineExceeded(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=504, detail="Przekroczono czas obsługi żądania.")
+
+
+class RequestCancelled(HTTPException):
+    # 499 (jak w nginx) - odpowiedź i tak nie dotrze do klienta
+    def __init__(self):
+        super().__init__(status_code=499, detail="Klient zamknął połączenie.")
+
+
+class _Scope:
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.cancel_on_disconnect = True
+        self.disconnected_at = None
+        self._disconnected = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def disconnect(self):
+        with self._lock:
+            if self._disconnected.is_set():
+                return
+            self.disconnected_at = time.monotonic()
+            self._disconnected.set()
+            callbacks = list(self._callbacks) if self.cancel_on_disconnect else []
+        for callback in callbacks:
+            callback()
+
+
+def count(key: str, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def get_cancellation_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["seconds_after_disconnect"] = round(stats["seconds_after_disconnect"], 3)
+    return stats
+
+
+def start(seconds: float):
+    """Ustawia termin żądania za seconds sekund; zwraca token dla reset()."""
+    return _scope.set(_Scope(time.monotonic() + seconds))
+
+
+def reset(token):
+    _scope.reset(token)
+
+
+def remaining():
+    """Sekundy do terminu żądania albo None poza żądaniem."""
+    scope = _scope.get()
+    return None if scope is None else scope.deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= DEADLINE_MIN_BUDGET
+
+
+def disconnected() -> bool:
+    scope = _scope.get()
+    return scope is not None and scope._disconnected.is_set()
+
+
+def cancelled() -> bool:
+    """Klient się rozłączył, a handler nie poprosił o dokończenie pracy."""
+    scope = _scope.get()
+    return scope is not None and scope.cancel_on_disconnect and scope._disconnected.is_set()
+
+
+def cancellable() -> bool:
+    return _scope.get() is not None
+
+
+def keep_on_disconnect():
+    """Dokończ żądanie mimo rozłączenia klienta (handler sprawdza disconnected() sam)."""
+    scope = _scope.get()
+    if scope is not None:
+        scope.cancel_on_disconnect = False
+
+
+def check():
+    if cancelled():
+        raise RequestCancelled()
+    if expired():
+        raise DeadlineExceeded()
+
+
+def budget(limit: float) -> float:
+    """Timeout wywołania: limit, ale nie dłużej niż do terminu żądania."""
+    check()
+    left = remaining()
+    return limit if left is None else min(limit, left)
+
+
+def clamp(deadline: float) -> float:
+    """Termin w skali time.monotonic() nie późniejszy niż termin żądania."""
+    scope = _scope.get()
+    return deadline if scope is None else min(deadline, scope.deadline)
+
+
+@contextmanager
+def on_cancel(callback):
+    """callback() zostanie wywołane (z pętli zdarzeń), jeśli klient rozłączy się w trakcie bloku."""
+    scope = _scope.get()
+    if scope is None:
+        yield
+        return
+    with scope._lock:
+        scope._callbacks.append(callback)
+    try:
+        if cancelled():
+            callback()
+        yield
+    finally:
+        with scope._lock:
+            scope._callbacks.remove(callback)
+
+
+def check_boto_call(**kwargs):
+    """Hook botocore 'before-call': nie zaczynaj wywołania AWS po terminie ani po rozłączeniu."""
+    model = kwargs.get("model")
+    if model is not None and model.name == "AbortMultipartUpload":
+        # Sprzątanie przerwanego multipart (uploads.py) musi dojść do S3
+        return
+    if cancelled():
+        count("s3_calls_skipped")
+    check()
+
+
+class DisconnectWatch:
+    """
+    Żądanie z podmienionym receive: po odczytaniu całej treści (formularz, zdjęcie) zadanie
+    w tle czeka na http.disconnect i oznacza zakres żądania jako rozłączony. Wcześniej nie
+    czytamy z receive, żeby nie zabrać handlerowi fragmentów treści.
+    """
+
+    def __init__(self, request: Request):
+        self._receive = request.receive
+        self._body_done = asyncio.Event()
+        self._scope = _scope.get()
+        self.request = Request(request.scope, receive=self._receive_message)
+        self._task = asyncio.create_task(self._watch())
+
+    async def _receive_message(self):
+        message = await self._receive()
+        if message["type"] == "http.disconnect":
+            count("disconnected_during_upload")
+            self._mark()
+        elif not message.get("more_body", False):
+            self._body_done.set()
+        return message
+
+    async def _watch(self):
+        await self._body_done.wait()
+        message = await self._receive()
+        if message["type"] == "http.disconnect":
+            self._mark()
+
+    def _mark(self):
+        if self._scope is not None and self._scope.disconnected_at is None:
+            count("disconnected")
+            self._scope.disconnect()
+
+    def close(self):
+        # Przed wysłaniem odpowiedzi - potem serwer też zgłasza http.disconnect
+        self._task.cancel()
+        if self._scope is not None and self._scope.disconnected_at is not None:
+            count("seconds_after_disconnect", time.monotonic() - self._scope.disconnected_at)
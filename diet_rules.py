@@ -0,0 +1,433 @@
+# diet_rules.py
+"""
+Deterministyczne wykrywanie konfliktów produktu z dietą i problemami użytkownika.
+
+Dane z Open Food Facts (allergens_tags, traces_tags, ingredients_analysis_tags, wartości
+odżywcze) są porównywane z wpisami Problem i dietą użytkownika. Wielojęzyczny słownik
+synonimów jest skompilowany do jednego automatu Aho-Corasicka, którym przeszukujemy
+zarówno tekst problemów użytkownika, jak i skład produktu.
+
+evaluate_product zwraca None, gdy reguły nie wystarczą (nieznany problem lub dieta,
+brak tagów OFF, brak tłumaczenia komunikatu) - wtedy decyduje meals_from_barcode_problems.
+"""
+import re
+import threading
+
+from aho_corasick import Automaton, normalize
+from nutriscore import product_healthy_index
+
+# Alergeny: kategoria -> (tag OFF, synonimy w składzie i w opisie problemu).
+# '*' na końcu - dowolna końcówka (odmiana), bez '*' - całe słowo.
+ALLERGENS = {
+    "milk": ("en:milk", [
+        "milk", "dairy", "lactose", "whey", "casein*", "buttermilk", "cream", "cheese*", "yogurt*", "yoghurt*",
+        "skyr", "kefir*", "ghee", "butter*",
+        "mlek*", "mleczn*", "laktoz*", "serwatk*", "kazein*", "maslank*", "smietan*", "ser", "sery", "sera",
+        "serem", "jogurt*", "nabial*", "twarog*", "maslo", "masla", "maslem", "masle", "maslu", "maslan*",
+        "milch*", "laktose", "molke*", "sahne", "kase", "rahmbutter", "sussrahmbutter", "sauerrahmbutter",
+        "lait*", "lactoserum", "creme", "fromage*", "beurre*",
+        "leche*", "lactosa", "queso*", "nata", "mantequilla*",
+        "leite*", "queijo*", "manteiga*",
+        "latte", "lattosio", "formaggi*", "burro",
+        "молок*", "молоч*", "лактоз*", "сыр*",
+    ]),
+    "gluten": ("en:gluten", [
+        "gluten", "wheat", "barley", "rye", "spelt", "oat", "oats", "malt",
+        "glutenu", "glutenem", "pszen*", "jeczmie*", "jeczmien*", "zyt*", "orkisz*", "owies", "owsian*",
+        "owsa", "slod*",
+        "weizen*", "gerste*", "roggen*", "dinkel*", "hafer*", "malz", "malzextrakt*", "gerstenmalz*",
+        "ble", "orge", "seigle", "epeautre", "avoine",
+        "trigo", "cebada", "centeno", "espelta", "avena", "malta",
+        "aveia", "cevada",
+        "frumento", "orzo", "segale", "farro",
+        "пшени*", "ячмен*", "рожь", "ржан*", "овес", "овся*", "глютен*",
+    ]),
+    "nuts": ("en:nuts", [
+        "nut", "nuts", "tree nut*", "almond*", "hazelnut*", "walnut*", "cashew*", "pecan*", "pistachio*",
+        "macadamia*", "brazil nut*",
+        "orzech*", "migdal*", "nerkowc*", "pistacj*",
+        "nuss*", "nusse*", "mandel*", "haselnuss*", "walnuss*",
+        "noix", "noisette*", "amande*", "cajou", "pistache*",
+        "nuez", "nueces", "almendra*", "avellana*", "anacardo*", "pistacho*",
+        "noz", "nozes", "amendoa*", "avela*", "caju",
+        "nocciol*", "mandorl*",
+        "орех*", "миндал*", "фундук*",
+    ]),
+    "peanuts": ("en:peanuts", [
+        "peanut*", "groundnut*", "arachid*",
+        "orzeszki ziemne", "orzeszkow ziemnych", "orzeszkami ziemnymi",
+        "erdnuss*", "erdnusse*",
+        "cacahuete*", "cacahouete*", "mani",
+        "amendoim*",
+        "арахис*",
+    ]),
+    "eggs": ("en:eggs", [
+        "egg", "eggs", "albumin*", "mayonnaise",
+        "jaj*", "jajk*", "majonez*",
+        "ei", "eier*", "eigelb", "eiweiss",
+        "oeuf*",
+        "huevo*", "mayonesa",
+        "ovo", "ovos",
+        "uova", "uovo",
+        "яйц*", "яичн*",
+    ]),
+    "soy": ("en:soybeans", [
+        "soy*", "soja*", "soia", "edamame", "tofu",
+        "соя", "сои", "соев*",
+    ]),
+    "fish": ("en:fish", [
+        "fish", "anchov*", "tuna", "salmon", "cod",
+        "ryb*", "losos*", "tunczyk*", "dorsz*", "sardyn*",
+        "fisch*",
+        "poisson*", "saumon", "thon",
+        "pescado*", "atun", "salmon",
+        "peixe*", "atum",
+        "pesce",
+        "рыб*", "лосос*", "тунец*",
+    ]),
+    "crustaceans": ("en:crustaceans", [
+        "crustacean*", "shrimp*", "prawn*", "crab*", "lobster*",
+        "skorupiak*", "krewet*", "krab*", "homar*",
+        "krebstier*", "garnele*",
+        "crustace*", "crevette*", "homard*",
+        "crustaceo*", "gamba*", "camaron*", "langostino*",
+        "camarao*", "camaroes",
+        "ракообразн*", "кревет*", "кальмар*",
+    ]),
+    "molluscs": ("en:molluscs", [
+        "mollusc*", "mollusk*", "mussel*", "squid", "octopus", "clam*", "oyster*",
+        "mieczak*", "malze", "malzy", "malzow", "kalmar*", "osmiornic*", "ostryg*",
+        "weichtier*", "muschel*",
+        "mollusque*", "moule*", "huitre*",
+        "molusco*", "mejillon*", "calamar*",
+        "моллюск*", "мид*",
+    ]),
+    "sesame": ("en:sesame-seeds", [
+        "sesame", "tahini", "sezam*", "sesam*", "sesamo", "gergelim", "кунжут*",
+    ]),
+    "celery": ("en:celery", [
+        "celery", "celeriac", "seler*", "sellerie", "celeri", "apio", "aipo", "sedano", "сельдере*",
+    ]),
+    "mustard": ("en:mustard", [
+        "mustard", "gorczyc*", "musztard*", "senf", "moutarde", "mostaza", "mostarda", "горчиц*",
+    ]),
+    "sulphites": ("en:sulphur-dioxide-and-sulphites", [
+        "sulphite*", "sulfite*", "sulphur dioxide", "sulfur dioxide", "e220", "e221", "e222", "e223", "e224",
+        "e226", "e227", "e228",
+        "siarczyn*", "dwutlenek siarki", "disiarczyn*",
+        "sulfit*", "schwefeldioxid",
+        "anhydride sulfureux",
+        "sulfito*", "dioxido de azufre",
+        "сульфит*",
+    ]),
+    "lupin": ("en:lupin", [
+        "lupin*", "lubin*", "lupine*", "altramuz*", "tremoço*", "люпин*",
+    ]),
+}
+
+# Nazwy zawierające synonim alergenu, które go nie oznaczają ('coconut milk', 'noix de coco')
+NOT_ALLERGENS = {
+    "milk": ["coconut milk", "almond milk", "oat milk", "soy milk", "rice milk", "cream of tartar",
+             "mleko kokosowe", "mleczko kokosowe", "lait de coco", "leche de coco", "leite de coco",
+             "kokosmilch",
+             # Tłuszcze roślinne i pasty nazywane masłem
+             "cocoa butter", "shea butter", "peanut butter", "nut butter", "almond butter", "cashew butter",
+             "hazelnut butter", "butternut*", "maslo kakaowe", "masla kakaowego", "maslo shea",
+             "maslo orzechowe", "masla orzechowego", "maslo z orzechow*", "beurre de cacao",
+             "beurre de karite", "beurre de cacahuete*", "manteca de cacao", "manteiga de cacau",
+             "burro di cacao", "burro di arachidi"],
+    "nuts": ["noix de coco", "noix de muscade", "nuez moscada", "noz moscada", "orzech kokosowy",
+             "orzecha kokosowego", "orzechy arachidowe", "orzechow arachidowych"],
+}
+
+# Określenia pojawiające się w opisie problemu, ale nie w składzie produktu
+PROBLEM_SYNONYMS = {
+    "gluten": ["celiac", "coeliac", "celiakia", "celiakii", "zoliakie", "coeliaque", "celiaqu*", "celiac*",
+               "целиаки*"],
+    "milk": ["nietolerancja laktozy", "lactose intolerance", "laktoseintoleranz"],
+}
+
+# Problemy oceniane na podstawie wartości odżywczych na 100 g (progi "high" wg UK FSA)
+NUTRIENT_PROBLEMS = {
+    "sugar": ("sugars_100g", 22.5, [
+        "diabetes", "diabetic", "sugar", "insulin resistance", "prediabetes",
+        "cukrzyc*", "diabet*", "cukier", "insulinoopornosc*", "insulinooporn*",
+        "zucker*", "diabete*", "azucar", "acucar", "диабет*", "сахар*",
+    ]),
+    "salt": ("salt_100g", 1.5, [
+        "hypertension", "high blood pressure", "salt", "sodium",
+        "nadcisnieni*", "sol", "soli", "sod", "sodu",
+        "bluthochdruck", "hypertonie", "salz",
+        "hipertension", "hipertensao", "sal",
+        "гипертони*", "давлени*", "сол*",
+    ]),
+    "saturated_fat": ("saturated-fat_100g", 5.0, [
+        "cholesterol*", "colesterol*", "cholesterin*", "холестерин*",
+    ]),
+}
+
+# Dieta -> wymagany tag ingredients_analysis_tags i tag oznaczający konflikt
+DIETS = {
+    "vegan": ("en:vegan", "en:non-vegan", [
+        "vegan*", "wegan*", "veganer*", "vegano*", "веган*",
+    ]),
+    "vegetarian": ("en:vegetarian", "en:non-vegetarian", [
+        "vegetarian*", "wegetaria*", "vegetarier*", "vegetarien*", "vegetariano*", "вегетариан*",
+    ]),
+    "palm_oil_free": ("en:palm-oil-free", "en:palm-oil", [
+        "palm oil free", "no palm oil", "without palm oil", "bez oleju palmowego", "sans huile de palme",
+        "sin aceite de palma",
+    ]),
+}
+# Diety bez ograniczeń co do składu (puste też)
+NEUTRAL_DIETS = {
+    normalize(d) for d in (
+        "none", "normal", "standard", "classic", "balanced", "regular", "omnivore", "no diet", "brak",
+        "normalna", "standardowa", "klasyczna", "zbilansowana", "zwykla", "tradycyjna", "bez diety",
+    )
+}
+# Słowa, które mogą otaczać rozpoznane problemy i diety ("alergia na mleko i orzechy"); każde
+# inne słowo (np. "kiwi", "nie") oznacza tekst, którego reguły nie rozumieją - decyduje OpenAI
+FILLER_WORDS = {
+    normalize(w) for w in (
+        "allergy", "allergies", "allergic", "intolerance", "intolerant", "diet", "to", "and", "or", "with",
+        "alergia", "alergie", "alergii", "uczulenie", "uczulony", "uczulona", "nietolerancja",
+        "nietolerancji", "dieta", "na", "i", "oraz", "lub",
+        "allergie", "unvertraglichkeit", "diat", "gegen", "und", "oder",
+    )
+}
+_WORDS = re.compile(r"\w+")
+
+# Dieta wykluczająca alergen (np. 'gluten free', 'bez laktozy') sprowadza się do problemu
+DIET_EXCLUDES = {
+    "gluten": ["gluten free", "bezglutenow*", "bez glutenu", "glutenfrei", "sans gluten", "sin gluten",
+               "sem gluten"],
+    "milk": ["lactose free", "dairy free", "bez laktozy", "bezlaktozow*", "bezmleczn*", "laktosefrei",
+             "sans lactose", "sin lactosa", "sem lactose"],
+}
+
+_text_matcher = Automaton(
+    [(pattern, (True, category)) for category, (_, patterns) in ALLERGENS.items() for pattern in patterns]
+    + [(pattern, (False, category)) for category, patterns in NOT_ALLERGENS.items() for pattern in patterns]
+)
+_problem_matcher = Automaton(
+    [(pattern, ("allergen", category)) for category, (_, patterns) in ALLERGENS.items() for pattern in patterns]
+    + [(pattern, ("allergen", category)) for category, patterns in PROBLEM_SYNONYMS.items() for pattern in patterns]
+    + [(pattern, ("nutrient", name)) for name, (_, _, patterns) in NUTRIENT_PROBLEMS.items() for pattern in patterns]
+)
+_diet_matcher = Automaton(
+    [(pattern, ("diet", name)) for name, (_, _, patterns) in DIETS.items() for pattern in patterns]
+    + [(pattern, ("allergen", category)) for category, patterns in DIET_EXCLUDES.items() for pattern in patterns]
+)
+
+# Komunikaty w języku użytkownika (wartości z /update_language)
+MESSAGES = {
+    "English": {
+        "contains": "Contains {allergen}",
+        "traces": "May contain traces of {allergen}",
+        "nutrient": "High {nutrient} content ({value:g} g per 100 g)",
+        "diet": "Not suitable for a {diet} diet",
+        "allergens": {
+            "milk": "milk (lactose)", "gluten": "gluten", "nuts": "nuts", "peanuts": "peanuts", "eggs": "eggs",
+            "soy": "soy", "fish": "fish", "crustaceans": "crustaceans", "molluscs": "molluscs",
+            "sesame": "sesame", "celery": "celery", "mustard": "mustard", "sulphites": "sulphites",
+            "lupin": "lupin",
+        },
+        "nutrients": {"sugar": "sugar", "salt": "salt", "saturated_fat": "saturated fat"},
+        "diets": {"vegan": "vegan", "vegetarian": "vegetarian", "palm_oil_free": "palm-oil-free"},
+    },
+    "Polish": {
+        "contains": "Zawiera {allergen}",
+        "traces": "Może zawierać śladowe ilości: {allergen}",
+        "nutrient": "Wysoka zawartość {nutrient} ({value:g} g na 100 g)",
+        "diet": "Nieodpowiedni dla diety {diet}",
+        "allergens": {
+            "milk": "mleko (laktozę)", "gluten": "gluten", "nuts": "orzechy", "peanuts": "orzeszki ziemne",
+            "eggs": "jaja", "soy": "soję", "fish": "ryby", "crustaceans": "skorupiaki", "molluscs": "mięczaki",
+            "sesame": "sezam", "celery": "seler", "mustard": "gorczycę", "sulphites": "siarczyny",
+            "lupin": "łubin",
+        },
+        "nutrients": {"sugar": "cukru", "salt": "soli", "saturated_fat": "tłuszczów nasyconych"},
+        "diets": {"vegan": "wegańskiej", "vegetarian": "wegetariańskiej", "palm_oil_free": "bez oleju palmowego"},
+    },
+    "Spanish": {
+        "contains": "Contiene {allergen}",
+        "traces": "Puede contener trazas de {allergen}",
+        "nutrient": "Alto contenido de {nutrient} ({value:g} g por 100 g)",
+        "diet": "No apto para una dieta {diet}",
+        "allergens": {
+            "milk": "leche (lactosa)", "gluten": "gluten", "nuts": "frutos de cáscara", "peanuts": "cacahuetes",
+            "eggs": "huevo", "soy": "soja", "fish": "pescado", "crustaceans": "crustáceos",
+            "molluscs": "moluscos", "sesame": "sésamo", "celery": "apio", "mustard": "mostaza",
+            "sulphites": "sulfitos", "lupin": "altramuces",
+        },
+        "nutrients": {"sugar": "azúcar", "salt": "sal", "saturated_fat": "grasas saturadas"},
+        "diets": {"vegan": "vegana", "vegetarian": "vegetariana", "palm_oil_free": "sin aceite de palma"},
+    },
+    "French": {
+        "contains": "Contient : {allergen}",
+        "traces": "Peut contenir des traces de {allergen}",
+        "nutrient": "Teneur élevée en {nutrient} ({value:g} g pour 100 g)",
+        "diet": "Ne convient pas à un régime {diet}",
+        "allergens": {
+            "milk": "lait (lactose)", "gluten": "gluten", "nuts": "fruits à coque", "peanuts": "arachides",
+            "eggs": "œufs", "soy": "soja", "fish": "poisson", "crustaceans": "crustacés",
+            "molluscs": "mollusques", "sesame": "sésame", "celery": "céleri", "mustard": "moutarde",
+            "sulphites": "sulfites", "lupin": "lupin",
+        },
+        "nutrients": {"sugar": "sucre", "salt": "sel", "saturated_fat": "graisses saturées"},
+        "diets": {"vegan": "végétalien", "vegetarian": "végétarien", "palm_oil_free": "sans huile de palme"},
+    },
+    "Portuguese": {
+        "contains": "Contém {allergen}",
+        "traces": "Pode conter vestígios de {allergen}",
+        "nutrient": "Alto teor de {nutrient} ({value:g} g por 100 g)",
+        "diet": "Não adequado para uma dieta {diet}",
+        "allergens": {
+            "milk": "leite (lactose)", "gluten": "glúten", "nuts": "frutos de casca rija", "peanuts": "amendoins",
+            "eggs": "ovos", "soy": "soja", "fish": "peixe", "crustaceans": "crustáceos",
+            "molluscs": "moluscos", "sesame": "sésamo", "celery": "aipo", "mustard": "mostarda",
+            "sulphites": "sulfitos", "lupin": "tremoço",
+        },
+        "nutrients": {"sugar": "açúcar", "salt": "sal", "saturated_fat": "gorduras saturadas"},
+        "diets": {"vegan": "vegana", "vegetarian": "vegetariana", "palm_oil_free": "sem óleo de palma"},
+    },
+}
+
+_counters = {"decided": 0, "fallback": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def get_rule_stats() -> dict:
+    with _counters_lock:
+        stats = dict(_counters)
+    total = stats["decided"] + stats["fallback"]
+    stats["decided_rate"] = stats["decided"] / total if total else 0.0
+    return stats
+
+
+def _match_whole(matcher: Automaton, text: str):
+    """Wartości wzorców w tekście; None, gdy poza dopasowaniami zostaje słowo spoza FILLER_WORDS."""
+    text = normalize(text)
+    covered = [False] * len(text)
+    values = set()
+    for start, end, value in matcher.iter_matches(text):
+        # Wzorzec z '*' kończy się przed końcówką słowa ('mlek' w 'mleka') - pokrywamy całe słowo
+        while end < len(text) and text[end].isalnum():
+            end += 1
+        covered[start:end] = [True] * (end - start)
+        values.add(value)
+    rest = "".join(" " if is_covered else ch for is_covered, ch in zip(covered, text))
+    if not values or any(word not in FILLER_WORDS for word in _WORDS.findall(rest)):
+        return None
+    return values
+
+
+def _user_requirements(user_context: dict):
+    """(alergeny, problemy odżywcze, diety) z problemów i diety użytkownika; None gdy czegoś nie rozpoznano."""
+    allergens, nutrients, diets = set(), set(), set()
+    for problem in user_context.get("problems") or []:
+        matches = _match_whole(_problem_matcher, problem)
+        if matches is None:
+            return None
+        for kind, name in matches:
+            (allergens if kind == "allergen" else nutrients).add(name)
+
+    diet = normalize(user_context.get("diet"))
+    if diet and diet not in NEUTRAL_DIETS:
+        matches = _match_whole(_diet_matcher, diet)
+        if matches is None:
+            return None
+        for kind, name in matches:
+            (allergens if kind == "allergen" else diets).add(name)
+    return allergens, nutrients, diets
+
+
+def _allergens_in_text(text: str) -> set:
+    matches = list(_text_matcher.iter_matches(normalize(text)))
+    excluded = [(start, end, category) for start, end, (positive, category) in matches if not positive]
+    found = set()
+    for start, end, (positive, category) in matches:
+        if positive and not any(c == category and s <= start and end <= e for s, e, c in excluded):
+            found.add(category)
+    return found
+
+
+def _decide(product: dict, user_context: dict):
+    requirements = _user_requirements(user_context)
+    if requirements is None:
+        return None
+    allergens, nutrients, diets = requirements
+
+    healthy_index = product_healthy_index(product)
+    if healthy_index is None:
+        return None
+
+    allergen_tags = product.get("allergens_tags")
+    traces_tags = product.get("traces_tags")
+    analysis_tags = product.get("ingredients_analysis_tags")
+    # Brak tagów (None) to brak danych w OFF, a nie brak alergenów
+    if allergens and (allergen_tags is None or traces_tags is None):
+        return None
+    if diets and analysis_tags is None:
+        return None
+    # Pusta lista allergens_tags w OFF to zwykle nieuzupełnione tagi, a nie produkt bez alergenów:
+    # alergen znaleziony w składzie rozstrzyga, jego brak już nie - wtedy meals_from_barcode_problems
+    allergen_tags_missing = not allergen_tags
+
+    messages = MESSAGES.get(user_context.get("language") or "English")
+    problems = []
+    if allergens:
+        in_text = _allergens_in_text(f"{product.get('name', '')} {product.get('ingredients', '')}")
+        for category in sorted(allergens):
+            tag = ALLERGENS[category][0]
+            if tag in allergen_tags or category in in_text:
+                problems.append(("contains", category))
+            elif tag in traces_tags:
+                problems.append(("traces", category))
+            elif allergen_tags_missing:
+                return None
+
+    nutriments = product.get("nutriments") or {}
+    for name in sorted(nutrients):
+        key, limit, _ = NUTRIENT_PROBLEMS[name]
+        value = nutriments.get(key)
+        if value is None:
+            return None
+        if float(value) > limit:
+            problems.append(("nutrient", name, float(value)))
+
+    for name in sorted(diets):
+        required, conflict, _ = DIETS[name]
+        if conflict in analysis_tags:
+            problems.append(("diet", name))
+        elif required not in analysis_tags:
+            # 'maybe-vegan', 'vegan-status-unknown' itp.
+            return None
+
+    if problems and messages is None:
+        return None
+    texts = []
+    for problem in problems:
+        if problem[0] in ("contains", "traces"):
+            texts.append(messages[problem[0]].format(allergen=messages["allergens"][problem[1]]))
+        elif problem[0] == "nutrient":
+            texts.append(messages["nutrient"].format(nutrient=messages["nutrients"][problem[1]], value=problem[2]))
+        else:
+            texts.append(messages["diet"].format(diet=messages["diets"][problem[1]]))
+    return {"healthy_index": healthy_index, "problems": texts}
+
+
+def evaluate_product(product: dict, user_context: dict):
+    """
+    Wynik w formacie meals_from_barcode_problems ({'healthy_index', 'problems'})
+    albo None, gdy reguły nie potrafią rozstrzygnąć.
+    """
+    result = _decide(product, user_context)
+    _count("decided" if result is not None else "fallback")
+    return result
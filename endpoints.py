@@ -1,30 +1,52 @@
 from typing import List
 
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends, Request, Body
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends, Request, Body, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 from datetime import datetime, date, timedelta
 from psycopg2.extras import RealDictCursor
 from pydantic import BaseModel
 
 
+import asyncio
 import json
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import re
-import io
 import logging
-from PIL import Image
 from openai import OpenAI
 import boto3
 import requests
+from botocore.config import Config as BotoConfig
 
 from auth import get_current_user
-from db import get_db_connection, get_or_create_user_by_sub
+from db import forget_user_sub
+from db_session import DBSession, get_db, get_db_session, get_current_user_id
+from session_tokens import (
+    session_tokens_enabled, is_session_token, issue_session_token, get_session_version, revoke_user_sessions
+)
 from config import S3_BUCKET_NAME, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION, OPENAI_API_KEY
-from config import USER_POOL_ID
+from config import USER_POOL_ID, GOAL_ENGINE, PHOTO_ANALYSIS_MODE, EVENTS_KEEPALIVE, OPENAI_IMAGE_MODE
+from config import S3_TIMEOUT, S3_MAX_ATTEMPTS, IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_MAX_BYTES, IMAGE_TIMEOUT
 
 from checkSubscription import check_subscription_add_meal, verify_apple_subscribe_active, decode_apple_receipt
-from OpenAI_requests import query_meal_nutrients, new_goal, meals_from_barcode_problems
-from openfoodfacts_api import getInfoFromOpenFoodsApi
-
-router = APIRouter()
+from OpenAI_requests import query_meal_nutrients, new_goal, image_data_url
+from analysis_cache import cached_barcode_problems
+from diet_rules import evaluate_product
+from nutriscore import product_healthy_index
+from goal_calculator import calculate_goal
+from openfoodfacts_api import OpenFoodFactsError, get_product
+from products import load_product, product_from_data, mirror_image, store_product
+from openai_gateway import OpenAIUnavailableError
+from meal_jobs import PENDING_NAME, PRIORITY_NORMAL, PRIORITY_LOW, load_user_context, get_job
+from meal_jobs import enqueue as enqueue_meal_job, notify as notify_meal_workers
+from events import publish as publish_event, subscribe, unsubscribe
+from bulkheads import BulkheadRoute, bulkhead
+from pipeline import Stage, run_stages
+import deadlines
+import images
+from uploads import SpooledUpload, spool_upload, spooled_image
+
+router = APIRouter(route_class=BulkheadRoute)
 logger = logging.getLogger("server_logger")
 
 # Inicjalizacja klienta S3 oraz ustawienie klucza OpenAI
@@ -32,8 +54,28 @@ s3 = boto3.client(
     's3',
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION
+    region_name=AWS_REGION,
+    config=BotoConfig(connect_timeout=S3_TIMEOUT, read_timeout=S3_TIMEOUT,
+                      retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"})
 )
+# Wywołania S3 w żądaniu nie zaczynają się po jego terminie (deadlines.py)
+s3.meta.events.register("before-call.s3", deadlines.check_boto_call)
+
+
+def _prepare_photo(data: bytes):
+    """Zmniejszone zdjęcie bez metadanych (images.py, pula procesów) i jego Content-Type."""
+    timeout = deadlines.budget(IMAGE_TIMEOUT)
+    try:
+        body = images.prepare(data, IMAGE_FORMAT, quality=IMAGE_QUALITY, max_bytes=IMAGE_MAX_BYTES,
+                              timeout=timeout)
+    except FuturesTimeoutError:
+        logger.warning("Przygotowanie zdjęcia przekroczyło %.1f s.", timeout)
+        raise HTTPException(status_code=504, detail="Przekroczono czas przygotowania zdjęcia.")
+    except BrokenProcessPool:
+        # images.prepare utworzył już nową pulę - ponowienie ma szansę się udać
+        raise HTTPException(status_code=503, detail="Przygotowanie zdjęcia chwilowo niedostępne.",
+                            headers={"Retry-After": "5"})
+    return body, images.CONTENT_TYPES[IMAGE_FORMAT]
 
 
 class ProblemsUpdateRequest(BaseModel):
@@ -58,12 +100,36 @@ def test(
         raise HTTPException(status_code=500, detail="Wystąpił błąd podczas testu")
 
 
+@router.get("/events")
+async def events_stream(request: Request, user_id: int = Depends(get_current_user_id)):
+    """
+    Strumień Server-Sent Events dla zalogowanego użytkownika: meal_analysed, meal_edited,
+    goal_updated - z dowolnego urządzenia i procesu serwera (events.py).
+    """
+    subscription = subscribe(user_id)
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.get(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Komentarz SSE - podtrzymuje połączenie przez proxy i load balancer
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.post("/register")
-def register_user(email: str = Form(...), password: str = Form(...)):
+def register_user(email: str = Form(...), password: str = Form(...), session: DBSession = Depends(get_db)):
     try:
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        cur = session.cur
 
         cur.execute('SELECT ID FROM "User" WHERE email=%s', (email,))
         existing_user = cur.fetchone()
@@ -77,33 +143,46 @@ def register_user(email: str = Form(...), password: str = Form(...)):
             RETURNING ID
         """, (email, password, date.today(), "English"))
         new_id = cur.fetchone()[0]
-        conn.commit()
+        session.commit()
         logger.info("Zarejestrowano użytkownika: %s", email)
         return {"message": "Użytkownik zarejestrowany.", "user_id": new_id}
     except Exception as e:
         logger.error("Błąd przy rejestracji użytkownika: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
-@router.post("/delete_account")
-def delete_account(current_user: dict = Depends(get_current_user)):
+@router.post("/session_token")
+def create_session_token(session: DBSession = Depends(get_db_session)):
+    # Wymiana zweryfikowanego tokena Cognito/Apple na krótkotrwały token sesyjny serwera
+    if not session_tokens_enabled():
+        raise HTTPException(status_code=503, detail="Tokeny sesyjne są wyłączone.")
+    if is_session_token(session.current_user):
+        raise HTTPException(status_code=400, detail="Wymagany token Cognito lub Apple.")
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
+        version = get_session_version(session.cur, session.user_id)
+        token, expires_in = issue_session_token(session.user_id, version, session.current_user)
+        logger.info("Wydano token sesyjny dla user_id: %s", session.user_id)
+        return {"access_token": token, "token_type": "Bearer", "expires_in": expires_in}
+    except Exception as e:
+        logger.error("Błąd przy wydawaniu tokena sesyjnego: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
 
-        conn = get_db_connection()
-        cur = conn.cursor()
+@router.post("/delete_account")
+@bulkhead("external")
+def delete_account(session: DBSession = Depends(get_db_session)):
+    try:
+        user_id = session.user_id
+        cur = session.cur
         cur.execute(
-            'UPDATE "User" SET email = %s, password = NULL WHERE ID = %s',
+            'UPDATE "User" SET email = %s, password = NULL, cognito_sub = NULL, apple_sub = NULL WHERE ID = %s',
             ("foodio.example@gmail.com", user_id)
         )
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="User not found or unauthorized")
-        conn.commit()
+        revoke_user_sessions(cur, user_id)
+        session.commit()
+        forget_user_sub(session.sub, session.issuer)
         # Usuń użytkownika z AWS Cognito User Pool
         cognito_client = boto3.client(
             'cognito-idp',
@@ -114,26 +193,18 @@ def delete_account(current_user: dict = Depends(get_current_user)):
         # Zakładamy, że 'sub' jest używany jako identyfikator użytkownika w Cognito
         cognito_client.admin_delete_user(
             UserPoolId=USER_POOL_ID,
-            Username=sub
+            Username=session.sub
         )
         return {"message": "Konto zostało usunięte (anonymized)."}
     except Exception as e:
         logger.error("Błąd przy usuwaniu konta: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/buy_subscription")
+@bulkhead("external")
 def buy_subscription(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         subscription_type: int = Form(...),
         original_transaction_id: str = Form(...)
 ):
@@ -146,37 +217,32 @@ def buy_subscription(
     if not verify_apple_subscribe_active(original_transaction_id):
         raise HTTPException(status_code=403, detail="Subskrypcja nieaktywna wg Apple")
 
-    sub = current_user["sub"]
-    email = current_user.get("email", "")
-    user_id = get_or_create_user_by_sub(sub, email)
+    user_id = session.user_id
 
-    logger.info(f"{email} original_transaction_id is {original_transaction_id}")
+    logger.info(f"{session.email} original_transaction_id is {original_transaction_id}")
 
 
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("""
-                INSERT INTO Subscription (User_ID, subscription_type, original_transaction_id, isActive)
-                VALUES (%s, %s, %s, 'Y')
-                ON CONFLICT (User_ID) DO UPDATE
-                  SET subscription_type = EXCLUDED.subscription_type,
-                      original_transaction_id = EXCLUDED.original_transaction_id,
-                      isActive = 'Y';
-            """, (user_id, subscription_type, original_transaction_id))
-            conn.commit()
+        session.cur.execute("""
+            INSERT INTO Subscription (User_ID, subscription_type, original_transaction_id, isActive)
+            VALUES (%s, %s, %s, 'Y')
+            ON CONFLICT (User_ID) DO UPDATE
+              SET subscription_type = EXCLUDED.subscription_type,
+                  original_transaction_id = EXCLUDED.original_transaction_id,
+                  isActive = 'Y';
+        """, (user_id, subscription_type, original_transaction_id))
+        session.commit()
     except Exception as e:
-        conn.rollback()
+        session.rollback()
         raise HTTPException(status_code=500, detail="DB error: " + str(e))
-    finally:
-        conn.close()
 
     return {"success": True, "original_transaction_id": original_transaction_id}
 
 
 @router.post("/add_meal_from_barcode")
+@bulkhead("external")
 def add_meal_from_barcode(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         latitude: float = Form(...),
         longitude: float = Form(...),
         original_transaction_id: str = Form(...),
@@ -185,112 +251,140 @@ def add_meal_from_barcode(
 ):
     try:
         logger.info(f"apple recipe ma forme (pierwsze 50 znakow): {original_transaction_id[:50]}")
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         now = datetime.now()
         today = date.today()
 
         # original_transaction_id = decode_apple_receipt(original_transaction_id)
         logger.info(f"apple recipe ma forme (pierwsze 50 znakow): {original_transaction_id[:50]}")
-        original_file_contents = image.file.read()
-        file_name = f"{user_id}_{int(now.timestamp())}_barcode_{image.filename}"
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=file_name, Body=original_file_contents)
-
-        # Pobranie kontekstu użytkownika (problemy, dieta)
-        cur.execute("SELECT description FROM Problem WHERE User_ID = %s LIMIT 7", (user_id,))
-        problems_rows = cur.fetchall()
-        user_problems = [row[0] for row in problems_rows] if problems_rows else []
-
-        cur.execute("SELECT diet, language FROM \"User\" WHERE ID = %s", (user_id,))
-        diet_row = cur.fetchone()
-        user_diet = diet_row[0] if diet_row and diet_row[0] is not None else ""
-        user_language = diet_row[1] if diet_row and diet_row[1] is not None else ""
-
-        user_context = {
-            "problems": user_problems,
-            "diet": user_diet,
-            "language": user_language
-        }
 
-        # Pobranie danych z OpenFoodsAPI
-        name, kcal, proteins, carbs, fats, ingredients, image_front_url = getInfoFromOpenFoodsApi(barcode)
-
-        if len(ingredients) > 0:
-            problems_result, _ = meals_from_barcode_problems(name, ingredients, user_context)
-        else:
-            problems_result = {"healthy_index": -1, "problems": []}
-
-        healthy_index_val = problems_result.get("healthy_index", -1)
-        problems_val = problems_result.get("problems", [])
-
-        image_stream = io.BytesIO(original_file_contents)
-        img = Image.open(image_stream)
+        barcode_key = str(barcode)
+
+
+        def fetch_off(existing):
+            # Produkt ze wspólnej tabeli Product; przy pierwszym skanie z Open Food Facts
+            if existing is not None:
+                return None
+            try:
+                data = get_product(barcode_key, cur)
+            except OpenFoodFactsError as e:
+                logger.error("Wystąpił błąd podczas pobierania danych z Open Food Facts: %s", e)
+                data = None
+            if data is None:
+                raise HTTPException(status_code=404, detail="Nie znaleziono produktu o podanym kodzie kreskowym.")
+            return data
+
+        def mirror_product_image(existing, data):
+            # Kopia zdjęcia OFF do S3 idzie równolegle z oceną produktu (reguły / OpenAI)
+            if existing is not None:
+                return existing["img_link"]
+            return mirror_image(s3, barcode_key, data.get("image_url"))
+
+        def meal_image(img_link):
+            # Bez zdjęcia OFF posiłek dostaje zdjęcie użytkownika pod jego własnym kluczem (nie w Product)
+            if img_link is not None:
+                return img_link
+            with spool_upload(image) as upload:
+                body, content_type = _prepare_photo(upload.source())
+            file_name = f"{user_id}_{int(now.timestamp())}_barcode_{image.filename}"
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=file_name, Body=body, ContentType=content_type)
+            return file_name
+
+        def save_product(existing, data, img_link):
+            if existing is not None:
+                return existing
+            return store_product(cur, barcode_key, data, img_link)
+
+        def evaluate(product, user_context):
+            if len(product["ingredients"]) > 0:
+                # Reguły na tagach OFF rozstrzygają większość skanów bez zapytania do OpenAI
+                problems_result = evaluate_product(product, user_context)
+                if problems_result is None:
+                    problems_result = cached_barcode_problems(cur, product["name"], product["ingredients"], user_context)
+            else:
+                problems_result = {"healthy_index": -1, "problems": []}
+            return problems_result
+
+        def presign(file_name):
+            return s3.generate_presigned_url(
+                'get_object', Params={'Bucket': S3_BUCKET_NAME, 'Key': file_name}, ExpiresIn=300
+            )
 
-        max_size = (512, 1024)
-        img_for_openai = img.copy()
-        if img_for_openai.width > max_size[0] or img_for_openai.height > max_size[1]:
-            img_for_openai.thumbnail(max_size, Image.ANTIALIAS)
+        def store(product, problems_result, file_name, presigned_url):
+            name, kcal, proteins, carbs, fats = (
+                product["name"], product["kcal"], product["proteins"], product["carbs"], product["fats"]
+            )
 
-        buf = io.BytesIO()
-        img_format = img.format if img.format else "PNG"
-        img_for_openai.save(buf, format=img_format)
-        resized_image_bytes = buf.getvalue()
+            # Nutri-Score liczony lokalnie ma pierwszeństwo przed oceną z OpenAI
+            healthy_index_val = product_healthy_index(product)
+            if healthy_index_val is None:
+                healthy_index_val = problems_result.get("healthy_index", -1)
+            problems_val = problems_result.get("problems", [])
 
-        resized_file_name = f"resized_{file_name}"
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=resized_file_name, Body=resized_image_bytes)
-        presigned_url = s3.generate_presigned_url(
-            'get_object', Params={'Bucket': S3_BUCKET_NAME, 'Key': resized_file_name}, ExpiresIn=300
-        )
+            # Wstawienie rekordu do Meal, aby uzyskać meal_id
+            cur.execute("""
+                INSERT INTO Meal(
+                    User_ID, name, bar_code, img_link, kcal, proteins, carbs, fats, date, healthy_index, latitude, longitude, added
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING ID
+            """, (
+                user_id, name, product["barcode"], file_name, kcal, proteins, carbs, fats, now, healthy_index_val, latitude, longitude,
+                False))
+            meal_id = cur.fetchone()[0]
+
+            # Wstawienie problemów do tabeli Warning z wykorzystaniem meal_id
+            problems_with_id = []
+            for problem in problems_val:
+                cur.execute("INSERT INTO Warning (Meal_ID, warning) VALUES (%s, %s) RETURNING ID", (meal_id, problem))
+                problem_id = cur.fetchone()[0]
+                problems_with_id.append({"id": problem_id, "description": problem})
 
-        # Wstawienie rekordu do Meal, aby uzyskać meal_id
-        cur.execute("""
-            INSERT INTO Meal(
-                User_ID, name, bar_code, img_link, kcal, proteins, carbs, fats, date, healthy_index, latitude, longitude, added
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING ID
-        """, (
-            user_id, name, barcode, file_name, kcal, proteins, carbs, fats, now, healthy_index_val, latitude, longitude,
-            False))
-        meal_id = cur.fetchone()[0]
-        conn.commit()
-
-        # Wstawienie problemów do tabeli Warning z wykorzystaniem meal_id
-        problems_with_id = []
-        for problem in problems_val:
-            cur.execute("INSERT INTO Warning (Meal_ID, warning) VALUES (%s, %s) RETURNING ID", (meal_id, problem))
-            problem_id = cur.fetchone()[0]
-            problems_with_id.append({"id": problem_id, "description": problem})
-        conn.commit()
-
-        meal_data = {
-            "id": meal_id,
-            "name": name,
-            "img_link": presigned_url,
-            "kcal": kcal,
-            "proteins": proteins,
-            "carbs": carbs,
-            "fats": fats,
-            "healthy_index": healthy_index_val,
-            "latitude": str(latitude),
-            "longitude": str(longitude),
-            "date": now.isoformat(),
-            "added": False,
-            "warnings": problems_with_id
-        }
+            meal_data = {
+                "id": meal_id,
+                "name": name,
+                "img_link": presigned_url,
+                "kcal": kcal,
+                "proteins": proteins,
+                "carbs": carbs,
+                "fats": fats,
+                "healthy_index": healthy_index_val,
+                "latitude": str(latitude),
+                "longitude": str(longitude),
+                "date": now.isoformat(),
+                "added": False,
+                "warnings": problems_with_id
+            }
 
-        cur.execute("""
-            INSERT INTO OpenAI_request(User_ID, type, img_link, date)
-            VALUES (%s, %s, %s, %s)
-            RETURNING ID
-        """, (user_id, 'B', file_name, now))
-        openai_req_id = cur.fetchone()[0]
-        conn.commit()
+            cur.execute("""
+                INSERT INTO OpenAI_request(User_ID, type, img_link, date)
+                VALUES (%s, %s, %s, %s)
+                RETURNING ID
+            """, (user_id, 'B', file_name, now))
+            openai_req_id = cur.fetchone()[0]
+            publish_event(cur, user_id, "meal_analysed", meal_id=meal_id, status="done")
+            return meal_data, problems_with_id, openai_req_id
+
+        # Ocena produktu czeka tylko na dane produktu i kontekst użytkownika, nie na kopię zdjęcia w S3
+        results = run_stages("barcode", [
+            Stage("context", lambda: load_user_context(cur, user_id), db=True),
+            Stage("lookup", lambda: load_product(cur, barcode_key), db=True),
+            # off i evaluate czekają na OFF/OpenAI - kursor biorą tylko na zapytania (cursor_lock)
+            Stage("off", fetch_off, deps=("lookup",)),
+            Stage("product", lambda existing, data: existing or product_from_data(barcode_key, data),
+                  deps=("lookup", "off")),
+            Stage("image", mirror_product_image, deps=("lookup", "off")),
+            Stage("meal_image", meal_image, deps=("image",)),
+            Stage("evaluate", evaluate, deps=("product", "context")),
+            Stage("save_product", save_product, deps=("lookup", "off", "image"), db=True),
+            Stage("presign", presign, deps=("meal_image",)),
+            Stage("store", store, deps=("save_product", "evaluate", "meal_image", "presign"), db=True),
+        ])
+        meal_data, problems_with_id, openai_req_id = results["store"]
+        meal_id = meal_data["id"]
+        session.commit()
 
         logger.info("Dodano posiłek (meal_id: %s) dla user_id: %s", meal_id, user_id)
         return {
@@ -301,134 +395,172 @@ def add_meal_from_barcode(
             "extracted_problems": problems_with_id
         }
 
+    except HTTPException:
+        raise
+    except OpenAIUnavailableError as e:
+        logger.warning("OpenAI niedostępne przy dodawaniu posiłku: %s", e)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         logger.error("Błąd przy dodawaniu posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 @router.post("/add_meal_from_photo")
+@bulkhead("external")
 def add_meal_from_photo(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         latitude: float = Form(...),
         longitude: float = Form(...),
         original_transaction_id: str = Form(...),
-        image: UploadFile = File(...)
+        image: SpooledUpload = Depends(spooled_image),
+        prefer: str = Header(None)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         now = datetime.now()
         today = date.today()
 
-        original_file_contents = image.file.read()
         file_name = f"{user_id}_{int(now.timestamp())}_{image.filename}"
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=file_name, Body=original_file_contents)
-
-        image_stream = io.BytesIO(original_file_contents)
-        img = Image.open(image_stream)
-
-        max_size = (512, 1024)
-        img_for_openai = img.copy()
-        if img_for_openai.width > max_size[0] or img_for_openai.height > max_size[1]:
-            img_for_openai.thumbnail(max_size, Image.ANTIALIAS)
-
-        buf = io.BytesIO()
-        img_format = img.format if img.format else "PNG"
-        img_for_openai.save(buf, format=img_format)
-        resized_image_bytes = buf.getvalue()
-
         resized_file_name = f"resized_{file_name}"
-        s3.put_object(Bucket=S3_BUCKET_NAME, Key=resized_file_name, Body=resized_image_bytes)
-        presigned_url = s3.generate_presigned_url(
-            'get_object', Params={'Bucket': S3_BUCKET_NAME, 'Key': resized_file_name}, ExpiresIn=300
-        )
 
-        cur.execute("SELECT description FROM Problem WHERE User_ID = %s LIMIT 7", (user_id,))
-        problems_rows = cur.fetchall()
-        user_problems = [row[0] for row in problems_rows] if problems_rows else []
-
-        cur.execute("SELECT diet, language FROM \"User\" WHERE ID = %s", (user_id,))
-        diet_row = cur.fetchone()
-        user_diet = diet_row[0] if diet_row and diet_row[0] is not None else ""
-        user_language = diet_row[1] if diet_row and diet_row[1] is not None else ""
-
-        user_context = {
-            "problems": user_problems,
-            "diet": user_diet,
-            "language": user_language
-        }
-
-        nutrients_dict, openai_result_text = query_meal_nutrients(presigned_url, user_context)
-        name_val = nutrients_dict.get("name", "dish")
-        kcal_val = nutrients_dict.get("kcal", -1)
-        proteins_val = nutrients_dict.get("proteins", -1)
-        carbs_val = nutrients_dict.get("carbs", -1)
-        fats_val = nutrients_dict.get("fats", -1)
-        healthy_index_val = nutrients_dict.get("healthy_index", -1)
-        problems_val = nutrients_dict.get("problems", [])
+        def upload_original():
+            # Strumieniem z pliku tymczasowego (multipart dla dużych zdjęć)
+            image.upload_to_s3(s3, S3_BUCKET_NAME, file_name)
+
+        def resize():
+            return _prepare_photo(image.source())
+
+        def upload_resized(resized):
+            resized_image_bytes, resized_content_type = resized
+            s3.put_object(Bucket=S3_BUCKET_NAME, Key=resized_file_name, Body=resized_image_bytes,
+                          ContentType=resized_content_type)
+
+        if PHOTO_ANALYSIS_MODE == "async" or "respond-async" in (prefer or ""):
+            # Zadanie kosztuje tylko zapisy do S3 i bazy - po rozłączeniu klienta dokańczamy je
+            # z niskim priorytetem zamiast przerywać (klient zobaczy posiłek przy synchronizacji)
+            deadlines.keep_on_disconnect()
+
+            def insert_pending(*uploads):
+                # Tryb zadań: posiłek z wartościami -1, analizę robi worker z meal_jobs.py
+                cur.execute("""
+                    INSERT INTO Meal(
+                        User_ID, name, img_link, kcal, proteins, carbs, fats, date, healthy_index, latitude, longitude, added
+                    )
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING ID
+                """, (user_id, PENDING_NAME, file_name, -1, -1, -1, -1, now, -1, latitude, longitude, False))
+                meal_id = cur.fetchone()[0]
+                priority = PRIORITY_NORMAL
+                if deadlines.disconnected():
+                    priority = PRIORITY_LOW
+                    deadlines.count("jobs_downgraded")
+                return meal_id, enqueue_meal_job(cur, meal_id, user_id, resized_file_name, priority)
+
+            # Worker pobierze zmniejszone zdjęcie z S3 - zadanie powstaje dopiero po obu zapisach
+            results = run_stages("photo_async", [
+                Stage("upload_original", upload_original),
+                Stage("resize", resize),
+                Stage("upload_resized", upload_resized, deps=("resize",)),
+                Stage("enqueue", insert_pending, deps=("upload_original", "upload_resized"), db=True),
+            ])
+            meal_id, job_id = results["enqueue"]
+            session.commit()
+            notify_meal_workers()
+
+            logger.info("Zlecono analizę zdjęcia (meal_id: %s, job_id: %s) dla user_id: %s", meal_id, job_id, user_id)
+            return JSONResponse(status_code=202, content={
+                "message": "Zdjęcie zapisane, analiza posiłku w toku.",
+                "meal_id": meal_id,
+                "status": "pending",
+                "status_url": f"/meal_status/{meal_id}"
+            })
 
-        # Wstawienie rekordu do Meal, aby uzyskać meal_id
-        cur.execute("""
-            INSERT INTO Meal(
-                User_ID, name, img_link, kcal, proteins, carbs, fats, date, healthy_index, latitude, longitude, added
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING ID
-        """, (
-            user_id, name_val, file_name, kcal_val, proteins_val, carbs_val, fats_val, now, healthy_index_val, latitude,
-            longitude, False))
-        meal_id = cur.fetchone()[0]
-        conn.commit()
-
-        # Wstawienie problemów do tabeli Warning z wykorzystaniem meal_id
-        problems_with_id = []
-        for problem in problems_val:
-            cur.execute("INSERT INTO Warning (Meal_ID, warning) VALUES (%s, %s) RETURNING ID", (meal_id, problem))
-            problem_id = cur.fetchone()[0]
-            problems_with_id.append({"id": problem_id, "description": problem})
-        conn.commit()
+        def presign():
+            # Tryb inline: bez zapisu resized_ i pobierania go przez OpenAI z S3; klient dostaje link do oryginału
+            key = file_name if OPENAI_IMAGE_MODE == "inline" else resized_file_name
+            return s3.generate_presigned_url('get_object', Params={'Bucket': S3_BUCKET_NAME, 'Key': key}, ExpiresIn=300)
+
+        def openai_image(resized, presigned_url):
+            if OPENAI_IMAGE_MODE == "inline":
+                return image_data_url(*resized)
+            upload_resized(resized)
+            return presigned_url
+
+        def store(analysis, _, presigned_url):
+            nutrients_dict, openai_result_text = analysis
+            name_val = nutrients_dict.get("name", "dish")
+            kcal_val = nutrients_dict.get("kcal", -1)
+            proteins_val = nutrients_dict.get("proteins", -1)
+            carbs_val = nutrients_dict.get("carbs", -1)
+            fats_val = nutrients_dict.get("fats", -1)
+            healthy_index_val = nutrients_dict.get("healthy_index", -1)
+            problems_val = nutrients_dict.get("problems", [])
+
+            # Wstawienie rekordu do Meal, aby uzyskać meal_id
+            cur.execute("""
+                INSERT INTO Meal(
+                    User_ID, name, img_link, kcal, proteins, carbs, fats, date, healthy_index, latitude, longitude, added
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING ID
+            """, (
+                user_id, name_val, file_name, kcal_val, proteins_val, carbs_val, fats_val, now, healthy_index_val, latitude,
+                longitude, False))
+            meal_id = cur.fetchone()[0]
+
+            # Wstawienie problemów do tabeli Warning z wykorzystaniem meal_id
+            problems_with_id = []
+            for problem in problems_val:
+                cur.execute("INSERT INTO Warning (Meal_ID, warning) VALUES (%s, %s) RETURNING ID", (meal_id, problem))
+                problem_id = cur.fetchone()[0]
+                problems_with_id.append({"id": problem_id, "description": problem})
 
-        cur.execute("""
-            SELECT ID, name, img_link, kcal, proteins, carbs, fats, healthy_index, latitude, longitude, date, added
-            FROM Meal WHERE ID = %s
-        """, (meal_id,))
-        updated_meal = cur.fetchone()
-        meal_data = {
-            "id": updated_meal[0],
-            "name": updated_meal[1],
-            "img_link": presigned_url,
-            "kcal": updated_meal[3],
-            "proteins": updated_meal[4],
-            "carbs": updated_meal[5],
-            "fats": updated_meal[6],
-            "healthy_index": updated_meal[7],
-            "latitude": str(updated_meal[8]),
-            "longitude": str(updated_meal[9]),
-            "date": updated_meal[10].isoformat() if isinstance(updated_meal[10], datetime) else updated_meal[10],
-            "added": updated_meal[11]
-        }
-        meal_data["warnings"] = problems_with_id
+            cur.execute("""
+                SELECT ID, name, img_link, kcal, proteins, carbs, fats, healthy_index, latitude, longitude, date, added
+                FROM Meal WHERE ID = %s
+            """, (meal_id,))
+            updated_meal = cur.fetchone()
+            meal_data = {
+                "id": updated_meal[0],
+                "name": updated_meal[1],
+                "img_link": presigned_url,
+                "kcal": updated_meal[3],
+                "proteins": updated_meal[4],
+                "carbs": updated_meal[5],
+                "fats": updated_meal[6],
+                "healthy_index": updated_meal[7],
+                "latitude": str(updated_meal[8]),
+                "longitude": str(updated_meal[9]),
+                "date": updated_meal[10].isoformat() if isinstance(updated_meal[10], datetime) else updated_meal[10],
+                "added": updated_meal[11]
+            }
+            meal_data["warnings"] = problems_with_id
 
-        cur.execute("""
-            INSERT INTO OpenAI_request(User_ID, type, img_link, date)
-            VALUES (%s, %s, %s, %s)
-            RETURNING ID
-        """, (user_id, 'M', file_name, now))
-        openai_req_id = cur.fetchone()[0]
-        conn.commit()
+            cur.execute("""
+                INSERT INTO OpenAI_request(User_ID, type, img_link, date)
+                VALUES (%s, %s, %s, %s)
+                RETURNING ID
+            """, (user_id, 'M', file_name, now))
+            openai_req_id = cur.fetchone()[0]
+            publish_event(cur, user_id, "meal_analysed", meal_id=meal_id, status="done")
+            return meal_data, problems_with_id, openai_req_id, openai_result_text
+
+        # Zapis oryginału do S3 idzie równolegle ze zmniejszaniem zdjęcia i zapytaniem do OpenAI;
+        # posiłek trafia do bazy dopiero, gdy oryginał jest już w S3
+        results = run_stages("photo", [
+            Stage("upload_original", upload_original),
+            Stage("resize", resize),
+            Stage("presign", presign),
+            Stage("context", lambda: load_user_context(cur, user_id), db=True),
+            Stage("openai_image", openai_image, deps=("resize", "presign")),
+            Stage("analyse", lambda image_url, user_context: query_meal_nutrients(image_url, user_context),
+                  deps=("openai_image", "context")),
+            Stage("store", store, deps=("analyse", "upload_original", "presign"), db=True),
+        ])
+        meal_data, problems_with_id, openai_req_id, openai_result_text = results["store"]
+        meal_id = meal_data["id"]
+        session.commit()
 
         logger.info("Dodano posiłek (meal_id: %s) dla user_id: %s", meal_id, user_id)
         return {
@@ -440,31 +572,72 @@ def add_meal_from_photo(
             "extracted_problems": problems_with_id
         }
 
+    except HTTPException:
+        raise
+    except OpenAIUnavailableError as e:
+        logger.warning("OpenAI niedostępne przy dodawaniu posiłku: %s", e)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         logger.error("Błąd przy dodawaniu posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
+@router.get("/meal_status/{meal_id}")
+def meal_status(meal_id: int, session: DBSession = Depends(get_db_session)):
+    try:
+        user_id = session.user_id
+        cur = session.cur
+
+        cur.execute("""
+            SELECT ID, name, img_link, kcal, proteins, carbs, fats, healthy_index, latitude, longitude, date, added
+            FROM Meal WHERE ID = %s AND User_ID = %s
+        """, (meal_id, user_id))
+        meal_row = cur.fetchone()
+        if meal_row is None:
+            raise HTTPException(status_code=404, detail="Nie znaleziono posiłku.")
+
+        # Posiłki dodane bez kolejki nie mają zadania - są od razu gotowe
+        job = get_job(cur, meal_id, user_id)
+        status = job[0] if job else "done"
+        result = {"meal_id": meal_id, "status": status, "attempts": job[1] if job else 0}
+        if status == "failed":
+            result["error"] = job[2]
+        if status != "done":
+            return result
+
+        cur.execute("SELECT ID, warning FROM Warning WHERE Meal_ID = %s ORDER BY ID", (meal_id,))
+        warnings = [{"id": row[0], "description": row[1]} for row in cur.fetchall()]
+        result["meal"] = {
+            "id": meal_row[0],
+            "name": meal_row[1],
+            "img_link": s3.generate_presigned_url(
+                'get_object', Params={'Bucket': S3_BUCKET_NAME, 'Key': meal_row[2]}, ExpiresIn=3600
+            ),
+            "kcal": meal_row[3],
+            "proteins": meal_row[4],
+            "carbs": meal_row[5],
+            "fats": meal_row[6],
+            "healthy_index": meal_row[7],
+            "latitude": str(meal_row[8]),
+            "longitude": str(meal_row[9]),
+            "date": meal_row[10].isoformat() if isinstance(meal_row[10], datetime) else meal_row[10],
+            "added": meal_row[11],
+            "warnings": warnings
+        }
+        result["warnings"] = warnings
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Błąd przy pobieraniu statusu posiłku: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 @router.get("/secure_meals_by_day")
-def secure_meals_by_day(current_user: dict = Depends(get_current_user)):
+def secure_meals_by_day(session: DBSession = Depends(get_db_session)):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("""
             SELECT date::date, ID, img_link, kcal, proteins, carbs, fats, healthy_index, latitude, longitude
@@ -508,20 +681,13 @@ def secure_meals_by_day(current_user: dict = Depends(get_current_user)):
     except Exception as e:
         logger.error("Błąd przy pobieraniu posiłków: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
 @router.get("/secure_meals_by_day/detailed")
-def secure_meals_detailed(current_user: dict = Depends(get_current_user)):
+def secure_meals_detailed(session: DBSession = Depends(get_db_session)):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("SELECT * FROM Meal WHERE User_ID = %s ORDER BY date DESC", (user_id,))
         rows = cur.fetchall()
@@ -578,31 +744,25 @@ def secure_meals_detailed(current_user: dict = Depends(get_current_user)):
     except Exception as e:
         logger.error("Błąd przy pobieraniu posiłków (detailed): %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
 @router.post("/edit_isAdded_true")
 def edit_isAdded_true(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_idx: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET added = TRUE WHERE ID = %s AND User_ID = %s", (meal_idx, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Meal not found or unauthorized")
-        conn.commit()
 
         cur.execute("SELECT ID, added FROM Meal WHERE ID = %s", (meal_idx,))
         updated = cur.fetchone()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_idx, added=True)
+        session.commit()
 
         return {
             "message": "Pole 'added' zostało zaktualizowane.",
@@ -611,37 +771,25 @@ def edit_isAdded_true(
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola added: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/edit_isAdded_false")
 def edit_isAdded_false(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_idx: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET added = FALSE WHERE ID = %s AND User_ID = %s", (meal_idx, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Meal not found or unauthorized")
-        conn.commit()
 
         cur.execute("SELECT ID, added FROM Meal WHERE ID = %s", (meal_idx,))
         updated = cur.fetchone()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_idx, added=False)
+        session.commit()
 
         return {
             "message": "Pole 'added' zostało zaktualizowane.",
@@ -650,28 +798,15 @@ def edit_isAdded_false(
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola added: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.get("/get_user_info")
 def get_user_info(
-        current_user: dict = Depends(get_current_user)
+        session: DBSession = Depends(get_db_session)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
         cur.execute('SELECT email, sex, birthDate, height, dateOfJoin FROM "User" WHERE ID = %s', (user_id,))
         user_info = cur.fetchone()
         if user_info is None:
@@ -688,29 +823,16 @@ def get_user_info(
     except Exception as e:
         logger.error("Błąd przy pobieraniu informacji o użytkowniku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.get("/get_goal")
 def get_goal(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_idx: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
         cur.execute(
             "SELECT kcal, protein, fats, carbs, desiredWeight, lifestyle, diet, startDate, endDate FROM Goal WHERE ID = %s AND User_ID = %s",
             (meal_idx, user_id)
@@ -734,28 +856,17 @@ def get_goal(
     except Exception as e:
         logger.error("Błąd przy pobieraniu goal: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_sex")
 def update_sex(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         sex: str = Form(...)
 ):
     try:
         logger.info(f"plec otrzymana od uzytkownika to: {sex}")
 
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
+        user_id = session.user_id
 
         gender=""
         if sex=="male":
@@ -769,36 +880,26 @@ def update_sex(
         #     raise HTTPException(status_code=400,
         #
         #                         detail="Nieprawidłowa wartość dla pola sex. Dozwolone wartości to: W, M, X.")
-        conn = get_db_connection()
-        cur = conn.cursor()
+        cur = session.cur
 
         logger.info(f"plec otrzymana od uzytkownika to: {sex}")
 
-        cur.execute('UPDATE "User" SET sex = %s WHERE email=%s', (gender[0], email))
+        cur.execute('UPDATE "User" SET sex = %s WHERE ID = %s', (gender[0], user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404,
                                 detail="Użytkownik nie został znaleziony lub aktualizacja nie powiodła się")
-        conn.commit()
+        session.commit()
         logger.info("Zaktualizowano pole sex dla user_id: %s", user_id)
         return {"message": "Pole sex zostało zaktualizowane.", "user_id": user_id, "sex": sex}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola sex: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 
 @router.post("/update_language")
 def update_language(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         language: str = Form(...)
 ):
     try:
@@ -816,45 +917,30 @@ def update_language(
                 detail=f"Nieprawidłowa wartość dla pola language. Dozwolone wartości to: {', '.join(allowed_languages)}."
             )
 
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
+        user_id = session.user_id
+        cur = session.cur
 
-        conn = get_db_connection()
-        cur = conn.cursor()
 
 
-
-        cur.execute('UPDATE "User" SET language = %s WHERE email=%s', (language, email))
+        cur.execute('UPDATE "User" SET language = %s WHERE ID = %s', (language, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404,
                                 detail="Użytkownik nie został znaleziony lub aktualizacja nie powiodła się")
-        conn.commit()
+        session.commit()
         logger.info("Zaktualizowano pole language dla user_id: %s", user_id)
         return {"message": "Pole language zostało zaktualizowane.", "user_id": user_id, "language": language}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola language: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_birthDate")
 def update_birthDate(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         birth_date: date = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
+        user_id = session.user_id
 
         if birth_date < date(1900, 1, 1):
             raise HTTPException(
@@ -862,40 +948,28 @@ def update_birthDate(
                 detail="Nieprawidłowa data urodzenia. Osoba nie mogła urodzić się przed 1 stycznia 1900."
             )
 
-        conn = get_db_connection()
-        cur = conn.cursor()
+        cur = session.cur
 
         cur.execute('UPDATE "User" SET birthDate = %s WHERE ID = %s', (birth_date, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404,
                                 detail="Użytkownik nie został znaleziony lub aktualizacja nie powiodła się")
-        conn.commit()
+        session.commit()
         logger.info("Zaktualizowano pole birthDate dla user_id: %s", user_id)
         return {"message": "Pole birthDate zostało zaktualizowane.", "user_id": user_id,
                 "birth_date": birth_date.isoformat()}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola birthDate: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_height")
 def update_height(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         height: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
+        user_id = session.user_id
 
         if height < 50 or height > 250:
             raise HTTPException(
@@ -903,77 +977,50 @@ def update_height(
                 detail="Nieprawidłowa wartość dla pola height. Dozwolony zakres: 50-250 cm."
             )
 
-        conn = get_db_connection()
-        cur = conn.cursor()
+        cur = session.cur
 
         cur.execute('UPDATE "User" SET height = %s WHERE ID = %s', (height, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404,
                                 detail="Użytkownik nie został znaleziony lub aktualizacja nie powiodła się")
-        conn.commit()
+        session.commit()
         logger.info("Zaktualizowano pole height dla user_id: %s", user_id)
         return {"message": "Pole height zostało zaktualizowane.", "user_id": user_id, "height": height}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola height: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 
 @router.post("/update_diet")
 def update_diet(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         diet: str = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute('UPDATE "User" SET diet = %s WHERE ID = %s', (diet, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Użytkownik nie został znaleziony lub aktualizacja nie powiodła się")
-        conn.commit()
+        session.commit()
         logger.info("Zaktualizowano pole diet dla user_id: %s", user_id)
         return {"message": "Pole diet zostało zaktualizowane.", "user_id": user_id, "diet": diet}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola diet: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 
 @router.post("/create_problem")
 def create_problem(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         description: str = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute('SELECT COUNT(*) FROM Problem WHERE User_ID = %s', (user_id,))
         count = cur.fetchone()[0]
@@ -982,35 +1029,22 @@ def create_problem(
 
         cur.execute('INSERT INTO Problem (User_ID, description) VALUES (%s, %s) RETURNING ID', (user_id, description))
         problem_id = cur.fetchone()[0]
-        conn.commit()
+        session.commit()
         return {"message": "Problem został utworzony.", "problem_id": problem_id}
     except Exception as e:
         logger.error("Błąd przy tworzeniu problemu: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_problems")
 def update_problems(
     payload: ProblemsUpdateRequest,
-    current_user: dict = Depends(get_current_user)
+    session: DBSession = Depends(get_db_session)
 ):
     try:
         problems = payload.problems
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         logger.info(f"Updating problems for user {user_id}")
 
@@ -1029,36 +1063,23 @@ def update_problems(
             cur.execute("INSERT INTO Problem (User_ID, description) VALUES (%s, %s) RETURNING ID", (user_id, desc))
             new_id = cur.fetchone()[0]
 
-        conn.commit()
+        session.commit()
         return {"message": "Problemy zostały zaktualizowane.", "problems": list(provided_descriptions)}
     except Exception as e:
-        conn.rollback()
+        session.rollback()
         logger.error("Błąd przy aktualizacji problemów: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 
 @router.delete("/delete_problem/{problem_id}")
 def delete_problem(
         problem_id: int,
-        current_user: dict = Depends(get_current_user)
+        session: DBSession = Depends(get_db_session)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute('SELECT ID FROM Problem WHERE ID = %s AND User_ID = %s', (problem_id, user_id))
         if not cur.fetchone():
@@ -1067,34 +1088,21 @@ def delete_problem(
         cur.execute('DELETE FROM Problem WHERE ID = %s', (problem_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Usunięcie problemu nie powiodło się.")
-        conn.commit()
+        session.commit()
         return {"message": "Problem został usunięty.", "problem_id": problem_id}
     except Exception as e:
         logger.error("Błąd przy usuwaniu problemu: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/add_current_weight")
 def add_current_weight(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         weight: float = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         today = date.today()
         cur.execute(
@@ -1102,7 +1110,7 @@ def add_current_weight(
             (user_id, weight, today)
         )
         weight_id = cur.fetchone()[0]
-        conn.commit()
+        session.commit()
         logger.info("Dodano aktualną wagę dla user_id: %s, waga: %s", user_id, weight)
         return {
             "message": "Aktualna waga została dodana.",
@@ -1114,29 +1122,16 @@ def add_current_weight(
     except Exception as e:
         logger.error("Błąd przy dodawaniu aktualnej wagi: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_goal_kcal")
 def update_goal_kcal(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         kcal: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("SELECT ID FROM Goal WHERE User_ID = %s ORDER BY ID DESC LIMIT 1", (user_id,))
         result = cur.fetchone()
@@ -1147,34 +1142,22 @@ def update_goal_kcal(
         cur.execute("UPDATE Goal SET kcal = %s WHERE ID = %s", (kcal, goal_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Aktualizacja nie powiodła się.")
-        conn.commit()
+        publish_event(cur, user_id, "goal_updated", goal_id=goal_id, kcal=kcal)
+        session.commit()
         return {"message": "Pole kcal zostało zaktualizowane.", "goal_id": goal_id, "kcal": kcal}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola kcal w Goal: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_goal_protein")
 def update_goal_protein(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         protein: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("SELECT ID FROM Goal WHERE User_ID = %s ORDER BY ID DESC LIMIT 1", (user_id,))
         result = cur.fetchone()
@@ -1185,34 +1168,22 @@ def update_goal_protein(
         cur.execute("UPDATE Goal SET protein = %s WHERE ID = %s", (protein, goal_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Aktualizacja nie powiodła się.")
-        conn.commit()
+        publish_event(cur, user_id, "goal_updated", goal_id=goal_id, protein=protein)
+        session.commit()
         return {"message": "Pole protein zostało zaktualizowane.", "goal_id": goal_id, "protein": protein}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola protein w Goal: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_goal_fats")
 def update_goal_fats(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         fats: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("SELECT ID FROM Goal WHERE User_ID = %s ORDER BY ID DESC LIMIT 1", (user_id,))
         result = cur.fetchone()
@@ -1223,34 +1194,22 @@ def update_goal_fats(
         cur.execute("UPDATE Goal SET fats = %s WHERE ID = %s", (fats, goal_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Aktualizacja nie powiodła się.")
-        conn.commit()
+        publish_event(cur, user_id, "goal_updated", goal_id=goal_id, fats=fats)
+        session.commit()
         return {"message": "Pole fats zostało zaktualizowane.", "goal_id": goal_id, "fats": fats}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola fats w Goal: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/update_goal_carbs")
 def update_goal_carbs(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         carbs: int = Form(...)
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("SELECT ID FROM Goal WHERE User_ID = %s ORDER BY ID DESC LIMIT 1", (user_id,))
         result = cur.fetchone()
@@ -1261,125 +1220,18 @@ def update_goal_carbs(
         cur.execute("UPDATE Goal SET carbs = %s WHERE ID = %s", (carbs, goal_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Aktualizacja nie powiodła się.")
-        conn.commit()
+        publish_event(cur, user_id, "goal_updated", goal_id=goal_id, carbs=carbs)
+        session.commit()
         return {"message": "Pole carbs zostało zaktualizowane.", "goal_id": goal_id, "carbs": carbs}
     except Exception as e:
         logger.error("Błąd przy aktualizacji pola carbs w Goal: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
-
-
-# @router.post("/create_goal")
-# def create_goal(
-#         current_user: dict = Depends(get_current_user),
-#         desiredWeight: float = Form(...),
-#         lifestyle: str = Form(...),
-#         diet: str = Form(...),
-#         startDate: date = Form(...),
-#         endDate: date = Form(...)
-# ):
-#     logger.info("Początek tworzenia celu dla użytkownika.")
-#     try:
-#         sub = current_user["sub"]
-#         email = current_user.get("email", "")
-#         user_id = get_or_create_user_by_sub(sub, email)
-#         logger.info(f"Znaleziono użytkownika o ID: {user_id}")
-#
-#         conn = get_db_connection()
-#         cur = conn.cursor()
-#
-#         cur.execute('SELECT sex, birthDate, height FROM "User" WHERE ID = %s', (user_id,))
-#         user_data = cur.fetchone()
-#         logger.info(f"Dane użytkownika pobrane: {user_data}")
-#
-#         now = datetime.now()
-#         if not user_data:
-#             logger.error("Nie znaleziono danych użytkownika.")
-#             raise HTTPException(status_code=404, detail="Nie znaleziono danych użytkownika.")
-#         sex, birthDate, height = user_data
-#
-#         cur.execute('UPDATE "User" SET diet = %s WHERE ID = %s', (diet, user_id))
-#         conn.commit()
-#         logger.info("Zaktualizowano pole diet w tabeli User.")
-#
-#         cur.execute("SELECT date FROM OpenAI_request WHERE User_ID = %s AND type = 'G' ORDER BY date DESC LIMIT 1", (user_id,))
-#         last_request = cur.fetchone()
-#         logger.info(f"Ostatnie zapytanie OpenAI: {last_request}")
-#
-#         if last_request:
-#             last_date = last_request[0]
-#             if now - last_date < timedelta(weeks=1):
-#                 next_allowed = last_date + timedelta(weeks=1)
-#                 time_remaining = next_allowed - now
-#                 logger.warning(f"Cel został już utworzony niedawno; kolejna operacja za {time_remaining}.")
-#                 raise HTTPException(status_code=400,
-#                                     detail=f"Cel będzie można utworzyć ponownie za {time_remaining}.")
-#
-#         # Wywołanie funkcji new_goal
-#         nutrients, raw_response = new_goal(sex, birthDate, height, lifestyle, diet, str(startDate), str(endDate))
-#         logger.info(f"Wynik new_goal: {nutrients}")
-#
-#         cur.execute("""
-#             INSERT INTO OpenAI_request(User_ID, type, img_link, date)
-#             VALUES (%s, %s, %s, %s)
-#             RETURNING ID
-#         """, (user_id, 'G', None, now))
-#         openai_req_id = cur.fetchone()[0]
-#         conn.commit()
-#         logger.info(f"Zapisano nowy rekord w OpenAI_request: ID {openai_req_id}")
-#
-#         kcal = nutrients.get("kcal", -1)
-#         protein = nutrients.get("proteins", -1)
-#         fats = nutrients.get("fats", -1)
-#         carbs = nutrients.get("carbs", -1)
-#
-#         insert_query = """
-#             INSERT INTO Goal (
-#                 User_ID, kcal, protein, fats, carbs, desiredWeight, lifestyle, startDate, endDate
-#             )
-#             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-#             RETURNING ID;
-#         """
-#         cur.execute(insert_query, (user_id, kcal, protein, fats, carbs, desiredWeight, lifestyle, startDate, endDate))
-#         goal_id = cur.fetchone()[0]
-#         conn.commit()
-#         logger.info(f"Cel utworzony o ID: {goal_id}")
-#
-#         # Zwracamy wynik z widokiem
-#         return {
-#             "message": "Cel został dodany.",
-#             "goal_id": goal_id,
-#             "kcal": kcal,
-#             "protein": protein,
-#             "fats": fats,
-#             "carbs": carbs
-#         }
-#     except Exception as e:
-#         logger.exception("Wystąpił błąd podczas tworzenia celu:")
-#         raise HTTPException(status_code=500, detail=str(e))
-#     finally:
-#         try:
-#             cur.close()
-#             logger.info("Zamknięto kursor.")
-#         except Exception as ex:
-#             logger.warning(f"Błąd przy zamykaniu kursora: {ex}")
-#         try:
-#             conn.close()
-#             logger.info("Zamknięto połączenie z bazą.")
-#         except Exception as ex:
-#             logger.warning(f"Błąd przy zamykaniu połączenia: {ex}")
+
 
 @router.post("/create_goal")
+@bulkhead("external")
 def create_goal(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         desiredWeight: float = Form(...),
         lifestyle: str = Form(...),
         diet: str = Form(...),
@@ -1388,13 +1240,10 @@ def create_goal(
 ):
     logger.info("Początek tworzenia celu dla użytkownika.")
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
+        user_id = session.user_id
         logger.info(f"Znaleziono użytkownika o ID: {user_id}")
 
-        conn = get_db_connection()
-        cur = conn.cursor()
+        cur = session.cur
 
         cur.execute('SELECT sex, birthDate, height FROM "User" WHERE ID = %s', (user_id,))
         user_data = cur.fetchone()
@@ -1407,7 +1256,6 @@ def create_goal(
         sex, birthDate, height = user_data
 
         cur.execute('UPDATE "User" SET diet = %s WHERE ID = %s', (diet, user_id))
-        conn.commit()
         logger.info("Zaktualizowano pole diet w tabeli User.")
 
         # Dla celów testowych pomijamy weryfikację daty ostatniego celu
@@ -1415,19 +1263,30 @@ def create_goal(
         last_request = cur.fetchone()
         logger.info(f"Ostatnie zapytanie OpenAI (pomijamy weryfikację): {last_request}")
 
-        # Wywołanie funkcji new_goal
-        nutrients, raw_response,text_from_openai = new_goal(sex, birthDate, height, lifestyle, diet, str(startDate), str(endDate))
-        logger.info(f"Wynik new_goal: {nutrients}")
-        logger.info(f"Wynik new_goal: {text_from_openai}")
+        nutrients = None
+        source = "openai"
+        if GOAL_ENGINE == "local":
+            cur.execute("SELECT weight FROM Weight WHERE User_ID = %s ORDER BY date DESC, ID DESC LIMIT 1", (user_id,))
+            weight_row = cur.fetchone()
+            nutrients = calculate_goal(sex, birthDate, height, weight_row[0] if weight_row else None,
+                                       desiredWeight, lifestyle, diet, startDate, endDate)
+            source = "local"
+            logger.info(f"Wynik goal_calculator: {nutrients}")
+
+        if nutrients is None:
+            # Tryb openai albo brak wzrostu / daty urodzenia potrzebnych do wzoru
+            source = "openai"
+            nutrients, raw_response,text_from_openai = new_goal(sex, birthDate, height, lifestyle, diet, str(startDate), str(endDate))
+            logger.info(f"Wynik new_goal: {nutrients}")
+            logger.info(f"Wynik new_goal: {text_from_openai}")
 
-        cur.execute("""
-            INSERT INTO OpenAI_request(User_ID, type, img_link, date)
-            VALUES (%s, %s, %s, %s)
-            RETURNING ID
-        """, (user_id, 'G', None, now))
-        openai_req_id = cur.fetchone()[0]
-        conn.commit()
-        logger.info(f"Zapisano nowy rekord w OpenAI_request: ID {openai_req_id}")
+            cur.execute("""
+                INSERT INTO OpenAI_request(User_ID, type, img_link, date)
+                VALUES (%s, %s, %s, %s)
+                RETURNING ID
+            """, (user_id, 'G', None, now))
+            openai_req_id = cur.fetchone()[0]
+            logger.info(f"Zapisano nowy rekord w OpenAI_request: ID {openai_req_id}")
 
         kcal = nutrients.get("kcal", -1)
         protein = nutrients.get("proteins", -1)
@@ -1438,14 +1297,16 @@ def create_goal(
 
         insert_query = """
             INSERT INTO Goal (
-                User_ID, kcal, protein, fats, carbs, desiredWeight, lifestyle, startDate, endDate
+                User_ID, kcal, protein, fats, carbs, desiredWeight, lifestyle, startDate, endDate, source
             )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             RETURNING ID;
         """
-        cur.execute(insert_query, (user_id, kcal, protein, fats, carbs, desiredWeight, lifestyle, startDate, endDate))
+        cur.execute(insert_query, (user_id, kcal, protein, fats, carbs, desiredWeight, lifestyle, startDate, endDate,
+                                   source))
         goal_id = cur.fetchone()[0]
-        conn.commit()
+        publish_event(cur, user_id, "goal_updated", goal_id=goal_id, kcal=kcal, protein=protein, fats=fats, carbs=carbs)
+        session.commit()
         logger.info(f"Cel utworzony o ID: {goal_id}")
 
         # Zwracamy wynik z widokiem
@@ -1457,35 +1318,23 @@ def create_goal(
             "fats": fats,
             "carbs": carbs
         }
+    except OpenAIUnavailableError as e:
+        logger.warning("OpenAI niedostępne przy tworzeniu celu: %s", e)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         logger.exception("Wystąpił błąd podczas tworzenia celu:")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-            logger.info("Zamknięto kursor.")
-        except Exception as ex:
-            logger.warning(f"Błąd przy zamykaniu kursora: {ex}")
-        try:
-            conn.close()
-            logger.info("Zamknięto połączenie z bazą.")
-        except Exception as ex:
-            logger.warning(f"Błąd przy zamykaniu połączenia: {ex}")
 
 
 
 
 @router.post("/get_meals")
 def get_meals(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("""
             SELECT ID, img_link, name, kcal, proteins, carbs, fats, date, healthy_index
@@ -1527,180 +1376,117 @@ def get_meals(
     except Exception as e:
         logger.error("Błąd przy pobieraniu posiłków: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
 
 
 @router.post("/meal_update_protein")
 def meal_update_protein(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_id: int = Form(...),
         new_value: int = Form(...),
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET proteins = %s WHERE ID = %s AND User_ID = %s", (new_value, meal_id, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Nie znaleziono posiłku lub brak uprawnień")
-        conn.commit()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_id, proteins=new_value)
+        session.commit()
 
         return {"message": "Protein value updated.", "meal": {"id": meal_id, "proteins": new_value}}
     except Exception as e:
         logger.error("Błąd przy aktualizacji białka w posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/meal_update_fats")
 def meal_update_fats(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_id: int = Form(...),
         new_value: int = Form(...),
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET fats = %s WHERE ID = %s AND User_ID = %s", (new_value, meal_id, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Nie znaleziono posiłku lub brak uprawnień")
-        conn.commit()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_id, fats=new_value)
+        session.commit()
 
         return {"message": "fats value updated.", "meal": {"id": meal_id, "proteins": new_value}}
     except Exception as e:
         logger.error("Błąd przy aktualizacji białka w posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/meal_update_carbs")
 def meal_update_carbs(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_id: int = Form(...),
         new_value: int = Form(...),
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET carbs = %s WHERE ID = %s AND User_ID = %s", (new_value, meal_id, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Nie znaleziono posiłku lub brak uprawnień")
-        conn.commit()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_id, carbs=new_value)
+        session.commit()
 
         return {"message": "fats value updated.", "meal": {"id": meal_id, "proteins": new_value}}
     except Exception as e:
         logger.error("Błąd przy aktualizacji białka w posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/meal_update_healthy_index")
 def meal_update_healthy_index(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_id: int = Form(...),
         new_value: int = Form(...),
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET healthy_index = %s WHERE ID = %s AND User_ID = %s",
                     (new_value % 11, meal_id, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Nie znaleziono posiłku lub brak uprawnień")
-        conn.commit()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_id, healthy_index=new_value % 11)
+        session.commit()
 
         return {"message": "healthy_index value updated.", "meal": {"id": meal_id, "proteins": new_value}}
     except Exception as e:
         logger.error("Błąd przy aktualizacji białka w posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 @router.post("/meal_update_kcal")
 def meal_update_kcal(
-        current_user: dict = Depends(get_current_user),
+        session: DBSession = Depends(get_db_session),
         meal_id: int = Form(...),
         new_value: int = Form(...),
 ):
     try:
-        sub = current_user["sub"]
-        email = current_user.get("email", "")
-        user_id = get_or_create_user_by_sub(sub, email)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
+        user_id = session.user_id
+        cur = session.cur
 
         cur.execute("UPDATE Meal SET kcal = %s WHERE ID = %s AND User_ID = %s", (new_value, meal_id, user_id))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Nie znaleziono posiłku lub brak uprawnień")
-        conn.commit()
+        publish_event(cur, user_id, "meal_edited", meal_id=meal_id, kcal=new_value)
+        session.commit()
 
         return {"message": "kcal value updated.", "meal": {"id": meal_id, "proteins": new_value}}
     except Exception as e:
         logger.error("Błąd przy aktualizacji białka w posiłku: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 class AppleNotification(BaseModel):
@@ -1711,10 +1497,9 @@ class AppleNotification(BaseModel):
 
 
 @router.post("/apple_notification")
-def handle_apple_notification(notification: AppleNotification):
+def handle_apple_notification(notification: AppleNotification, session: DBSession = Depends(get_db)):
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        cur = session.cur
 
         if notification.notification_type == "BUY":
             # Przy zakupie subskrypcji – tworzymy nowy rekord lub aktualizujemy istniejący:
@@ -1726,7 +1511,7 @@ def handle_apple_notification(notification: AppleNotification):
                       original_transaction_id = EXCLUDED.original_transaction_id,
                       isActive = 'Y';
             """, (notification.user_id, notification.subscription_type, notification.original_transaction_id))
-            conn.commit()
+            session.commit()
             return {"message": "Subskrypcja kupiona"}
 
         elif notification.notification_type == "RENEW":
@@ -1736,7 +1521,7 @@ def handle_apple_notification(notification: AppleNotification):
                 SET isActive = 'Y'
                 WHERE original_transaction_id = %s;
             """, (notification.original_transaction_id,))
-            conn.commit()
+            session.commit()
             return {"message": "Subskrypcja odnowiona - aktywna"}
 
         elif notification.notification_type == "CANCEL":
@@ -1746,7 +1531,7 @@ def handle_apple_notification(notification: AppleNotification):
                 SET isActive = 'N'
                 WHERE original_transaction_id = %s;
             """, (notification.original_transaction_id,))
-            conn.commit()
+            session.commit()
             return {"message": "Subskrypcja anulowana"}
 
         else:
@@ -1754,14 +1539,4 @@ def handle_apple_notification(notification: AppleNotification):
 
     except Exception as e:
         logger.error("Błąd przy obsłudze powiadomienia Apple: %s", e)
-        raise HTTPException(status_code=500, detail=str(e))
-
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,151 @@
+# events.py
+"""
+Powiadomienia w czasie rzeczywistym dla zalogowanego użytkownika (endpoint /events, SSE).
+
+Ścieżki zapisu wywołują publish() w swojej transakcji - to zwykłe pg_notify, więc
+zdarzenie wychodzi dopiero po commit i tylko wtedy, gdy zapis się udał. Każdy proces
+serwera ma jedno osobne połączenie (spoza puli) z LISTEN na EVENTS_CHANNEL i rozsyła
+zdarzenia do kolejek otwartych strumieni danego użytkownika - także gdy zapis zrobił
+inny proces, inna instancja albo worker z meal_jobs.py.
+
+Zdarzenia: meal_analysed, meal_edited, goal_updated.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+
+import psycopg2.extensions
+
+from config import EVENTS_CHANNEL, EVENTS_QUEUE_SIZE
+from db import _connect
+
+logger = logging.getLogger("server_logger")
+
+_lock = threading.Lock()
+_subscribers = {}
+_listener = None
+_stopping = threading.Event()
+_stats = {"published": 0, "received": 0, "delivered": 0, "dropped": 0}
+
+
+def _count(key: str, n: int = 1):
+    with _lock:
+        _stats[key] += n
+
+
+def get_event_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats["subscribers"] = sum(len(subs) for subs in _subscribers.values())
+        stats["users"] = len(_subscribers)
+    stats["listening"] = _listener is not None and _listener.is_alive()
+    return stats
+
+
+def publish(cur, user_id: int, event: str, **data):
+    """Zdarzenie dla user_id, wysyłane przy commit transakcji cur (payload pg_notify < 8000 B)."""
+    payload = json.dumps({"user_id": user_id, "event": event, **data}, default=str)
+    cur.execute("SELECT pg_notify(%s, %s)", (EVENTS_CHANNEL, payload))
+    _count("published")
+
+
+class Subscription:
+    """Kolejka zdarzeń jednego strumienia; zasilana z wątku nasłuchującego."""
+
+    def __init__(self, user_id: int, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+
+    def _put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+            _count("delivered")
+        except asyncio.QueueFull:
+            # Klient nie nadąża - po ponownym połączeniu i tak pobierze pełny stan
+            _count("dropped")
+
+    def deliver(self, event: dict):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+def subscribe(user_id: int) -> Subscription:
+    subscription = Subscription(user_id, asyncio.get_running_loop())
+    with _lock:
+        _subscribers.setdefault(user_id, set()).add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription: Subscription):
+    with _lock:
+        subs = _subscribers.get(subscription.user_id)
+        if subs is not None:
+            subs.discard(subscription)
+            if not subs:
+                del _subscribers[subscription.user_id]
+
+
+def _dispatch(payload: str):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning("Pominięto niepoprawne powiadomienie: %s", payload[:200])
+        return
+    _count("received")
+    with _lock:
+        subs = list(_subscribers.get(event.get("user_id"), ()))
+    for subscription in subs:
+        try:
+            subscription.deliver(event)
+        except RuntimeError:
+            # Pętla zdarzeń strumienia jest już zamknięta
+            unsubscribe(subscription)
+
+
+def _listen():
+    while not _stopping.is_set():
+        try:
+            conn = _connect()
+        except Exception as e:
+            logger.error("Nasłuch zdarzeń - brak połączenia z bazą: %s", e)
+            _stopping.wait(5)
+            continue
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {EVENTS_CHANNEL};")
+            cur.close()
+            logger.info("Nasłuch zdarzeń na kanale %s.", EVENTS_CHANNEL)
+            while not _stopping.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _dispatch(conn.notifies.pop(0).payload)
+        except Exception as e:
+            logger.error("Przerwany nasłuch zdarzeń: %s", e)
+            _stopping.wait(1)
+        finally:
+            conn.close()
+
+
+def start_listener():
+    global _listener
+    if _listener is not None:
+        return
+    _stopping.clear()
+    _listener = threading.Thread(target=_listen, name="events-listener", daemon=True)
+    _listener.start()
+
+
+def stop_listener(timeout: float = 5.0):
+    global _listener
+    _stopping.set()
+    if _listener is not None:
+        _listener.join(timeout)
+        _listener = None
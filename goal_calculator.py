@@ -0,0 +1,117 @@
+# goal_calculator.py
+"""
+Lokalne wyliczanie dziennego celu (kcal, białko, tłuszcze, węglowodany) zamiast new_goal z OpenAI.
+
+  BMR   - wzór Mifflina-St Jeora (masa, wzrost, wiek, płeć),
+  TDEE  - BMR x mnożnik aktywności z pola lifestyle,
+  kcal  - TDEE skorygowane o deficyt/nadwyżkę potrzebną do osiągnięcia desiredWeight
+          w czasie celu (7700 kcal na kg, w bezpiecznych granicach),
+  makro - podział kcal według diety (białko i węglowodany 4 kcal/g, tłuszcz 9 kcal/g).
+"""
+from datetime import date
+
+from aho_corasick import Automaton
+
+KCAL_PER_KG = 7700
+MAX_DEFICIT = 1000
+MAX_SURPLUS = 500
+MIN_KCAL = {"M": 1500, "W": 1200, "X": 1350}
+# Składnik płci we wzorze Mifflina-St Jeora; dla 'X' średnia z obu
+SEX_CONSTANT = {"M": 5, "W": -161, "X": -78}
+
+# Mnożniki aktywności (Harris-Benedict / FAO)
+ACTIVITY_LEVELS = {
+    "sedentary": 1.2,
+    "light": 1.375,
+    "moderate": 1.55,
+    "active": 1.725,
+    "very_active": 1.9,
+}
+DEFAULT_ACTIVITY = "moderate"
+_lifestyle_matcher = Automaton([
+    (pattern, level) for level, patterns in {
+        "sedentary": ["sedentary", "inactive", "desk*", "office", "low", "none", "siedzac*", "malo aktywn*",
+                      "nieaktywn*", "brak aktywnosci", "niski*"],
+        "light": ["light*", "lightly active", "slightly active", "lekk*", "lekko aktywn*", "niewielk*"],
+        "moderate": ["moderate*", "medium", "average", "normal", "umiarkowan*", "sredni*", "srednio aktywn*"],
+        "active": ["active", "high", "sport*", "aktywn*", "wysok*"],
+        "very_active": ["very active", "extremely active", "athlete", "bardzo aktywn*", "sportowiec",
+                        "wyczynow*", "ciezka praca fizyczna"],
+    }.items() for pattern in patterns
+])
+# Przy kilku dopasowaniach ('bardzo aktywny' pasuje też do 'aktywn*') wygrywa bardziej szczegółowe
+_ACTIVITY_PRIORITY = ["very_active", "sedentary", "light", "moderate", "active"]
+
+# Udział białka / węglowodanów / tłuszczu w kcal
+MACRO_SPLITS = {
+    "balanced": (0.20, 0.50, 0.30),
+    "high_protein": (0.35, 0.35, 0.30),
+    "low_carb": (0.30, 0.20, 0.50),
+    "keto": (0.20, 0.05, 0.75),
+    "mediterranean": (0.20, 0.45, 0.35),
+    "vegetarian": (0.18, 0.55, 0.27),
+    "vegan": (0.15, 0.60, 0.25),
+}
+DEFAULT_SPLIT = "balanced"
+_diet_matcher = Automaton([
+    (pattern, split) for split, patterns in {
+        "high_protein": ["high protein", "protein*", "wysokobialkow*", "bialkow*"],
+        "low_carb": ["low carb", "lowcarb", "niskoweglowodanow*", "paleo"],
+        "keto": ["keto*", "ketogen*"],
+        "mediterranean": ["mediterranean", "srodziemnomorsk*"],
+        "vegetarian": ["vegetarian*", "wegetaria*"],
+        "vegan": ["vegan*", "wegan*", "plant based", "roslinn*"],
+    }.items() for pattern in patterns
+])
+_SPLIT_PRIORITY = ["keto", "low_carb", "high_protein", "vegan", "vegetarian", "mediterranean"]
+
+
+def activity_multiplier(lifestyle: str) -> float:
+    levels = _lifestyle_matcher.find(lifestyle)
+    for level in _ACTIVITY_PRIORITY:
+        if level in levels:
+            return ACTIVITY_LEVELS[level]
+    return ACTIVITY_LEVELS[DEFAULT_ACTIVITY]
+
+
+def macro_split(diet: str):
+    splits = _diet_matcher.find(diet)
+    for split in _SPLIT_PRIORITY:
+        if split in splits:
+            return MACRO_SPLITS[split]
+    return MACRO_SPLITS[DEFAULT_SPLIT]
+
+
+def age_on(birth_date: date, on: date) -> int:
+    return on.year - birth_date.year - ((on.month, on.day) < (birth_date.month, birth_date.day))
+
+
+def bmr(sex: str, weight: float, height: float, age: int) -> float:
+    return 10 * weight + 6.25 * height - 5 * age + SEX_CONSTANT.get(sex, SEX_CONSTANT["X"])
+
+
+def calculate_goal(sex, birth_date, height, weight, desired_weight, lifestyle, diet, start_date, end_date):
+    """
+    Dzienny cel {'kcal', 'proteins', 'carbs', 'fats'} (liczby całkowite, gramy dla makro).
+    weight to ostatnia znana masa użytkownika; gdy jej brak, liczymy dla desired_weight.
+    Zwraca None, gdy brakuje danych potrzebnych do wzoru (wzrost, data urodzenia).
+    """
+    if not height or not birth_date:
+        return None
+    sex = sex if sex in SEX_CONSTANT else "X"
+    weight = float(weight if weight else desired_weight)
+    desired_weight = float(desired_weight)
+
+    tdee = bmr(sex, weight, float(height), age_on(birth_date, start_date)) * activity_multiplier(lifestyle)
+    days = max((end_date - start_date).days, 1)
+    adjustment = (desired_weight - weight) * KCAL_PER_KG / days
+    adjustment = min(max(adjustment, -MAX_DEFICIT), MAX_SURPLUS)
+    kcal = max(tdee + adjustment, MIN_KCAL[sex])
+
+    protein_share, carbs_share, fats_share = macro_split(diet)
+    return {
+        "kcal": int(round(kcal)),
+        "proteins": int(round(kcal * protein_share / 4)),
+        "carbs": int(round(kcal * carbs_share / 4)),
+        "fats": int(round(kcal * fats_share / 9)),
+    }
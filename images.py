@@ -0,0 +1,154 @@
+# images.py
+"""
+Przygotowanie zdjęć przed zapisem w S3 i wysłaniem do OpenAI (add_meal_from_photo,
+zdjęcie produktu w add_meal_from_barcode).
+
+  - JPEG jest dekodowany od razu w zmniejszonej skali (draft: 1/2, 1/4, 1/8 - najmniejszej,
+    która nie schodzi poniżej docelowego rozmiaru), pozostałe formaty zmniejsza reduce()
+    przed właściwym skalowaniem (thumbnail z reducing_gap); obie rzeczy działają tylko,
+    jeśli obraz nie został wcześniej wczytany (np. przez copy()),
+  - orientacja z EXIF jest nakładana na piksele, a przy zapisie pomijamy metadane
+    (EXIF z GPS, XMP, komentarze); zostaje tylko profil ICC,
+  - wynik to JPEG albo WebP nie większy niż max_bytes (niższa jakość, w ostateczności
+    mniejsze wymiary).
+
+prepare() wykonuje pracę w puli procesów (start_pool przy starcie aplikacji), więc kilka
+równoczesnych zdjęć dzieli się na rdzenie zamiast czekać na GIL w wątkach żądań. Moduł nie
+importuje config - parametry przekazuje wywołujący, a benchmark może go używać bez sekretów.
+"""
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger("server_logger")
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+MAX_SIZE = (512, 1024)
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+# Poniżej tego boku nie zmniejszamy dalej, nawet jeśli wynik przekracza max_bytes
+MIN_SIDE = 128
+_EXIF_ORIENTATION = 0x0112
+# Orientacje EXIF z obrotem o 90/270 stopni - po nałożeniu szerokość i wysokość się zamieniają
+_TRANSPOSED = (5, 6, 7, 8)
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _mp_context():
+    # forkserver, nie fork - procesy puli powstają z osobnego, jednowątkowego serwera, więc
+    # nową pulę (_replace_pool) można bezpiecznie utworzyć z wątku żądania, gdy działają inne
+    # wątki; serwer ładuje tylko ten moduł (nie config z sekretami). Procesy importują skrypt
+    # startowy jako __mp_main__ - CLI uvicorna i benchmarki mają blok if __name__ == "__main__"
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _flatten(img):
+    """RGB bez przezroczystości (białe tło) - JPEG nie ma kanału alfa."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return img.convert("RGB") if img.mode != "RGB" else img
+
+
+def _encode(img, fmt: str, quality: int, icc_profile) -> bytes:
+    buf = io.BytesIO()
+    options = {"quality": quality}
+    if icc_profile:
+        options["icc_profile"] = icc_profile
+    if fmt == "JPEG":
+        options["optimize"] = True
+    else:
+        options["method"] = 4
+    img.save(buf, format=fmt, **options)
+    return buf.getvalue()
+
+
+def prepare_image(data, fmt: str = "JPEG", max_size=MAX_SIZE, quality: int = 85, max_bytes: int = None) -> bytes:
+    """
+    Zdjęcie zmniejszone do max_size (z orientacją EXIF, bez metadanych) jako fmt; data to
+    bajty albo ścieżka pliku (duże zdjęcia z uploads.py - proces puli czyta je z dysku).
+    """
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"Nieobsługiwany format zdjęcia: {fmt}")
+    img = Image.open(io.BytesIO(data) if isinstance(data, bytes) else data)
+    orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+    # Ramka w układzie pikseli przed obrotem
+    box = (max_size[1], max_size[0]) if orientation in _TRANSPOSED else max_size
+    scale = min(box[0] / img.width, box[1] / img.height, 1.0)
+    img.draft("RGB", (round(img.width * scale), round(img.height * scale)))
+    img.thumbnail(box, Image.LANCZOS, reducing_gap=2.0)
+    img = ImageOps.exif_transpose(img)
+    icc_profile = img.info.get("icc_profile")
+    img = _flatten(img)
+    img.info = {}
+
+    while True:
+        current = quality
+        body = _encode(img, fmt, current, icc_profile)
+        while max_bytes is not None and len(body) > max_bytes and current - QUALITY_STEP >= MIN_QUALITY:
+            current -= QUALITY_STEP
+            body = _encode(img, fmt, current, icc_profile)
+        if max_bytes is None or len(body) <= max_bytes or min(img.size) * 3 // 4 < MIN_SIDE:
+            return body
+        # Nawet najniższa jakość nie mieści się w limicie - mniejsze wymiary
+        img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.LANCZOS)
+
+
+def start_pool(workers: int):
+    """Pula procesów dla prepare(); workers <= 0 - przetwarzanie w wątku wywołującym."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None or workers <= 0:
+            return
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+        _pool_workers = workers
+        # Uruchamia serwer forkserver i pierwszy proces - pierwsze zdjęcie nie czeka na import PIL
+        _pool.submit(int).result()
+    logger.info("Uruchomiono pulę %s procesów przygotowania zdjęć.", workers)
+
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _replace_pool(broken):
+    global _pool
+    with _pool_lock:
+        if _pool is not broken:
+            return
+        _pool = ProcessPoolExecutor(max_workers=_pool_workers, mp_context=_mp_context())
+    broken.shutdown(wait=False, cancel_futures=True)
+    logger.error("Pula procesów przygotowania zdjęć uszkodzona (proces zakończony) - utworzono nową.")
+
+
+def prepare(data, fmt: str = "JPEG", max_size=MAX_SIZE, quality: int = 85, max_bytes: int = None,
+            timeout: float = None) -> bytes:
+    """prepare_image() w puli procesów (gdy uruchomiona); timeout - czas oczekiwania na wynik."""
+    pool = _pool
+    if pool is None:
+        return prepare_image(data, fmt, max_size, quality, max_bytes)
+    future = pool.submit(prepare_image, data, fmt, max_size, quality, max_bytes)
+    try:
+        return future.result(timeout)
+    except BrokenProcessPool:
+        # Proces puli zginął (np. zabrakło pamięci) - kolejne zdjęcia dostaną nową pulę
+        _replace_pool(pool)
+        raise
+    finally:
+        future.cancel()
@@ -1,13 +1,28 @@
 # main.py
 from fastapi import FastAPI
 from endpoints import router as api_router
+from ops import router as ops_router
 from db import create_database_if_not_exists, initialize_schema
 from logging_config import setup_logging
 
-from db import get_db_connection
+from db import get_db_connection, close_pool
+from auth import close_http_client
+from endpoints import s3
+from meal_jobs import start_workers, stop_workers
+from events import start_listener, stop_listener
+from bulkheads import configure_thread_limiter, check_db_pool_size
+from images import start_pool as start_image_pool, stop_pool as stop_image_pool
+from config import IMAGE_WORKERS
+from uploads import UploadLimitMiddleware
 
 logger = setup_logging()
 app = FastAPI()
+app.add_middleware(UploadLimitMiddleware)
+
+@app.on_event("startup")
+def start_image_workers():
+    start_image_pool(IMAGE_WORKERS)
+
 
 @app.on_event("startup")
 def initialize_database():
@@ -20,4 +35,46 @@ def initialize_database():
         create_database_if_not_exists()
     initialize_schema()
 
-app.include_router(api_router)
\ No newline at end of file
+
+@app.on_event("startup")
+async def configure_bulkheads():
+    check_db_pool_size()
+    configure_thread_limiter()
+
+
+@app.on_event("startup")
+def start_meal_workers():
+    start_workers(s3)
+
+
+@app.on_event("startup")
+def start_events_listener():
+    start_listener()
+
+app.include_router(api_router)
+app.include_router(ops_router)
+
+
+@app.on_event("shutdown")
+def shutdown_meal_workers():
+    stop_workers()
+
+
+@app.on_event("shutdown")
+def shutdown_events_listener():
+    stop_listener()
+
+
+@app.on_event("shutdown")
+def shutdown_image_workers():
+    stop_image_pool()
+
+
+@app.on_event("shutdown")
+def shutdown_database():
+    close_pool()
+
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    await close_http_client()
@@ -0,0 +1,268 @@
+# meal_jobs.py
+"""
+Asynchroniczna analiza zdjęć posiłków (tryb zadań /add_meal_from_photo).
+
+Endpoint zapisuje zdjęcie w S3, wstawia posiłek z wartościami -1 oraz zadanie do tabeli
+MealJob i od razu zwraca meal_id; analizę (query_meal_nutrients) robi pula wątków.
+Kolejką jest sama tabela: worker pobiera zadanie przez SELECT ... FOR UPDATE SKIP LOCKED,
+więc kilka procesów i instancji serwera nie weźmie tego samego zadania, a broker nie jest
+potrzebny. Zadanie 'running', którego nikt nie skończył w PHOTO_JOB_LEASE sekund
+(np. restart procesu), wraca do kolejki; po PHOTO_JOB_MAX_ATTEMPTS próbach - 'failed',
+także gdy ostatnia próba przepadła razem z procesem. Worker pożycza połączenie z puli
+tylko na pobranie zadania i zapis wyniku - nie na czas zapytania do OpenAI.
+Zadania z priorytetem PRIORITY_LOW (klient rozłączył się przed odpowiedzią) workery biorą
+dopiero, gdy nie czeka żadne zwykłe.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+
+from config import S3_BUCKET_NAME, OPENAI_IMAGE_MODE
+from config import PHOTO_JOB_WORKERS, PHOTO_JOB_POLL_INTERVAL, PHOTO_JOB_MAX_ATTEMPTS, PHOTO_JOB_LEASE
+from db import get_db_connection
+from events import publish
+from OpenAI_requests import query_meal_nutrients, image_data_url
+
+logger = logging.getLogger("server_logger")
+
+PENDING_NAME = "..."
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = 1
+
+_wakeup = threading.Event()
+_stopping = threading.Event()
+_threads = []
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "enqueued_low": 0, "claimed": 0, "done": 0, "retried": 0, "failed": 0}
+
+
+def _count(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def get_job_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["workers"] = sum(t.is_alive() for t in _threads)
+    return stats
+
+
+def load_user_context(cur, user_id: int) -> dict:
+    """Kontekst użytkownika do zapytań OpenAI: problemy (max 7), dieta, język - jednym zapytaniem."""
+    cur.execute("""
+        SELECT u.diet, u.language,
+               ARRAY(SELECT p.description FROM Problem p WHERE p.User_ID = u.ID LIMIT 7)
+        FROM "User" u WHERE u.ID = %s
+    """, (user_id,))
+    row = cur.fetchone()
+    return {
+        "problems": list(row[2]) if row and row[2] else [],
+        "diet": row[0] if row and row[0] is not None else "",
+        "language": row[1] if row and row[1] is not None else ""
+    }
+
+
+def enqueue(cur, meal_id: int, user_id: int, img_link: str, priority: int = PRIORITY_NORMAL) -> int:
+    """Dodaje zadanie analizy zdjęcia img_link (klucz S3 zmniejszonego zdjęcia) w transakcji cur."""
+    cur.execute("""
+        INSERT INTO MealJob (Meal_ID, User_ID, img_link, status, attempts, created_at, priority)
+        VALUES (%s, %s, %s, 'pending', 0, %s, %s)
+        RETURNING ID
+    """, (meal_id, user_id, img_link, datetime.now(), priority))
+    _count("enqueued" if priority == PRIORITY_NORMAL else "enqueued_low")
+    return cur.fetchone()[0]
+
+
+def notify():
+    """Budzi workery tego procesu - wywołać po commit transakcji z enqueue()."""
+    _wakeup.set()
+
+
+def get_job(cur, meal_id: int, user_id: int):
+    """(status, attempts, error) ostatniego zadania posiłku albo None."""
+    cur.execute("""
+        SELECT status, attempts, error FROM MealJob
+        WHERE Meal_ID = %s AND User_ID = %s
+        ORDER BY ID DESC LIMIT 1
+    """, (meal_id, user_id))
+    return cur.fetchone()
+
+
+def _fail_expired(cur):
+    """Zadania, którym wygasła blokada po ostatniej próbie (np. proces zabity w trakcie analizy)."""
+    cur.execute("""
+        UPDATE MealJob SET status = 'failed', error = 'lease expired', locked_until = NULL, finished_at = now()
+        WHERE status = 'running' AND locked_until < now() AND attempts >= %s
+        RETURNING Meal_ID, User_ID
+    """, (PHOTO_JOB_MAX_ATTEMPTS,))
+    for meal_id, user_id in cur.fetchall():
+        publish(cur, user_id, "meal_analysed", meal_id=meal_id, status="failed")
+        _count("failed")
+        logger.warning("Analiza zdjęcia (meal_id: %s) przerwana %s razy - zadanie 'failed'.",
+                       meal_id, PHOTO_JOB_MAX_ATTEMPTS)
+
+
+def _claim(cur):
+    cur.execute("""
+        UPDATE MealJob
+        SET status = 'running', attempts = attempts + 1, started_at = now(),
+            locked_until = now() + make_interval(secs => %s)
+        WHERE ID = (
+            SELECT ID FROM MealJob
+            WHERE (status = 'pending' OR status = 'running') AND (locked_until IS NULL OR locked_until < now())
+              AND attempts < %s
+            ORDER BY priority, ID
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING ID, Meal_ID, User_ID, img_link, attempts
+    """, (PHOTO_JOB_LEASE, PHOTO_JOB_MAX_ATTEMPTS))
+    return cur.fetchone()
+
+
+def apply_analysis(cur, meal_id: int, nutrients_dict: dict):
+    """Zapisuje wynik query_meal_nutrients w posiłku i tabeli Warning; zwraca ostrzeżenia z ID."""
+    cur.execute("""
+        UPDATE Meal SET name = %s, kcal = %s, proteins = %s, carbs = %s, fats = %s, healthy_index = %s
+        WHERE ID = %s
+    """, (nutrients_dict.get("name", "dish"), nutrients_dict.get("kcal", -1), nutrients_dict.get("proteins", -1),
+          nutrients_dict.get("carbs", -1), nutrients_dict.get("fats", -1), nutrients_dict.get("healthy_index", -1),
+          meal_id))
+    problems_with_id = []
+    for problem in nutrients_dict.get("problems", []):
+        cur.execute("INSERT INTO Warning (Meal_ID, warning) VALUES (%s, %s) RETURNING ID", (meal_id, problem))
+        problems_with_id.append({"id": cur.fetchone()[0], "description": problem})
+    return problems_with_id
+
+
+def _image_url(s3, img_link: str) -> str:
+    if OPENAI_IMAGE_MODE == "inline":
+        obj = s3.get_object(Bucket=S3_BUCKET_NAME, Key=img_link)
+        return image_data_url(obj["Body"].read(), obj.get("ContentType") or "image/jpeg")
+    return s3.generate_presigned_url('get_object', Params={'Bucket': S3_BUCKET_NAME, 'Key': img_link}, ExpiresIn=300)
+
+
+def _in_transaction(fn, *args):
+    """fn(cur, *args) w jednej transakcji na połączeniu pożyczonym z puli tylko na ten czas."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        try:
+            result = fn(cur, *args)
+        finally:
+            cur.close()
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _take_job(cur):
+    """(zadanie, kontekst użytkownika, img_link posiłku) albo None przy pustej kolejce."""
+    _fail_expired(cur)
+    job = _claim(cur)
+    if job is None:
+        return None
+    job_id, meal_id, user_id, _, _ = job
+    user_context = load_user_context(cur, user_id)
+    cur.execute("SELECT img_link FROM Meal WHERE ID = %s", (meal_id,))
+    meal_row = cur.fetchone()
+    if meal_row is None:
+        cur.execute("UPDATE MealJob SET status = 'failed', error = %s, finished_at = now() WHERE ID = %s",
+                    ("meal deleted", job_id))
+        return job, user_context, None
+    return job, user_context, meal_row[0]
+
+
+def _record_failure(cur, job, failed: bool, error: str):
+    job_id, meal_id, user_id, _, attempts = job
+    # Ponowienie z wykładniczym odstępem (locked_until wstrzymuje pobranie zadania)
+    cur.execute("""
+        UPDATE MealJob SET status = %s, error = %s,
+                           locked_until = CASE WHEN %s THEN NULL ELSE now() + make_interval(secs => %s) END,
+                           finished_at = CASE WHEN %s THEN now() END
+        WHERE ID = %s
+    """, ("failed" if failed else "pending", error[:500], failed, PHOTO_JOB_POLL_INTERVAL * 2 ** attempts,
+          failed, job_id))
+    if failed:
+        publish(cur, user_id, "meal_analysed", meal_id=meal_id, status="failed")
+
+
+def _record_result(cur, job, meal_img: str, nutrients_dict: dict):
+    job_id, meal_id, user_id, _, _ = job
+    apply_analysis(cur, meal_id, nutrients_dict)
+    cur.execute("""
+        INSERT INTO OpenAI_request(User_ID, type, img_link, date)
+        VALUES (%s, %s, %s, %s)
+    """, (user_id, 'M', meal_img, datetime.now()))
+    cur.execute("UPDATE MealJob SET status = 'done', error = NULL, finished_at = now() WHERE ID = %s",
+                (job_id,))
+    publish(cur, user_id, "meal_analysed", meal_id=meal_id, status="done")
+
+
+def _process(s3, job, user_context: dict, meal_img):
+    job_id, meal_id, user_id, img_link, attempts = job
+    if meal_img is None:
+        # Posiłek usunięty - _take_job oznaczył już zadanie jako 'failed'
+        _count("failed")
+        return
+
+    # Pobranie z S3 i OpenAI bez połączenia z bazą - analiza może trwać do OPENAI_DEADLINE
+    try:
+        nutrients_dict, _ = query_meal_nutrients(_image_url(s3, img_link), user_context)
+    except Exception as e:
+        failed = attempts >= PHOTO_JOB_MAX_ATTEMPTS
+        _in_transaction(_record_failure, job, failed, str(e))
+        _count("failed" if failed else "retried")
+        logger.warning("Analiza zdjęcia (meal_id: %s, próba %s) nieudana: %s", meal_id, attempts, e)
+        return
+
+    _in_transaction(_record_result, job, meal_img, nutrients_dict)
+    _count("done")
+    logger.info("Przeanalizowano zdjęcie posiłku (meal_id: %s) dla user_id: %s", meal_id, user_id)
+
+
+def _worker(s3):
+    while not _stopping.is_set():
+        try:
+            claimed = _in_transaction(_take_job)
+        except Exception as e:
+            logger.error("Błąd workera zadań zdjęć (pobranie zadania): %s", e)
+            claimed = None
+        if claimed is None:
+            # Pusta kolejka - czekamy na notify() z tego procesu albo kolejny cykl odpytywania
+            _wakeup.wait(PHOTO_JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        _count("claimed")
+        try:
+            _process(s3, *claimed)
+        except Exception as e:
+            # Zadanie wróci do kolejki po wygaśnięciu blokady (PHOTO_JOB_LEASE)
+            logger.error("Błąd workera zadań zdjęć: %s", e)
+
+
+def start_workers(s3):
+    if _threads or PHOTO_JOB_WORKERS <= 0:
+        return
+    _stopping.clear()
+    for i in range(PHOTO_JOB_WORKERS):
+        thread = threading.Thread(target=_worker, args=(s3,), name=f"meal-job-{i}", daemon=True)
+        thread.start()
+        _threads.append(thread)
+    logger.info("Uruchomiono %s workerów analizy zdjęć.", PHOTO_JOB_WORKERS)
+
+
+def stop_workers(timeout: float = 10.0):
+    """Zatrzymuje workery; przerwane zadania wrócą do kolejki po wygaśnięciu blokady."""
+    _stopping.set()
+    _wakeup.set()
+    deadline = time.monotonic() + timeout
+    for thread in _threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+    _threads.clear()
@@ -0,0 +1,126 @@
+# nutriscore.py
+"""
+Lokalny Nutri-Score (algorytm dla żywności ogólnej, wersja 2017/2021) z wartości
+odżywczych OFF na 100 g i przeliczenie na healthy_index w skali 1-10.
+
+Obliczenia są wektorowe (numpy), więc ta sama funkcja liczy jeden produkt przy skanie
+i setki tysięcy wierszy przy uzupełnianiu historii (backfill_healthy_index.py).
+Kategorie specjalne (napoje, sery, tłuszcze) nie są rozróżniane - OFF nie podaje ich
+w wartościach odżywczych, a dla większości produktów różnica jest niewielka.
+"""
+import numpy as np
+
+# Punkty ujemne: liczba progów przekroczonych przez wartość (wartość > próg)
+ENERGY_KJ = np.array([335, 670, 1005, 1340, 1675, 2010, 2345, 2680, 3015, 3350])
+SUGARS_G = np.array([4.5, 9, 13.5, 18, 22.5, 27, 31, 36, 40, 45])
+SATURATED_FAT_G = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+SODIUM_MG = np.array([90, 180, 270, 360, 450, 540, 630, 720, 810, 900])
+# Punkty dodatnie
+FIBER_G = np.array([0.9, 1.9, 2.8, 3.7, 4.7])
+PROTEINS_G = np.array([1.6, 3.2, 4.8, 6.4, 8.0])
+FRUITS_VEGETABLES_PCT = np.array([40, 60, 80])
+FRUITS_VEGETABLES_POINTS = np.array([0, 1, 2, 5])
+
+# Wynik Nutri-Score -> healthy_index: granice klas A-E trafiają w te same poziomy
+# co ocena z klasy OFF (A: 10-9, B: 8-7, C: 6-5, D: 4-3, E: 2-1)
+_SCORE_POINTS = [-15, -1, 0, 2, 3, 10, 11, 18, 19, 40]
+_INDEX_POINTS = [10, 9, 8, 7, 6, 5, 4, 3, 2, 1]
+# Gdy brakuje wartości odżywczych, a OFF podaje samą klasę
+GRADE_HEALTHY_INDEX = {"a": 9, "b": 7, "c": 5, "d": 3, "e": 1}
+
+
+# Kolumny macierzy wejściowej: klucze OFF w kolejności pierwszeństwa
+NUTRIENT_COLUMNS = (
+    ("energy_kj", ("energy_100g",)),
+    ("energy_kcal", ("energy-kcal_100g",)),
+    ("sugars", ("sugars_100g",)),
+    ("saturated_fat", ("saturated-fat_100g",)),
+    ("sodium", ("sodium_100g",)),
+    ("salt", ("salt_100g",)),
+    ("fiber", ("fiber_100g",)),
+    ("proteins", ("proteins_100g",)),
+    ("fruits_vegetables", ("fruits-vegetables-nuts_100g", "fruits-vegetables-nuts-estimate_100g",
+                           "fruits-vegetables-nuts-estimate-from-ingredients_100g")),
+)
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def nutrient_matrix(nutriments_list) -> np.ndarray:
+    """Macierz (produkty x NUTRIENT_COLUMNS) z listy słowników 'nutriments' OFF; NaN gdy brak."""
+    rows = []
+    for nutriments in nutriments_list:
+        nutriments = nutriments or {}
+        row = []
+        for _, keys in NUTRIENT_COLUMNS:
+            value = np.nan
+            for key in keys:
+                value = _float(nutriments.get(key))
+                if not np.isnan(value):
+                    break
+            row.append(value)
+        rows.append(row)
+    return np.array(rows, dtype=float).reshape(len(rows), len(NUTRIENT_COLUMNS))
+
+
+def _points(values, thresholds):
+    return np.searchsorted(thresholds, values, side="left")
+
+
+def nutriscore_points(energy_kj, sugars, saturated_fat, sodium_mg, fiber, proteins, fruits_vegetables):
+    """
+    Wynik Nutri-Score (od -15 do 40, niżej = zdrowiej) dla tablic wartości na 100 g.
+    NaN w energii, cukrach, tłuszczach nasyconych lub sodzie daje NaN w wyniku;
+    brak błonnika i owoców/warzyw liczy się jak 0 (tak samo robi OFF).
+    """
+    negative = (_points(energy_kj, ENERGY_KJ) + _points(sugars, SUGARS_G)
+                + _points(saturated_fat, SATURATED_FAT_G) + _points(sodium_mg, SODIUM_MG))
+    fruits_vegetables = np.nan_to_num(fruits_vegetables)
+    fv_points = FRUITS_VEGETABLES_POINTS[_points(fruits_vegetables, FRUITS_VEGETABLES_PCT)]
+    fiber_points = _points(np.nan_to_num(fiber), FIBER_G)
+    protein_points = _points(np.nan_to_num(proteins), PROTEINS_G)
+    # Przy >= 11 punktach ujemnych białko liczy się tylko z dużym udziałem owoców/warzyw
+    protein_points = np.where((negative >= 11) & (fv_points < 5), 0, protein_points)
+    score = (negative - fv_points - fiber_points - protein_points).astype(float)
+    missing = np.isnan(energy_kj) | np.isnan(sugars) | np.isnan(saturated_fat) | np.isnan(sodium_mg)
+    score[missing] = np.nan
+    return score
+
+
+def score_to_healthy_index(score):
+    index = np.rint(np.interp(score, _SCORE_POINTS, _INDEX_POINTS))
+    return np.where(np.isnan(score), np.nan, index)
+
+
+def healthy_indexes_from_matrix(matrix: np.ndarray) -> np.ndarray:
+    """healthy_index (1-10, NaN gdy za mało danych) dla macierzy w układzie NUTRIENT_COLUMNS."""
+    (energy_kj, energy_kcal, sugars, saturated_fat, sodium, salt, fiber, proteins,
+     fruits_vegetables) = np.asarray(matrix, dtype=float).T
+    energy_kj = np.where(np.isnan(energy_kj), energy_kcal * 4.184, energy_kj)
+    sodium_mg = np.where(np.isnan(sodium), salt * 400, sodium * 1000)
+    score = nutriscore_points(energy_kj, sugars, saturated_fat, sodium_mg, fiber, proteins, fruits_vegetables)
+    return score_to_healthy_index(score)
+
+
+def healthy_indexes(nutriments_list) -> np.ndarray:
+    """healthy_index (1-10, NaN gdy za mało danych) dla listy słowników 'nutriments' z OFF."""
+    return healthy_indexes_from_matrix(nutrient_matrix(nutriments_list))
+
+
+def healthy_index(nutriments: dict):
+    """healthy_index jednego produktu albo None, gdy brakuje danych do Nutri-Score."""
+    value = healthy_indexes([nutriments])[0]
+    return None if np.isnan(value) else int(value)
+
+
+def product_healthy_index(product: dict):
+    """healthy_index produktu (Product / normalize_product): lokalny Nutri-Score, potem klasa z OFF."""
+    value = healthy_index(product.get("nutriments"))
+    if value is None:
+        value = GRADE_HEALTHY_INDEX.get((product.get("nutriscore_grade") or "").lower())
+    return value
@@ -0,0 +1,223 @@
+# off_dump_loader.py
+"""
+Ładuje eksport Open Food Facts do lokalnego indeksu (tabela OffProduct).
+
+Pełny import (JSONL albo CSV/TSV, także .gz):
+    python off_dump_loader.py openfoodfacts-products.jsonl.gz
+    python off_dump_loader.py en.openfoodfacts.org.products.csv.gz
+
+Przyrostowe odświeżenie z plików delta OFF (tylko pliki nowsze niż ostatni import):
+    python off_dump_loader.py --delta
+
+Domyślnie używa połączenia z db.get_db_connection(); --dsn pozwala wskazać inną bazę.
+Po imporcie ustaw OFF_LOOKUP_MODE=local_first (albo local_only) dla serwera.
+"""
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+import time
+
+import psycopg2
+import requests
+
+import off_index
+from config import OFF_TIMEOUT, OFF_USER_AGENT
+from openfoodfacts_api import normalize_product, NUTRIMENT_KEYS
+
+logger = logging.getLogger("server_logger")
+
+DELTA_BASE_URL = "https://static.openfoodfacts.org/data/delta/"
+BATCH_SIZE = 50000
+
+# Eksport CSV ma bardzo długie pola (ingredients_text, categories)
+csv.field_size_limit(sys.maxsize)
+
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _tags(value):
+    if value is None:
+        return None
+    return [tag for tag in value.split(",") if tag]
+
+
+def product_from_csv_row(row: dict) -> dict:
+    """Wiersz eksportu CSV -> słownik w kształcie produktu z API (tylko pola używane przez normalize_product)."""
+    nutriments = {}
+    for key in NUTRIMENT_KEYS:
+        if key.endswith("_100g"):
+            value = _float(row.get(key))
+            if value is not None:
+                nutriments[key] = value
+    # Eksport CSV nie ma wartości na porcję - liczymy je z serving_quantity (w gramach)
+    serving = _float(row.get("serving_quantity"))
+    if serving:
+        for key in ("energy-kcal", "proteins", "carbohydrates", "fat"):
+            if f"{key}_100g" in nutriments:
+                nutriments[f"{key}_serving"] = round(nutriments[f"{key}_100g"] * serving / 100, 2)
+    return {
+        "code": row.get("code"),
+        "product_name": row.get("product_name") or "No name",
+        "ingredients_text": row.get("ingredients_text") or "",
+        "image_front_url": row.get("image_url") or "no image",
+        "last_modified_t": row.get("last_modified_t"),
+        "nutriments": nutriments,
+        # Kolumna 'allergens' w eksporcie CSV zawiera tagi (en:milk,en:gluten)
+        "allergens_tags": _tags(row.get("allergens")),
+        "traces_tags": _tags(row.get("traces_tags")),
+        "ingredients_analysis_tags": _tags(row.get("ingredients_analysis_tags")),
+        "nutriscore_grade": row.get("nutriscore_grade") or None,
+    }
+
+
+def iter_jsonl(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logger.warning("Pominięto uszkodzoną linię eksportu OFF.")
+
+
+def iter_products(path):
+    """Produkty z pliku eksportu jako słowniki w kształcie odpowiedzi API OFF."""
+    with _open_text(path) as f:
+        if ".jsonl" in path or ".json" in path:
+            yield from iter_jsonl(f)
+        else:
+            # Oficjalny eksport "CSV" OFF jest rozdzielany tabulatorami
+            header = f.readline()
+            delimiter = "\t" if "\t" in header else ","
+            f.seek(0)
+            for row in csv.DictReader(f, delimiter=delimiter):
+                yield product_from_csv_row(row)
+
+
+def _rows(products, stats):
+    for product in products:
+        code = product.get("code")
+        if not code or not str(code).strip().isdigit():
+            stats["skipped"] += 1
+            continue
+        last_modified_t = int(_float(product.get("last_modified_t")) or 0)
+        stats["max_t"] = max(stats["max_t"], last_modified_t)
+        yield code, normalize_product(product), last_modified_t
+
+
+def load_products(conn, products, source: str, kind: str, batch_size: int = BATCH_SIZE) -> dict:
+    """Ładuje produkty paczkami (commit po każdej paczce) i zapisuje import w OffImport."""
+    stats = {"rows": 0, "skipped": 0, "max_t": 0}
+    cur = conn.cursor()
+    start = time.perf_counter()
+    try:
+        batch = []
+        for row in _rows(products, stats):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                stats["rows"] += off_index.copy_batch(cur, batch)
+                conn.commit()
+                batch = []
+                logger.info("OFF %s: załadowano %s produktów.", source, stats["rows"])
+        stats["rows"] += off_index.copy_batch(cur, batch)
+        off_index.record_import(cur, source, kind, stats["max_t"], stats["rows"])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def delta_files_after(up_to_t: int):
+    """Pliki delta OFF (products_<od>_<do>.json.gz) obejmujące zmiany po up_to_t, od najstarszego."""
+    response = requests.get(DELTA_BASE_URL + "index.txt", timeout=OFF_TIMEOUT,
+                            headers={"User-Agent": OFF_USER_AGENT})
+    response.raise_for_status()
+    files = []
+    for name in response.text.split():
+        try:
+            start_t, end_t = (int(x) for x in name.split(".")[0].split("_")[-2:])
+        except ValueError:
+            continue
+        if end_t > up_to_t:
+            files.append((start_t, end_t, name))
+    return sorted(files)
+
+
+def load_delta(conn, batch_size: int = BATCH_SIZE) -> list:
+    cur = conn.cursor()
+    try:
+        up_to_t = off_index.last_import_t(cur)
+    finally:
+        cur.close()
+    results = []
+    for _, end_t, name in delta_files_after(up_to_t):
+        response = requests.get(DELTA_BASE_URL + name, timeout=max(OFF_TIMEOUT, 60),
+                                headers={"User-Agent": OFF_USER_AGENT})
+        response.raise_for_status()
+        lines = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(response.content)), encoding="utf-8")
+        stats = load_products(conn, iter_jsonl(lines), name, "D", batch_size)
+        # Plik delta może nie zawierać produktu z końca zakresu - zapamiętujemy zakres z nazwy
+        if stats["max_t"] < end_t:
+            cur = conn.cursor()
+            try:
+                off_index.record_import(cur, name, "D", end_t, 0)
+                conn.commit()
+            finally:
+                cur.close()
+        results.append((name, stats))
+    return results
+
+
+def _connect(dsn):
+    if dsn:
+        return psycopg2.connect(dsn)
+    from db import get_db_connection
+    return get_db_connection()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import eksportu Open Food Facts do tabeli OffProduct.")
+    parser.add_argument("path", nargs="?", help="plik eksportu OFF (.jsonl/.csv, opcjonalnie .gz)")
+    parser.add_argument("--delta", action="store_true", help="doładuj pliki delta nowsze niż ostatni import")
+    parser.add_argument("--dsn", help="DSN Postgresa (domyślnie baza serwera z config)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    if not args.path and not args.delta:
+        parser.error("podaj plik eksportu albo --delta")
+
+    logging.basicConfig(level=logging.INFO)
+    conn = _connect(args.dsn)
+    try:
+        if args.path:
+            stats = load_products(conn, iter_products(args.path), args.path, "F", args.batch_size)
+            print(f"{args.path}: {stats['rows']} produktów ({stats['skipped']} pominiętych) "
+                  f"w {stats['seconds']:.1f} s, {stats['rows'] / max(stats['seconds'], 1e-9):.0f} wierszy/s")
+        if args.delta:
+            for name, stats in load_delta(conn, args.batch_size):
+                print(f"{name}: {stats['rows']} produktów w {stats['seconds']:.1f} s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
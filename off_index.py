@@ -0,0 +1,81 @@
+# off_index.py
+"""
+Lokalny indeks produktów Open Food Facts (tabela OffProduct) ładowany z eksportu OFF.
+Moduł zależy tylko od psycopg2 (bez config), żeby benchmark mógł działać z dowolnym DSN.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+
+STAGE_TABLE = "off_product_stage"
+
+
+def normalize_barcode(code) -> str:
+    # Endpoint przyjmuje barcode jako int, więc wiodące zera (UPC-A/EAN-13) giną - klucz ich nie ma
+    code = str(code).strip()
+    return code.lstrip("0") or "0"
+
+
+def lookup(cur, barcode):
+    cur.execute("SELECT data FROM OffProduct WHERE barcode = %s", (normalize_barcode(barcode),))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def lookup_many(cur, barcodes) -> dict:
+    keys = {normalize_barcode(b): b for b in barcodes}
+    cur.execute("SELECT barcode, data FROM OffProduct WHERE barcode = ANY(%s)", (list(keys),))
+    return {keys[barcode]: data for barcode, data in cur.fetchall()}
+
+
+def _create_stage(cur):
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGE_TABLE} (
+            barcode varchar(100) NOT NULL,
+            data jsonb NOT NULL,
+            last_modified_t bigint NOT NULL
+        );
+    """)
+    cur.execute(f"TRUNCATE {STAGE_TABLE};")
+
+
+def copy_batch(cur, rows) -> int:
+    """
+    Ładuje paczkę (barcode, data, last_modified_t) przez COPY do tabeli tymczasowej
+    i scala z OffProduct; nowsza wersja produktu (last_modified_t) wygrywa.
+    Zwraca liczbę wierszy w paczce.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    count = 0
+    for barcode, data, last_modified_t in rows:
+        writer.writerow((normalize_barcode(barcode), json.dumps(data, ensure_ascii=False), int(last_modified_t or 0)))
+        count += 1
+    if not count:
+        return 0
+    buf.seek(0)
+    _create_stage(cur)
+    cur.copy_expert(f"COPY {STAGE_TABLE} (barcode, data, last_modified_t) FROM STDIN WITH (FORMAT csv)", buf)
+    cur.execute(f"""
+        INSERT INTO OffProduct (barcode, data, last_modified_t)
+        SELECT DISTINCT ON (barcode) barcode, data, last_modified_t
+        FROM {STAGE_TABLE}
+        ORDER BY barcode, last_modified_t DESC
+        ON CONFLICT (barcode) DO UPDATE
+          SET data = EXCLUDED.data, last_modified_t = EXCLUDED.last_modified_t
+          WHERE OffProduct.last_modified_t <= EXCLUDED.last_modified_t
+    """)
+    return count
+
+
+def record_import(cur, source: str, kind: str, up_to_t: int, rows: int):
+    cur.execute("""
+        INSERT INTO OffImport (source, kind, up_to_t, rows, imported_at)
+        VALUES (%s, %s, %s, %s, %s)
+    """, (source, kind, up_to_t, rows, datetime.now()))
+
+
+def last_import_t(cur) -> int:
+    cur.execute("SELECT COALESCE(MAX(up_to_t), 0) FROM OffImport")
+    return cur.fetchone()[0]
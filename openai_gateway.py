@@ -0,0 +1,477 @@
+# openai_gateway.py
+"""
+Jedyna droga do API OpenAI (OpenAI_requests.py): limity współbieżności, tempo w granicach
+limitów konta, ponawianie, terminy i bezpiecznik.
+
+  - semafory: globalny (OPENAI_MAX_CONCURRENCY) i na model (OPENAI_MODEL_CONCURRENCY),
+  - kubełki żetonów: zapytania i tokeny na minutę (OPENAI_RPM / OPENAI_TPM, na proces),
+  - ponawianie 429 / 5xx / timeoutów / błędów połączenia z wykładniczym odstępem
+    i pełnym jitterem (albo po Retry-After z odpowiedzi),
+  - termin (deadline) całego wywołania razem z kolejką i ponowieniami; timeout pojedynczej
+    próby nie przekracza pozostałego czasu,
+  - bezpiecznik: po OPENAI_BREAKER_THRESHOLD kolejnych nieudanych wywołaniach odrzuca
+    od razu przez OPENAI_BREAKER_COOLDOWN sekund, potem przepuszcza jedną próbę,
+  - zabezpieczanie (hedging, OPENAI_HEDGE_ENABLED, wywołania z hedge=True): gdy próba
+    trwa dłużej niż percentyl OPENAI_HEDGE_PERCENTILE ostatnich czasów, wysyłamy drugą
+    identyczną i bierzemy szybszą, a wolniejszą przerywamy. Udział zabezpieczonych wywołań
+    ogranicza OPENAI_HEDGE_MAX_RATE,
+  - w żądaniu HTTP wywołanie idzie przez klienta asynchronicznego (ta sama pętla co przy
+    zabezpieczaniu), więc rozłączenie klienta (deadlines.py) przerywa je w locie.
+
+Błędy bramki (OpenAIUnavailableError) endpointy zamieniają na 503 zamiast 500.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, wait
+from contextlib import ExitStack
+
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from config import OPENAI_API_KEY, OPENAI_TIMEOUT, OPENAI_DEADLINE, OPENAI_MAX_RETRIES
+from config import OPENAI_MAX_CONCURRENCY, OPENAI_MODEL_CONCURRENCY, OPENAI_RPM, OPENAI_TPM
+from config import OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN
+from config import OPENAI_HEDGE_ENABLED, OPENAI_HEDGE_PERCENTILE, OPENAI_HEDGE_MIN_DELAY, OPENAI_HEDGE_MAX_RATE
+from config import OPENAI_HEDGE_MIN_SAMPLES
+import deadlines
+
+logger = logging.getLogger("server_logger")
+
+# Ponawianiem zajmuje się bramka, nie klient
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=OPENAI_TIMEOUT)
+
+# Szacunek tokenów zdjęcia (detail auto, ok. 512x1024 po zmniejszeniu: 6 kafelków)
+IMAGE_TOKENS = 1105
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+LATENCY_SAMPLES = 1000
+# Okno ostatnich wywołań, z którego liczymy udział zabezpieczonych (limit OPENAI_HEDGE_MAX_RATE)
+HEDGE_WINDOW = 200
+
+_RETRYABLE = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+              openai.InternalServerError)
+
+
+class OpenAIUnavailableError(Exception):
+    """OpenAI niedostępne: bezpiecznik otwarty, minął termin albo wyczerpano ponowienia."""
+
+
+class TokenBucket:
+    """Kubełek żetonów: rate na minutę, pojemność = limit minutowy."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float, deadline: float) -> float:
+        """Czeka na amount żetonów (najwyżej do deadline); zwraca czas oczekiwania."""
+        amount = min(amount, self.capacity)
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return now - start
+                wait = (amount - self._tokens) / self.rate
+            if now + wait > deadline:
+                raise OpenAIUnavailableError("Przekroczony limit zapytań do OpenAI (termin minie w kolejce).")
+            time.sleep(min(wait, 1.0))
+
+    def try_acquire(self, amount: float) -> bool:
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < amount:
+                return False
+            self._tokens -= amount
+            return True
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                return False
+            # Półotwarty - przepuszczamy jedną próbę
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release_probe(self):
+        """Próba półotwartego stanu nie doszła do OpenAI - kolejne wywołanie może spróbować."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None or self._probing:
+                    logger.error("Bezpiecznik OpenAI otwarty po %s nieudanych wywołaniach.", self._failures)
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+_global_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+_model_slots = {}
+_model_slots_lock = threading.Lock()
+_requests_bucket = TokenBucket(OPENAI_RPM)
+_tokens_bucket = TokenBucket(OPENAI_TPM)
+breaker = CircuitBreaker(OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+# Próby zabezpieczanych wywołań działają jako zadania w osobnej pętli zdarzeń (AsyncOpenAI) -
+# anulowanie zadania przegranej próby naprawdę zamyka jej połączenie
+_hedge_loop = None
+_hedge_client = None
+_hedge_lock = threading.Lock()
+_hedge_window = deque(maxlen=HEDGE_WINDOW)
+
+
+def _model_semaphore(model: str):
+    with _model_slots_lock:
+        if model not in _model_slots:
+            _model_slots[model] = threading.BoundedSemaphore(OPENAI_MODEL_CONCURRENCY.get(model, OPENAI_MAX_CONCURRENCY))
+        return _model_slots[model]
+
+
+def _model_stats(model: str) -> dict:
+    # Wywoływać pod _stats_lock
+    if model not in _stats:
+        _stats[model] = {
+            "calls": 0, "succeeded": 0, "failed": 0, "retries": 0, "rejected": 0,
+            "errors": {}, "prompt_tokens": 0, "completion_tokens": 0,
+            "queue_wait_total": 0.0, "latencies": deque(maxlen=LATENCY_SAMPLES),
+            "hedge_eligible": 0, "hedged": 0, "hedge_wins": 0, "hedge_budget_denied": 0,
+        }
+    return _stats[model]
+
+
+def _record(model: str, **changes):
+    with _stats_lock:
+        stats = _model_stats(model)
+        for key, value in changes.items():
+            if key == "latency":
+                stats["latencies"].append(value)
+            elif key == "error":
+                stats["errors"][value] = stats["errors"].get(value, 0) + 1
+            else:
+                stats[key] += value
+
+
+def latency_percentile(model: str, p: float):
+    """Percentyl p (0-1) ostatnich czasów udanych prób dla modelu albo None bez próbek."""
+    with _stats_lock:
+        samples = sorted(_model_stats(model)["latencies"])
+    if not samples:
+        return None
+    return samples[min(int(p * len(samples)), len(samples) - 1)]
+
+
+def get_openai_stats() -> dict:
+    with _stats_lock:
+        models = {}
+        for model, stats in _stats.items():
+            samples = sorted(stats["latencies"])
+
+            def percentile(p):
+                return round(samples[min(int(p * len(samples)), len(samples) - 1)], 3) if samples else 0.0
+
+            models[model] = {key: value for key, value in stats.items() if key != "latencies"}
+            models[model]["errors"] = dict(stats["errors"])
+            models[model]["queue_wait_total"] = round(stats["queue_wait_total"], 3)
+            models[model].update({
+                "latency_p50": percentile(0.50),
+                "latency_p95": percentile(0.95),
+                "latency_p99": percentile(0.99),
+                "hedge_rate": round(stats["hedged"] / stats["hedge_eligible"], 4) if stats["hedge_eligible"] else 0.0,
+                "hedge_win_rate": round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0,
+            })
+    return {"breaker": breaker.state, "hedging": OPENAI_HEDGE_ENABLED, "models": models}
+
+
+def estimate_tokens(messages, max_tokens: int) -> int:
+    """Przybliżona liczba tokenów wywołania (4 znaki na token, stała za zdjęcie) do kubełka TPM."""
+    tokens = max_tokens
+    for message in messages:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += len(part.get("text", "")) // 4
+    return tokens
+
+
+def _retry_delay(attempt: int, error) -> float:
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Pełny jitter - równoległe wywołania nie ponawiają się w tej samej chwili
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _acquire(semaphore, deadline: float):
+    if not semaphore.acquire(timeout=max(deadline - time.monotonic(), 0)):
+        raise OpenAIUnavailableError("Przekroczony limit równoległych zapytań do OpenAI.")
+
+
+def _reserve(stack: ExitStack, model: str, messages, max_tokens: int, deadline: float, blocking: bool = True) -> bool:
+    """
+    Miejsca w semaforach (zwalniane przy zamknięciu stack) i żetony dla jednej próby.
+    blocking=False - bez czekania; zwraca False, gdy czegoś brakuje.
+    """
+    start = time.monotonic()
+    for semaphore in (_global_slots, _model_semaphore(model)):
+        if blocking:
+            _acquire(semaphore, deadline)
+        elif not semaphore.acquire(blocking=False):
+            return False
+        stack.callback(semaphore.release)
+    tokens = estimate_tokens(messages, max_tokens)
+    if blocking:
+        _requests_bucket.acquire(1, deadline)
+        _tokens_bucket.acquire(tokens, deadline)
+        _record(model, queue_wait_total=time.monotonic() - start)
+    elif not (_requests_bucket.try_acquire(1) and _tokens_bucket.try_acquire(tokens)):
+        return False
+    return True
+
+
+def _attempt_timeout(deadline: float) -> float:
+    timeout = min(OPENAI_TIMEOUT, deadline - time.monotonic())
+    if timeout <= 0:
+        raise OpenAIUnavailableError("Minął termin zapytania do OpenAI.")
+    return timeout
+
+
+def _cancelled_result(future):
+    """future.result(); gdy przerwane przez rozłączenie klienta - RequestCancelled."""
+    try:
+        return future.result()
+    except CancelledError:
+        if deadlines.cancelled():
+            raise deadlines.RequestCancelled()
+        raise
+
+
+def _attempt(model: str, messages, max_tokens: int, deadline: float):
+    """Jedna próba: miejsca w semaforach, żetony, wywołanie z timeoutem w granicach terminu."""
+    with ExitStack() as slots:
+        _reserve(slots, model, messages, max_tokens, deadline)
+        if deadlines.cancellable():
+            # W żądaniu HTTP przez klienta asynchronicznego - rozłączenie klienta przerywa wywołanie
+            future = _submit(model, messages, max_tokens, deadline)
+            with deadlines.on_cancel(future.cancel):
+                response, latency = _cancelled_result(future)
+            _record(model, latency=latency)
+            return response
+        timeout = _attempt_timeout(deadline)
+        call_start = time.monotonic()
+        response = client.with_options(timeout=timeout).chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens
+        )
+        _record(model, latency=time.monotonic() - call_start)
+        return response
+
+
+def _event_loop():
+    global _hedge_loop
+    with _hedge_lock:
+        if _hedge_loop is None:
+            _hedge_loop = asyncio.new_event_loop()
+            threading.Thread(target=_hedge_loop.run_forever, name="openai-hedge", daemon=True).start()
+        return _hedge_loop
+
+
+async def _async_call(model: str, messages, max_tokens: int, timeout: float):
+    global _hedge_client
+    if _hedge_client is None:
+        # Tworzony w pętli zabezpieczania, ten sam adres i klucz co klient synchroniczny
+        _hedge_client = AsyncOpenAI(api_key=client.api_key, base_url=client.base_url, max_retries=0,
+                                    timeout=OPENAI_TIMEOUT)
+    start = time.monotonic()
+    response = await _hedge_client.with_options(timeout=timeout).chat.completions.create(
+        model=model, messages=messages, max_tokens=max_tokens
+    )
+    return response, time.monotonic() - start
+
+
+def _submit(model: str, messages, max_tokens: int, deadline: float):
+    coroutine = _async_call(model, messages, max_tokens, _attempt_timeout(deadline))
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop())
+
+
+def _hedge_delay(model: str):
+    """Po ilu sekundach wysłać drugą próbę; None - bez zabezpieczania (za mało próbek)."""
+    with _stats_lock:
+        samples = len(_model_stats(model)["latencies"])
+    if samples < OPENAI_HEDGE_MIN_SAMPLES:
+        return None
+    return max(latency_percentile(model, OPENAI_HEDGE_PERCENTILE), OPENAI_HEDGE_MIN_DELAY)
+
+
+def _hedge_allowed() -> bool:
+    with _hedge_lock:
+        return sum(_hedge_window) < OPENAI_HEDGE_MAX_RATE * max(len(_hedge_window), 1)
+
+
+def _hedged_attempt(model: str, messages, max_tokens: int, deadline: float):
+    """
+    Próba z zabezpieczeniem: po _hedge_delay druga identyczna, wygrywa pierwsza udana
+    odpowiedź, przegrana jest anulowana. Druga próba nie czeka w kolejce - gdy brak
+    wolnego miejsca, żetonów albo budżetu (OPENAI_HEDGE_MAX_RATE), czekamy na pierwszą.
+    """
+    delay = _hedge_delay(model)
+    if delay is None:
+        return _attempt(model, messages, max_tokens, deadline)
+    _record(model, hedge_eligible=1)
+
+    futures = {}
+
+    def cancel_all():
+        for future in list(futures):
+            future.cancel()
+
+    with ExitStack() as primary_slots, ExitStack() as hedge_slots, deadlines.on_cancel(cancel_all):
+        _reserve(primary_slots, model, messages, max_tokens, deadline)
+        futures[_submit(model, messages, max_tokens, deadline)] = "primary"
+        done, _ = wait(futures, timeout=min(delay, max(deadline - time.monotonic(), 0)))
+        hedged = False
+        if not done:
+            if _hedge_allowed() and _reserve(hedge_slots, model, messages, max_tokens, deadline, blocking=False):
+                futures[_submit(model, messages, max_tokens, deadline)] = "hedge"
+                hedged = True
+                _record(model, hedged=1)
+            else:
+                _record(model, hedge_budget_denied=1)
+        with _hedge_lock:
+            _hedge_window.append(hedged)
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response, latency = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                _record(model, latency=latency)
+                if futures[future] == "hedge":
+                    _record(model, hedge_wins=1)
+                return response
+        if isinstance(error, CancelledError) and deadlines.cancelled():
+            raise deadlines.RequestCancelled()
+        raise error
+
+
+def chat_completion(model: str, messages, max_tokens: int, deadline: float = None, hedge: bool = False):
+    """
+    chat.completions.create przez bramkę. deadline to time.monotonic(), do którego musi
+    zakończyć się całe wywołanie (domyślnie teraz + OPENAI_DEADLINE, najpóźniej termin
+    żądania HTTP z deadlines.py). hedge=True - wywołanie
+    może być zabezpieczone drugą próbą (gdy OPENAI_HEDGE_ENABLED).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + OPENAI_DEADLINE
+    deadline = deadlines.clamp(deadline)
+    if deadlines.cancelled():
+        deadlines.count("openai_calls_skipped")
+        raise deadlines.RequestCancelled()
+    if not breaker.allow():
+        _record(model, rejected=1)
+        raise OpenAIUnavailableError("OpenAI chwilowo niedostępne (bezpiecznik otwarty).")
+    _record(model, calls=1)
+
+    attempt = 0
+    while True:
+        try:
+            if hedge and OPENAI_HEDGE_ENABLED:
+                response = _hedged_attempt(model, messages, max_tokens, deadline)
+            else:
+                response = _attempt(model, messages, max_tokens, deadline)
+        except _RETRYABLE as e:
+            _record(model, error=type(e).__name__)
+            if deadlines.expired() or deadlines.cancelled():
+                # Próbę skrócił termin żądania HTTP - to nie świadczy o stanie OpenAI
+                _record(model, failed=1)
+                breaker.release_probe()
+                raise OpenAIUnavailableError("Minął termin żądania.") from e
+            delay = _retry_delay(attempt, e)
+            attempt += 1
+            if attempt > OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                _record(model, failed=1)
+                breaker.record_failure()
+                raise OpenAIUnavailableError(f"OpenAI nie odpowiedziało poprawnie: {e}") from e
+            logger.warning("OpenAI (%s): %s, ponowienie %s za %.2f s.", model, type(e).__name__, attempt, delay)
+            _record(model, retries=1)
+            time.sleep(delay)
+            continue
+        except deadlines.RequestCancelled:
+            # Klient się rozłączył - wywołanie przerwane po naszej stronie
+            deadlines.count("openai_calls_cancelled")
+            _record(model, failed=1, error="cancelled")
+            breaker.release_probe()
+            raise
+        except OpenAIUnavailableError:
+            # Kolejka/termin po naszej stronie - nie świadczy o stanie OpenAI
+            _record(model, failed=1, error="deadline")
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            # Błędy żądania (400, 401...) - OpenAI odpowiada, nie ponawiamy i nie otwieramy bezpiecznika
+            _record(model, failed=1, error=type(e).__name__)
+            breaker.record_success()
+            raise
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            _record(model, prompt_tokens=usage.prompt_tokens or 0, completion_tokens=usage.completion_tokens or 0)
+        _record(model, succeeded=1)
+        breaker.record_success()
+        return response
+
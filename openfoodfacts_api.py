@@ -1,49 +1,237 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 import requests
+from psycopg2.extras import Json
+
+from cache import TTLCache
+from config import OFF_TIMEOUT, OFF_USER_AGENT, OFF_LOOKUP_MODE
+from config import PRODUCT_CACHE_TTL, PRODUCT_CACHE_NEGATIVE_TTL, PRODUCT_CACHE_STALE_TTL
+from config import PRODUCT_CACHE_LOCAL_SIZE, PRODUCT_CACHE_LOCAL_TTL
+from db import get_db_connection
+import deadlines
+import off_index
+from pipeline import cursor_lock
+
+logger = logging.getLogger("server_logger")
+
+OFF_PRODUCT_URL = "https://world.openfoodfacts.org/api/v2/product/{barcode}.json"
+
+
+class OpenFoodFactsError(Exception):
+    """Open Food Facts nie odpowiedział poprawnie (sieć, timeout, 5xx)."""
+
+
+# Sesja HTTP utrzymuje połączenie keep-alive z OFF między skanami
+_http = requests.Session()
+_http.headers["User-Agent"] = OFF_USER_AGENT
+
+# barcode -> (found, data, fetched_at jako epoch); przed tabelą ProductCache
+_local_cache = TTLCache(PRODUCT_CACHE_LOCAL_SIZE, PRODUCT_CACHE_LOCAL_TTL)
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="off-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+# Trzymamy tylko potrzebne wartości odżywcze - pełny słownik OFF ma setki kluczy
+NUTRIMENT_KEYS = (
+    "energy-kcal_serving", "proteins_serving", "carbohydrates_serving", "fat_serving",
+    "energy-kcal_100g", "energy_100g", "proteins_100g", "carbohydrates_100g", "fat_100g",
+    "sugars_100g", "saturated-fat_100g", "sodium_100g", "salt_100g", "fiber_100g",
+    "fruits-vegetables-nuts_100g", "fruits-vegetables-nuts-estimate_100g",
+    "fruits-vegetables-nuts-estimate-from-ingredients_100g",
+)
 
 
+def normalize_product(product: dict) -> dict:
+    # OFF zwraca też jawne null ("product_name": null) - wtedy get() z domyślną wartością nie wystarcza
+    nutriments = product.get("nutriments") or {}
+    return {
+        "name": product.get("product_name") or "No name",
+        "kcal": nutriments.get("energy-kcal_serving", 0),
+        "proteins": nutriments.get("proteins_serving", 0),
+        "carbs": nutriments.get("carbohydrates_serving", 0),
+        "fats": nutriments.get("fat_serving", 0),
+        "ingredients": product.get("ingredients_text") or "",
+        "image_url": product.get("image_front_url", "no image"),
+        "nutriments": {k: nutriments[k] for k in NUTRIMENT_KEYS if k in nutriments},
+        # None = OFF nie ma danych; pusta lista zwykle też (diet_rules.py nie uznaje jej za brak alergenów)
+        "allergens_tags": product.get("allergens_tags"),
+        "traces_tags": product.get("traces_tags"),
+        "ingredients_analysis_tags": product.get("ingredients_analysis_tags"),
+        "nutriscore_grade": product.get("nutriscore_grade"),
+    }
 
 
-def getInfoFromOpenFoodsApi(barcode):
+def _check_deadline(error):
+    # Timeout skrócony terminem żądania - 504 zamiast "OFF niedostępne" / "brak produktu"
+    if isinstance(error, requests.Timeout) and deadlines.expired():
+        raise deadlines.DeadlineExceeded() from error
+
+
+def fetch_product(barcode):
+    """
+    Pobiera produkt bezpośrednio z Open Food Facts.
+    Zwraca znormalizowany słownik albo None, gdy OFF nie zna kodu kreskowego.
+    """
     try:
-        # Build the URL with the provided barcode
-        json_file = f"https://world.openfoodfacts.org/api/v2/product/{barcode}.json"
+        response = _http.get(OFF_PRODUCT_URL.format(barcode=barcode), timeout=deadlines.budget(OFF_TIMEOUT))
+    except requests.RequestException as e:
+        _check_deadline(e)
+        raise OpenFoodFactsError(str(e))
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise OpenFoodFactsError(f"status {response.status_code}")
+    data = response.json()
+    if data.get("status") != 1 or not data.get("product"):
+        return None
+    return normalize_product(data["product"])
 
-        # Pobranie danych z URL
-        response = requests.get(json_file)
-        response.raise_for_status()  # Raise an error for bad status codes
-        data = response.json()
-    except Exception as e:
-        print("Wystąpił błąd podczas pobierania danych:", e)
+
+def fetch_image(url):
+    """Pobiera zdjęcie produktu z serwera obrazów OFF. Zwraca (bajty, content-type)."""
+    try:
+        response = _http.get(url, timeout=deadlines.budget(OFF_TIMEOUT))
+    except requests.RequestException as e:
+        _check_deadline(e)
+        raise OpenFoodFactsError(str(e))
+    if response.status_code != 200:
+        raise OpenFoodFactsError(f"status {response.status_code}")
+    return response.content, response.headers.get("Content-Type", "image/jpeg")
+
+
+def _load_entry(cur, barcode: str):
+    cur.execute("SELECT found, data, fetched_at FROM ProductCache WHERE barcode = %s", (barcode,))
+    row = cur.fetchone()
+    if row is None:
         return None
+    found, data, fetched_at = row
+    return found, data, fetched_at.timestamp()
 
-    # Pobranie informacji o produkcie
-    product = data.get("product", {})
-    name = product.get("product_name", "No name")
 
-    nutriments = product.get("nutriments", {})
-    kcal = nutriments.get("energy-kcal_serving", 0)
-    proteins = nutriments.get("proteins_serving", 0)
-    carbs = nutriments.get("carbohydrates_serving", 0)
-    fats = nutriments.get("fat_serving", 0)
+def _store_entry(cur, barcode: str, data):
+    now = datetime.now()
+    cur.execute("""
+        INSERT INTO ProductCache (barcode, found, data, fetched_at)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (barcode) DO UPDATE
+          SET found = EXCLUDED.found, data = EXCLUDED.data, fetched_at = EXCLUDED.fetched_at
+    """, (barcode, data is not None, Json(data) if data is not None else None, now))
+    _local_cache.set(barcode, (data is not None, data, now.timestamp()))
 
-    sklad = product.get("ingredients_text", [])
-    image_front_url = product.get("image_front_url", "no image")
 
-    # Wyświetlenie danych
-    # print("Nazwa:", name)
-    # print("Kcal:", kcal)
-    # print("Proteins:", proteins)
-    # print("Carbs:", carbs)
-    # print("Fats:", fats)
-    # print("Skład:", sklad)
-    # print("Image Front URL:", image_front_url)
+def _with_cursor(cur, fn, *args):
+    if cur is not None:
+        # Kursor żądania - w etapie pipeline.py tylko na czas zapytania, bez wywołań sieciowych
+        with cursor_lock():
+            return fn(cur, *args)
+    conn = get_db_connection()
+    own_cur = conn.cursor()
+    try:
+        result = fn(own_cur, *args)
+        conn.commit()
+        return result
+    finally:
+        own_cur.close()
+        conn.close()
+
+
+def _fetch_from_sources(cur, barcode: str):
+    if OFF_LOOKUP_MODE != "online":
+        data = _with_cursor(cur, off_index.lookup, barcode)
+        if data is not None or OFF_LOOKUP_MODE == "local_only":
+            return data
+    return fetch_product(barcode)
+
+
+def _refresh(barcode: str):
+    try:
+        # Połączenie z puli tylko na zapytania, nie na czas odpowiedzi OFF
+        _with_cursor(None, _store_entry, barcode, _fetch_from_sources(None, barcode))
+        logger.info("Odświeżono w tle produkt %s z Open Food Facts.", barcode)
+    except Exception as e:
+        logger.warning("Nie udało się odświeżyć produktu %s: %s", barcode, e)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(barcode)
+
+
+def _schedule_refresh(barcode: str):
+    with _refreshing_lock:
+        if barcode in _refreshing:
+            return
+        _refreshing.add(barcode)
+    _refresh_executor.submit(_refresh, barcode)
+
+
+def get_product(barcode, cur=None):
+    """
+    Produkt z cache (LRU w procesie -> tabela ProductCache -> lokalny indeks OffProduct
+    i/lub API Open Food Facts, zależnie od OFF_LOOKUP_MODE).
+
+    - wpis młodszy niż TTL (PRODUCT_CACHE_TTL, dla nieznanych kodów PRODUCT_CACHE_NEGATIVE_TTL)
+      jest zwracany od razu,
+    - wpis przeterminowany, ale młodszy niż TTL + PRODUCT_CACHE_STALE_TTL, też jest zwracany,
+      a odświeżenie idzie w tle (stale-while-revalidate),
+    - starszy albo brakujący wpis jest pobierany z OFF; gdy OFF nie odpowiada, zwracamy
+      przeterminowany wpis, jeśli jakikolwiek mamy.
+    Zwraca słownik produktu albo None dla kodu nieznanego w OFF.
+    """
+    barcode = str(barcode)
+    entry = _local_cache.get(barcode)
+    if entry is None:
+        entry = _with_cursor(cur, _load_entry, barcode)
+        if entry is not None:
+            _local_cache.set(barcode, entry)
+
+    if entry is not None:
+        found, data, fetched_at = entry
+        age = time.time() - fetched_at
+        ttl = PRODUCT_CACHE_TTL if found else PRODUCT_CACHE_NEGATIVE_TTL
+        if age < ttl:
+            return data
+        if age < ttl + PRODUCT_CACHE_STALE_TTL:
+            _schedule_refresh(barcode)
+            return data
+
+    try:
+        data = _fetch_from_sources(cur, barcode)
+    except OpenFoodFactsError as e:
+        if entry is not None:
+            logger.warning("Open Food Facts niedostępne (%s), używam starego wpisu dla %s.", e, barcode)
+            return entry[1]
+        raise
+    _with_cursor(cur, _store_entry, barcode, data)
+    return data
+
+
+def getInfoFromOpenFoodsApi(barcode, cur=None):
+    try:
+        product = get_product(barcode, cur)
+    except Exception as e:
+        logger.error("Wystąpił błąd podczas pobierania danych z Open Food Facts: %s", e)
+        return None
+    if product is None:
+        return None
 
-    return name, kcal, proteins, carbs, fats, sklad, image_front_url
+    return (
+        product["name"],
+        product["kcal"],
+        product["proteins"],
+        product["carbs"],
+        product["fats"],
+        product["ingredients"],
+        product["image_url"],
+    )
 
 
 if __name__ == '__main__':
     # getInfoFromOpenFoodsApi("5000112651324")
     # print()
     # getInfoFromOpenFoodsApi("5901939103372")
-    print(getInfoFromOpenFoodsApi("5901939103273"))
-    print(getInfoFromOpenFoodsApi("5900497312004"))
\ No newline at end of file
+    print(fetch_product("5901939103273"))
+    print(fetch_product("5900497312004"))
@@ -0,0 +1,63 @@
+# ops.py
+"""
+Statystyki operacyjne bieżącego procesu pod /<nazwa>_stats: pula bazy, grodzie, bramka
+OpenAI, kolejka zadań zdjęć, zdarzenia, etapy żądań, anulowania i przesłane zdjęcia.
+
+Zawierają stan bezpiecznika, zużycie tokenów i treść błędów, więc wymagają nagłówka
+X-Ops-Token równego OPS_TOKEN z sekretów; bez skonfigurowanego tokena trasy odpowiadają
+404, jakby ich nie było. Trasy są asynchroniczne - odpowiadają także przy pełnych grodziach.
+"""
+import hmac
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from config import OPS_TOKEN
+from analysis_cache import get_analysis_cache_stats
+from bulkheads import get_bulkhead_stats
+from db import get_pool_stats
+from deadlines import get_cancellation_stats
+from diet_rules import get_rule_stats
+from events import get_event_stats
+from meal_jobs import get_job_stats
+from openai_gateway import get_openai_stats
+from pipeline import get_pipeline_stats
+from uploads import get_upload_stats
+
+
+def require_ops_token(x_ops_token: str = Header(None)):
+    if not OPS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_ops_token is None or not hmac.compare_digest(x_ops_token.encode(), OPS_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Brak dostępu.")
+
+
+def _analysis_cache_stats():
+    # Trafienia cache analiz kodów kreskowych i skany rozstrzygnięte regułami
+    stats = get_analysis_cache_stats()
+    stats["rules"] = get_rule_stats()
+    return stats
+
+
+STATS = {
+    "db_pool": get_pool_stats,
+    "analysis_cache": _analysis_cache_stats,
+    "meal_job": get_job_stats,
+    "bulkhead": get_bulkhead_stats,
+    "upload": get_upload_stats,
+    "openai": get_openai_stats,
+    "cancellation": get_cancellation_stats,
+    "pipeline": get_pipeline_stats,
+    "event": get_event_stats,
+}
+
+router = APIRouter(dependencies=[Depends(require_ops_token)], include_in_schema=False)
+
+
+def _stats_route(get_stats):
+    async def stats():
+        return get_stats()
+    return stats
+
+
+for _name, _get_stats in STATS.items():
+    router.add_api_route(f"/{_name}_stats", _stats_route(_get_stats), methods=["GET"], name=f"{_name}_stats")
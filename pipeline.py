@@ -0,0 +1,153 @@
+# pipeline.py
+"""
+Wykonawca etapów żądania jako grafu zależności (add_meal_from_photo, add_meal_from_barcode).
+
+Etap to funkcja, której argumentami są wyniki etapów z deps. Etapy bez wzajemnych
+zależności działają równolegle w puli wątków (np. zapis oryginału do S3 obok zmniejszania
+zdjęcia i zapytania do OpenAI), więc czas żądania zbliża się do najdłuższej ścieżki grafu
+zamiast sumy etapów. Etapy z db=True korzystają z kursora żądania - psycopg2 nie pozwala
+na równoległe użycie jednego połączenia, więc wykonują się po kolei (blokada na przebieg).
+Etap, który przeplata zapytania z wywołaniami sieciowymi (OFF, OpenAI), nie ma db=True -
+jego kod bierze tę samą blokadę tylko na czas zapytań: with cursor_lock().
+
+Czas każdego etapu trafia do statystyk (/pipeline_stats) i do logu żądania. Po terminie
+żądania albo rozłączeniu klienta (deadlines.py) kolejne etapy nie startują.
+"""
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+from config import PIPELINE_WORKERS
+import deadlines
+
+logger = logging.getLogger("server_logger")
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+_stats_lock = threading.Lock()
+_stats = {}
+# Blokada kursora bieżącego przebiegu run_stages (widoczna w wątkach etapów)
+_cursor_lock = contextvars.ContextVar("pipeline_cursor_lock", default=None)
+
+
+class Stage:
+    def __init__(self, name: str, fn, deps=(), db: bool = False):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.db = db
+
+
+@contextmanager
+def cursor_lock():
+    """Wyłączny dostęp do kursora żądania w etapie bez db=True; poza run_stages nic nie robi."""
+    lock = _cursor_lock.get()
+    if lock is None:
+        yield
+        return
+    with lock:
+        yield
+
+
+def _record(pipeline: str, wall: float, timings: dict):
+    with _stats_lock:
+        stats = _stats.setdefault(pipeline, {"runs": 0, "wall_total": 0.0, "wall_max": 0.0, "stages": {}})
+        stats["runs"] += 1
+        stats["wall_total"] += wall
+        stats["wall_max"] = max(stats["wall_max"], wall)
+        for name, (_, duration) in timings.items():
+            stage = stats["stages"].setdefault(name, {"runs": 0, "total": 0.0, "max": 0.0})
+            stage["runs"] += 1
+            stage["total"] += duration
+            stage["max"] = max(stage["max"], duration)
+
+
+def get_pipeline_stats() -> dict:
+    with _stats_lock:
+        result = {}
+        for pipeline, stats in _stats.items():
+            runs = stats["runs"]
+            stages = {name: {"runs": s["runs"], "avg_ms": round(s["total"] / s["runs"] * 1000, 1),
+                             "max_ms": round(s["max"] * 1000, 1)} for name, s in stats["stages"].items()}
+            result[pipeline] = {
+                "runs": runs,
+                "wall_avg_ms": round(stats["wall_total"] / runs * 1000, 1) if runs else 0.0,
+                "wall_max_ms": round(stats["wall_max"] * 1000, 1),
+                # Suma średnich etapów - ile trwałoby żądanie, gdyby etapy szły po kolei
+                "sequential_avg_ms": round(sum(s["avg_ms"] for s in stages.values()), 1),
+                "stages": stages,
+            }
+        return result
+
+
+def run_stages(pipeline: str, stages) -> dict:
+    """
+    Wykonuje etapy zgodnie z zależnościami i zwraca {nazwa: wynik}. Przy błędzie etapu
+    nowe etapy nie startują, trwające są dokańczane, a wyjątek leci do wywołującego.
+    """
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        missing = [dep for dep in stage.deps if dep not in stages]
+        if missing:
+            raise ValueError(f"Etap {stage.name} zależy od nieznanych etapów: {missing}")
+
+    # RLock - etap z db=True może wywołać kod, który sam bierze cursor_lock()
+    db_lock = threading.RLock()
+    results, timings = {}, {}
+    start = time.perf_counter()
+    lock_token = _cursor_lock.set(db_lock)
+
+    def execute(stage, args):
+        stage_start = time.perf_counter()
+        if stage.db:
+            with db_lock:
+                result = stage.fn(*args)
+        else:
+            result = stage.fn(*args)
+        timings[stage.name] = (stage_start - start, time.perf_counter() - stage_start)
+        return result
+
+    try:
+        waiting = dict(stages)
+        running = {}
+        error = None
+        while waiting or running:
+            if error is None and waiting:
+                # Po terminie żądania albo rozłączeniu klienta nie zaczynamy kolejnych etapów
+                try:
+                    deadlines.check()
+                except Exception as e:
+                    error = e
+            if error is None:
+                for name, stage in list(waiting.items()):
+                    if all(dep in results for dep in stage.deps):
+                        del waiting[name]
+                        args = [results[dep] for dep in stage.deps]
+                        # Kontekst żądania (np. termin) przechodzi do wątków etapów
+                        context = contextvars.copy_context()
+                        running[_executor.submit(context.run, execute, stage, args)] = name
+            if not running:
+                if error is None and waiting:
+                    raise ValueError(f"Cykl zależności między etapami: {sorted(waiting)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    error = error or e
+    finally:
+        _cursor_lock.reset(lock_token)
+    wall = time.perf_counter() - start
+    _record(pipeline, wall, timings)
+    if waiting and deadlines.cancelled():
+        deadlines.count("stages_skipped", len(waiting))
+    logger.info("Etapy %s (%.0f ms): %s", pipeline, wall * 1000,
+                ", ".join(f"{name} +{offset * 1000:.0f}/{duration * 1000:.0f} ms"
+                          for name, (offset, duration) in sorted(timings.items(), key=lambda item: item[1][0])))
+    if error is not None:
+        raise error
+    return results
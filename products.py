@@ -0,0 +1,77 @@
+# products.py
+"""
+Wspólna dla wszystkich użytkowników tabela Product - jeden wiersz na kod kreskowy.
+
+Pierwsze zeskanowanie produktu pobiera dane z Open Food Facts (przez cache produktów)
+i kopiuje zdjęcie OFF do S3 pod stałym kluczem (bez zdjęcia OFF img_link zostaje NULL);
+kolejne skany, także innych użytkowników, to tylko odczyt z bazy. Meal.bar_code wskazuje na Product.barcode.
+"""
+import logging
+import mimetypes
+from datetime import datetime
+
+from psycopg2.extras import Json
+
+from config import S3_BUCKET_NAME
+from openfoodfacts_api import fetch_image, OpenFoodFactsError
+
+logger = logging.getLogger("server_logger")
+
+PRODUCT_IMAGE_PREFIX = "products/"
+
+_COLUMNS = ("barcode", "name", "kcal", "proteins", "carbs", "fats", "ingredients", "img_link",
+            "nutriments", "allergens_tags", "traces_tags", "ingredients_analysis_tags", "nutriscore_grade")
+
+
+def load_product(cur, barcode: str):
+    cur.execute(f"SELECT {', '.join(_COLUMNS)} FROM Product WHERE barcode = %s", (barcode,))
+    row = cur.fetchone()
+    return dict(zip(_COLUMNS, row)) if row else None
+
+
+def _name(data: dict) -> str:
+    # Wpisy ProductCache sprzed poprawki normalize_product mogą mieć name = null
+    return (data.get("name") or "No name")[:255]
+
+
+def product_from_data(barcode: str, data: dict) -> dict:
+    """Słownik w kształcie wiersza Product z danych OFF (przed zapisem; img_link jeszcze nieznany)."""
+    product = {column: data.get(column) for column in _COLUMNS}
+    product.update(barcode=barcode, name=_name(data), ingredients=data.get("ingredients") or "", img_link=None)
+    return product
+
+
+def mirror_image(s3, barcode: str, image_url):
+    """
+    Kopiuje zdjęcie produktu z OFF do S3 (klucz stały dla kodu kreskowego) i zwraca klucz.
+    None, gdy OFF nie ma zdjęcia albo jest niedostępne - zdjęcie użytkownika nigdy nie trafia
+    do wspólnego Product (zostaje przy jego posiłku).
+    """
+    if not (image_url and image_url.startswith("http")):
+        return None
+    try:
+        body, content_type = fetch_image(image_url)
+    except OpenFoodFactsError as e:
+        logger.warning("Nie udało się pobrać zdjęcia OFF dla %s: %s", barcode, e)
+        return None
+    ext = mimetypes.guess_extension(content_type.split(";")[0]) or ".jpg"
+    key = f"{PRODUCT_IMAGE_PREFIX}{barcode}{ext}"
+    s3.put_object(Bucket=S3_BUCKET_NAME, Key=key, Body=body, ContentType=content_type)
+    return key
+
+
+def store_product(cur, barcode: str, data: dict, img_link: str) -> dict:
+    """Zapisuje produkt z danych OFF i zwraca wiersz Product."""
+    # Równoległy pierwszy skan mógł już wstawić wiersz - klucz S3 jest ten sam, więc nic nie tracimy
+    cur.execute("""
+        INSERT INTO Product (barcode, name, kcal, proteins, carbs, fats, ingredients, img_link,
+                             off_image_url, created_at, nutriments, allergens_tags, traces_tags,
+                             ingredients_analysis_tags, nutriscore_grade)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (barcode) DO NOTHING
+    """, (barcode, _name(data), data["kcal"], data["proteins"], data["carbs"], data["fats"],
+          data.get("ingredients") or "", img_link, data.get("image_url"), datetime.now(),
+          Json(data.get("nutriments") or {}), data.get("allergens_tags"), data.get("traces_tags"),
+          data.get("ingredients_analysis_tags"), data.get("nutriscore_grade")))
+    logger.info("Dodano produkt %s do tabeli Product.", barcode)
+    return load_product(cur, barcode)
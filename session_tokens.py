@@ -0,0 +1,84 @@
+# session_tokens.py
+import time
+import logging
+
+from fastapi import HTTPException
+from jose import jwt
+
+from cache import TTLCache
+from config import SESSION_SIGNING_KEYS, SESSION_ACTIVE_KID, SESSION_TOKEN_ISSUER, SESSION_TOKEN_TTL
+from config import SESSION_VERSION_CACHE_TTL, USER_CACHE_SIZE
+
+logger = logging.getLogger("server_logger")
+
+_session_versions = TTLCache(USER_CACHE_SIZE, SESSION_VERSION_CACHE_TTL)
+
+
+def session_tokens_enabled() -> bool:
+    return bool(SESSION_ACTIVE_KID) and SESSION_ACTIVE_KID in SESSION_SIGNING_KEYS
+
+
+def is_session_token(claims: dict) -> bool:
+    return claims.get("iss") == SESSION_TOKEN_ISSUER
+
+
+def issue_session_token(user_id: int, session_version: int, identity: dict):
+    """
+    Wydaje token HS256 z wewnętrznym user_id na podstawie zweryfikowanego tokena Cognito/Apple.
+    Zwraca (token, czas ważności w sekundach).
+    """
+    now = int(time.time())
+    exp = now + SESSION_TOKEN_TTL
+    # Sesja nie może przeżyć tokena dostawcy tożsamości, z którego powstała
+    if identity.get("exp"):
+        exp = min(exp, int(identity["exp"]))
+    claims = {
+        "iss": SESSION_TOKEN_ISSUER,
+        "sub": identity["sub"],
+        "idp": identity["iss"],
+        "email": identity.get("email", ""),
+        "uid": user_id,
+        "sv": session_version,
+        "iat": now,
+        "exp": exp,
+    }
+    token = jwt.encode(claims, SESSION_SIGNING_KEYS[SESSION_ACTIVE_KID], algorithm="HS256",
+                       headers={"kid": SESSION_ACTIVE_KID})
+    return token, exp - now
+
+
+def verify_session_token(token: str, kid) -> dict:
+    secret = SESSION_SIGNING_KEYS.get(kid)
+    if secret is None:
+        logger.error("Token sesyjny z nieznanym kid: %s", kid)
+        raise HTTPException(status_code=401, detail="Nieprawidłowy token sesyjny (kid).")
+    try:
+        return jwt.decode(token, secret, algorithms=["HS256"], issuer=SESSION_TOKEN_ISSUER,
+                          options={"verify_aud": False})
+    except Exception as e:
+        logger.error("Token sesyjny niepoprawny: %s", e)
+        raise HTTPException(status_code=401, detail=f"Token sesyjny niepoprawny: {str(e)}")
+
+
+def get_session_version(cur, user_id: int):
+    version = _session_versions.get(user_id)
+    if version is None:
+        cur.execute('SELECT session_version FROM "User" WHERE ID = %s', (user_id,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        version = row[0]
+        _session_versions.set(user_id, version)
+    return version
+
+
+def check_session_token(cur, claims: dict):
+    if get_session_version(cur, claims["uid"]) != claims.get("sv"):
+        logger.warning("Odrzucono unieważniony token sesyjny dla user_id: %s", claims["uid"])
+        raise HTTPException(status_code=401, detail="Sesja została unieważniona.")
+
+
+def revoke_user_sessions(cur, user_id: int):
+    """Unieważnia wszystkie wydane tokeny sesyjne użytkownika (w transakcji wywołującego)."""
+    cur.execute('UPDATE "User" SET session_version = session_version + 1 WHERE ID = %s', (user_id,))
+    _session_versions.pop(user_id)
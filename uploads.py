@@ -0,0 +1,199 @@
+# uploads.py
+"""
+Zdjęcia z formularzy add_meal_from_photo i add_meal_from_barcode bez trzymania całego
+pliku w pamięci.
+
+  - UploadLimitMiddleware odrzuca (413) treść żądania większą niż UPLOAD_MAX_BYTES plus
+    pola formularza: od razu po nagłówku Content-Length, a bez niego w trakcie odbioru,
+    więc parser formularza Starlette nie zapisze więcej niż limit,
+  - spool_upload() przepisuje plik z formularza kawałkami (UPLOAD_CHUNK_BYTES) do pliku
+    tymczasowego - w pamięci do UPLOAD_SPOOL_BYTES, dalej na dysku - i po drodze liczy
+    SHA-256 (metadana obiektu w S3),
+  - wymiary zdjęcia są czytane z nagłówka, bez dekodowania pikseli; powyżej
+    UPLOAD_MAX_PIXELS zdjęcie jest odrzucane (bomba dekompresyjna: mały plik, gigabajty
+    po zdekodowaniu),
+  - oryginał idzie do S3 strumieniem z pliku (multipart od UPLOAD_MULTIPART_BYTES, części
+    po kolei w wątku żądania - termin i rozłączenie klienta sprawdzane przed każdą częścią),
+    a do images.prepare jako ścieżka pliku na dysku (procesy puli otwierają go same).
+"""
+import hashlib
+import io
+import logging
+import tempfile
+import threading
+
+from boto3.s3.transfer import TransferConfig
+from fastapi import HTTPException, UploadFile, File
+from fastapi.responses import JSONResponse
+from PIL import Image, UnidentifiedImageError
+
+from config import UPLOAD_MAX_BYTES, UPLOAD_MAX_PIXELS, UPLOAD_SPOOL_BYTES, UPLOAD_CHUNK_BYTES, UPLOAD_MULTIPART_BYTES
+
+logger = logging.getLogger("server_logger")
+
+# Zapas na pozostałe pola formularza i nagłówki części multipart
+FORM_OVERHEAD = 64 * 1024
+TOO_LARGE = f"Zdjęcie jest większe niż {UPLOAD_MAX_BYTES // (1024 * 1024)} MB."
+
+_transfer_config = TransferConfig(multipart_threshold=UPLOAD_MULTIPART_BYTES,
+                                  multipart_chunksize=UPLOAD_MULTIPART_BYTES, use_threads=False)
+_stats_lock = threading.Lock()
+_stats = {
+    "uploads": 0,
+    "bytes": 0,
+    "spooled_to_disk": 0,
+    "rejected_too_large": 0,
+    "rejected_dimensions": 0,
+    "rejected_invalid": 0,
+}
+
+
+def _count(key: str, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def get_upload_stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+
+class UploadLimitMiddleware:
+    """Middleware ASGI: limit rozmiaru treści żądania, zanim przeczyta ją parser formularza."""
+
+    def __init__(self, app, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes + FORM_OVERHEAD
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            _count("rejected_too_large")
+            response = JSONResponse(status_code=413, content={"detail": TOO_LARGE})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Wyjątek z receive przechodzi przez parser formularza do obsługi HTTPException
+                    _count("rejected_too_large")
+                    raise HTTPException(status_code=413, detail=TOO_LARGE)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class SpooledUpload:
+    """Przesłane zdjęcie: rozmiar, SHA-256, wymiary i plik tymczasowy (zamknięcie go usuwa)."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.size = 0
+        self.sha256 = None
+        self.width = None
+        self.height = None
+        self._buffer = io.BytesIO()
+        self._file = None
+
+    def _write(self, chunk: bytes):
+        if self._file is None and self.size + len(chunk) > UPLOAD_SPOOL_BYTES:
+            self._file = tempfile.NamedTemporaryFile(prefix="upload_")
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+            _count("spooled_to_disk")
+        (self._file or self._buffer).write(chunk)
+        self.size += len(chunk)
+
+    def _finish(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def open(self):
+        """Niezależny uchwyt do odczytu - etapy S3 i zmniejszania czytają równolegle."""
+        if self._file is not None:
+            return open(self._file.name, "rb")
+        return io.BytesIO(self._buffer.getvalue())
+
+    def source(self):
+        """Dla images.prepare: ścieżka pliku na dysku albo bajty małego zdjęcia."""
+        return self._file.name if self._file is not None else self._buffer.getvalue()
+
+    def upload_to_s3(self, s3, bucket: str, key: str):
+        with self.open() as f:
+            s3.upload_fileobj(f, bucket, key, ExtraArgs={"Metadata": {"sha256": self.sha256}},
+                              Config=_transfer_config)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _reject_dimensions(upload: SpooledUpload, reason: str):
+    _count("rejected_dimensions")
+    logger.warning("Odrzucono zdjęcie %s (%s B): %s", upload.filename, upload.size, reason)
+    raise HTTPException(status_code=413, detail="Zdjęcie ma zbyt duże wymiary.")
+
+
+def _check_image(upload: SpooledUpload):
+    try:
+        with upload.open() as f, Image.open(f) as img:
+            upload.width, upload.height = img.size
+    except Image.DecompressionBombError as e:
+        _reject_dimensions(upload, str(e))
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        _count("rejected_invalid")
+        logger.warning("Nieprawidłowy plik zdjęcia %s: %s", upload.filename, e)
+        raise HTTPException(status_code=400, detail="Nieprawidłowy plik zdjęcia.")
+    if upload.width * upload.height > UPLOAD_MAX_PIXELS:
+        _reject_dimensions(upload, f"{upload.width}x{upload.height} pikseli")
+
+
+def spool_upload(image: UploadFile) -> SpooledUpload:
+    """Plik z formularza jako SpooledUpload; 413 przy przekroczeniu limitów, 400 gdy to nie zdjęcie."""
+    upload = SpooledUpload(image.filename)
+    digest = hashlib.sha256()
+    try:
+        image.file.seek(0)
+        while True:
+            chunk = image.file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            if upload.size + len(chunk) > UPLOAD_MAX_BYTES:
+                _count("rejected_too_large")
+                raise HTTPException(status_code=413, detail=TOO_LARGE)
+            digest.update(chunk)
+            upload._write(chunk)
+        upload._finish()
+        upload.sha256 = digest.hexdigest()
+        _check_image(upload)
+    except BaseException:
+        upload.close()
+        raise
+    _count("uploads")
+    _count("bytes", upload.size)
+    return upload
+
+
+def spooled_image(image: UploadFile = File(...)):
+    """Zależność FastAPI: pole formularza image jako SpooledUpload, usuwany po odpowiedzi."""
+    upload = spool_upload(image)
+    try:
+        yield upload
+    finally:
+        upload.close()